@@ -0,0 +1,62 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Modules of the repository root
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from portfolio_manager import calculate_trade_metrics, calculate_equity_curve
+
+SETUP_FILE = os.path.join(REPO_DIR, 'setup', 'setup.json')
+
+
+def check_open_position_metrics(setup):
+    """An open position falling by half, with no closed trade, still shows in the drawdown and ratios."""
+
+    initial_cash = setup['Portfolio']['cash']
+    dates = pd.bdate_range('2024-01-01', periods=11)
+    close = pd.DataFrame({'SYN': np.linspace(100.0, 50.0, len(dates))}, index=dates)
+    quantity = initial_cash // 200
+    trades = pd.DataFrame({'date': [dates[0]], 'symbol': ['SYN'], 'action': ['buy'], 'price': [100.0],
+                           'quantity': [quantity], 'cash_remaining': [initial_cash - quantity * 100.0]})
+
+    equity_curve = calculate_equity_curve(trades, close, initial_cash, close['SYN'])
+    metrics = calculate_trade_metrics(trades, None, setup, print_trades=False, equity_curve=equity_curve)
+
+    expected = (1 - equity_curve['equity'].iloc[-1] / initial_cash) * 100
+    assert metrics['total_trades'] == 0 and 'fees' in metrics and 'benchmark' in metrics, metrics
+    assert np.isclose(metrics['max_drawdown'], expected), f"max_drawdown {metrics['max_drawdown']} != {expected}"
+    assert metrics['sharpe_ratio'] < 0 and metrics['exposure'] > 0, metrics
+
+
+# Backtest metrics checked on small hand-made cases, without any network access
+CHECKS = {
+    'portfolio_manager.open_position_metrics': check_open_position_metrics,
+}
+
+
+def main():
+
+    with open(SETUP_FILE, 'r') as f:
+        setup = json.load(f)
+
+    failures = []
+    for name, check in CHECKS.items():
+        try:
+            check(setup)
+            print(f"Check {name} passed")
+        except Exception as e:
+            print(f"Check {name} failed: {type(e).__name__} {e}")
+            failures.append(name)
+
+    if failures:
+        print(f"{len(failures)} checks failed: {', '.join(failures)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
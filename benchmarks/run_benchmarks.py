@@ -0,0 +1,390 @@
+import argparse
+import copy
+import gc
+import inspect
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import BDay
+from tabulate import tabulate
+
+# Modules of the repository root
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import momentum
+import risk
+import trend
+from data_providers import configure_data_provider
+from indicator_cache import configure_indicator_cache
+from market_data import get_market_data, clear_market_data
+from portfolio_manager import portfolio_manager, calculate_trade_metrics, calculate_ticker_gain
+from price_panel import fetch_price_panel
+from utils.analysis import get_stock_signals, set_score_action, add_moving_average_slope, get_backtest_equity_curve
+from utils.utils import get_stock_selection_dates
+
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+SETUP_FILE = os.path.join(REPO_DIR, 'setup', 'setup.json')
+
+# Modules every public function of which must have a benchmark
+BENCHMARKED_MODULES = [trend, momentum, risk]
+
+# Symbols of the synthetic universe and business days of the benchmarked period
+SIZES = {
+    'small': (20, 250),
+    'medium': (100, 1000),
+    'large': (500, 2500),
+}
+
+# Fixed end, so every run benchmarks the same synthetic data
+END_DATE = pd.Timestamp('2024-12-31')
+
+# Each benchmark builds the call it times from the context of a size, with fresh copies of the frames
+# the function modifies, so every repeat computes the same thing. Indicators run on the frame of the
+# first symbol, the pipeline stages on the whole universe.
+BENCHMARKS = {
+    # trend.py
+    'trend.calculate_ema': lambda c: (trend.calculate_ema, (c['close'], 20)),
+    'trend.calculate_sma': lambda c: (trend.calculate_sma, (c['close'], 20)),
+    'trend.detect_long_term_crossings': lambda c: (trend.detect_long_term_crossings,
+                                                   (c['frame'].copy(), c['setup'], c['end_date'])),
+    'trend.detect_ma_crossings': lambda c: (trend.detect_ma_crossings, (c['frame'].copy(), c['setup'], c['end_date'])),
+    'trend.detect_bollinger_crossings': lambda c: (trend.detect_bollinger_crossings,
+                                                   (c['frame'].copy(), c['setup'], c['end_date'])),
+    'trend.detect_wr_crossings': lambda c: (trend.detect_wr_crossings, (c['frame'].copy(), c['setup'], c['end_date'])),
+    'trend.calculate_crossing_signal': lambda c: (trend.calculate_crossing_signal, (c['sma_short'], c['sma_long'])),
+    'trend.calculate_bollinger_signal': lambda c: (trend.calculate_bollinger_signal, (c['close'], 20, 2)),
+    'trend.calculate_macd': lambda c: (trend.calculate_macd, (c['close'], 12, 26, 9)),
+    'trend.calculate_week_rule_signal': lambda c: (trend.calculate_week_rule_signal,
+                                                   (c['close'], c['high'], c['low'], 4)),
+    'trend.detect_macd_trend': lambda c: (trend.detect_macd_trend, (c['frame'].copy(), c['setup'], c['end_date'])),
+    'trend.calculate_ma_slope': lambda c: (trend.calculate_ma_slope, (c['frame'].copy(), 20, 3, 'benchmark')),
+    'trend.calculate_rolling_slope': lambda c: (trend.calculate_rolling_slope, (c['sma_long'], 3)),
+    'trend.calculate_obv': lambda c: (trend.calculate_obv, (c['frame'].copy(), c['obv_setup'])),
+    'trend.calculate_on_balance_volume': lambda c: (trend.calculate_on_balance_volume, (c['close'], c['volume'])),
+    'trend.add_stochastic_oscillator': lambda c: (trend.add_stochastic_oscillator, (c['frame'].copy(), c['setup'])),
+    'trend.calculate_stochastic_oscillator': lambda c: (trend.calculate_stochastic_oscillator,
+                                                        (c['high'], c['low'], c['close'], 14, 3, 3)),
+    'trend.detect_stochastic_crossings': lambda c: (trend.detect_stochastic_crossings, (c['indicators'].copy(),)),
+
+    # momentum.py
+    'momentum.add_rsi': lambda c: (momentum.add_rsi, (c['frame'].copy(), c['setup'])),
+    'momentum.calculate_rsi': lambda c: (momentum.calculate_rsi, (c['close'], 14)),
+    'momentum.calculate_rsi_averages': lambda c: (momentum.calculate_rsi_averages, (c['close'], 14)),
+    'momentum.wilder_smoothing': lambda c: (momentum.wilder_smoothing, (c['gain'], 14)),
+    'momentum.rsi_add_cross_signal': lambda c: (momentum.rsi_add_cross_signal, (c['indicators'].copy(), c['setup'])),
+    'momentum.calculate_rsi_signal': lambda c: (momentum.calculate_rsi_signal, (c['indicators']['RSI'], 30, 70)),
+    'momentum.add_adx': lambda c: (momentum.add_adx, (c['frame'].copy(), c['setup'])),
+    'momentum.calculate_adx': lambda c: (momentum.calculate_adx, (c['high'], c['low'], c['close'], 14)),
+
+    # risk.py
+    'risk.get_stop_data': lambda c: (risk.get_stop_data, (c['frame'], c['setup'], c['close'].iloc[0] * 1.5,
+                                                          c['frame'].index[0], 'Buy')),
+    'risk.evaluate_positions': lambda c: (risk.evaluate_positions, (c['position'], c['price_panel'], c['setup'])),
+    'risk.get_first_hit': lambda c: (risk.get_first_hit, (c['stop_hit'], c['close_matrix'], c['price_panel'].dates)),
+    'risk.add_shape_ratio': lambda c: (risk.add_shape_ratio, (c['frame'].copy(), c['irx'], c['setup'])),
+    'risk.calculate_sharpe_ratio': lambda c: (risk.calculate_sharpe_ratio, (c['returns'], c['irx'], 90, 252)),
+    'risk.add_sortino_ratio': lambda c: (risk.add_sortino_ratio, (c['frame'].copy(), c['irx'], c['setup'])),
+    'risk.calculate_sortino_ratio': lambda c: (risk.calculate_sortino_ratio, (c['returns'], c['daily_rf'], 20, 252)),
+    'risk.get_stock_from_rm': lambda c: (risk.get_stock_from_rm, (dict(c['signals']), c['setup'])),
+    'risk.calculate_risk_filter': lambda c: (risk.calculate_risk_filter, (c['scored'], c['setup'])),
+
+    # Pipeline stages
+    'analysis.get_stock_signals': lambda c: (get_stock_signals, (c['stock_list'], c['setup'], len(c['stock_list']),
+                                                                 c['start_date'], c['end_date'])),
+    'analysis.get_stock_signals[panel]': lambda c: (get_stock_signals, (c['stock_list'], c['setup'],
+                                                                        len(c['stock_list']), c['start_date'],
+                                                                        c['end_date'], 1, 'panel')),
+    'analysis.set_score_action': lambda c: (set_score_action, (c['indicators'].copy(), c['setup'])),
+    'analysis.get_backtest_equity_curve': lambda c: (get_backtest_equity_curve,
+                                                     (c['trades'], c['stock_list'], c['setup'], c['start_date'],
+                                                      c['end_date'])),
+    'portfolio_manager.portfolio_manager': lambda c: (portfolio_manager, (c['signals'], c['setup'])),
+    'portfolio_manager.calculate_trade_metrics': lambda c: (calculate_trade_metrics,
+                                                            (c['trades'], c['benchmark'], c['setup'], False,
+                                                             c['equity_curve'])),
+
+    # Imports of a fresh interpreter starting main.py, the fixed cost of every CLI run
+    'main.startup': lambda c: (import_main, ()),
+}
+
+
+def main():
+
+    args = parse_arguments()
+
+    missing = [name for name in get_public_functions(BENCHMARKED_MODULES) if name not in BENCHMARKS]
+    for name in missing:
+        print(f"Warning: {name} has no benchmark")
+
+    names = [name for name in BENCHMARKS if not args.only or any(pattern in name for pattern in args.only)]
+
+    # Prices come from the seeded generator, and indicators are timed as computed, never served from the cache
+    configure_data_provider('synthetic', seed=args.seed)
+    configure_indicator_cache(0)
+
+    rows = []
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        for size in args.sizes:
+            symbols, days = SIZES[size]
+            print(f"Benchmarking {size}: {symbols} symbols x {days} days")
+
+            # Each size gets its own store, as the ticker_data directory of the working directory
+            size_dir = os.path.join(work_dir, size)
+            os.makedirs(size_dir)
+            os.chdir(size_dir)
+            clear_market_data()
+
+            context = build_context(symbols, days)
+            for name in names:
+                timings = time_benchmark(BENCHMARKS[name], context, args.repeat)
+                rows.append({'size': size, 'name': name, 'symbols': symbols, 'days': days,
+                             'min_ms': min(timings) * 1000, 'median_ms': statistics.median(timings) * 1000})
+
+        os.chdir(cwd)
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': rows
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now().strftime('%Y-%m-%dT%H-%M-%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {output}")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(rows, baseline['results'], args.threshold, args.min_delta)
+        print(f"Compared to {args.baseline} (commit {baseline.get('commit')})")
+
+    print_results(rows, args.baseline is not None)
+
+    if regressions:
+        print(f"{len(regressions)} benchmarks slower than the baseline by more than {args.threshold:.0%}:")
+        for row in regressions:
+            print(f"  {row['size']} {row['name']}: {row['baseline_ms']:.3f} ms -> {row['min_ms']:.3f} ms")
+        sys.exit(1)
+
+
+def parse_arguments():
+
+    parser = argparse.ArgumentParser(description='Time the indicators and pipeline stages on synthetic data, '
+                                                 'without any network access.')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small', 'medium'],
+                        help='Universe sizes to benchmark (default: small medium)')
+    parser.add_argument('--only', nargs='+', help='Only run the benchmarks whose name contains one of these')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed calls of each benchmark (default: 5)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic prices (default: 0)')
+    parser.add_argument('--output', help='JSON file to save the results to (default: '
+                                         'benchmarks/results/<datetime>.json)')
+    parser.add_argument('--baseline', help='Results JSON of an earlier run to compare to, exiting with 1 when a '
+                                           'benchmark got slower')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Slowdown over the baseline reported as a regression (default: 0.25)')
+    parser.add_argument('--min-delta', type=float, default=1.0,
+                        help='Milliseconds a benchmark must also lose to be a regression, so timer noise on fast '
+                             'functions is ignored (default: 1.0)')
+    return parser.parse_args()
+
+
+def build_context(symbols, days):
+    """Load a synthetic universe into the store and prepare the inputs of every benchmark."""
+
+    setup = get_benchmark_setup()
+    end_date = END_DATE
+    start_date = end_date - BDay(days)
+    analysis_start_date, _ = get_stock_selection_dates(start_date, end_date, setup)
+
+    stock_list = [{'Symbol': f"SYN{number:04d}"} for number in range(symbols)]
+    tickers = [stock['Symbol'] for stock in stock_list]
+
+    price_panel = fetch_price_panel(tickers, start_date=analysis_start_date, end_date=end_date)
+    irx = get_market_data(['^IRX'], start_date=analysis_start_date, end_date=end_date)['^IRX']
+
+    frame = price_panel.get_frame(tickers[0], analysis_start_date, end_date).copy()
+    frame['daily_return'] = frame['Close'].pct_change(fill_method=None)
+
+    obv_setup = copy.deepcopy(setup)
+    obv_setup['Analysis']['Volume']['OBV']['enabled'] = 1
+
+    close_matrix = price_panel.get_field('Close')
+    position = {'Position': {ticker: {str(start_date.date()): {'price': float(close_matrix[i, -days]), 'volume': 100}}
+                             for i, ticker in enumerate(tickers)}}
+
+    indicators = add_indicators(frame.copy(), irx, setup, end_date)
+    scored = indicators.copy()
+    set_score_action(scored, setup)
+
+    signals = risk.get_stock_from_rm(get_stock_signals(stock_list, setup, symbols, start_date, end_date), setup)
+    trades = portfolio_manager(signals, setup)
+    benchmark = calculate_ticker_gain('^SPX', start_date, end_date)
+
+    return {
+        'setup': setup,
+        'obv_setup': obv_setup,
+        'stock_list': stock_list,
+        'start_date': start_date,
+        'end_date': end_date,
+        'price_panel': price_panel,
+        'irx': irx,
+        'daily_rf': (1 + irx['Close']) ** (1 / 252) - 1,
+        'frame': frame,
+        'close': frame['Close'],
+        'high': frame['High'],
+        'low': frame['Low'],
+        'volume': frame['Volume'],
+        'returns': frame['daily_return'],
+        'gain': frame['Close'].diff().clip(lower=0),
+        'sma_short': trend.calculate_sma(frame['Close'], 5),
+        'sma_long': trend.calculate_sma(frame['Close'], 20),
+        'indicators': indicators,
+        'scored': scored,
+        'close_matrix': close_matrix,
+        'stop_hit': close_matrix <= close_matrix[:, -days:-days + 1] * 0.9,
+        'position': position,
+        'signals': signals,
+        'trades': trades,
+        'benchmark': benchmark,
+        'equity_curve': get_backtest_equity_curve(trades, stock_list, setup, start_date, end_date),
+    }
+
+
+def add_indicators(df, irx, setup, end_date):
+    """Frame with every column the ticker pipeline adds before scoring, as get_ticker_signals builds it."""
+
+    risk.add_shape_ratio(df, irx, setup)
+    risk.add_sortino_ratio(df, irx, setup)
+    add_moving_average_slope(df, setup)
+    momentum.add_adx(df, setup)
+    momentum.add_rsi(df, setup)
+    trend.add_stochastic_oscillator(df, setup)
+    trend.detect_long_term_crossings(stock_data=df, setup=setup, end_date=end_date)
+    trend.detect_ma_crossings(stock_data=df, end_date=end_date, setup=setup)
+    trend.detect_bollinger_crossings(stock_data=df, end_date=end_date, setup=setup)
+    trend.detect_wr_crossings(stock_data=df, setup=setup, end_date=end_date)
+    trend.detect_macd_trend(df, setup=setup, end_date=end_date)
+
+    return df.dropna()
+
+
+def get_benchmark_setup():
+    """setup.json with every analysis method and filter enabled, so no benchmark is skipped by the setup.
+
+    OBV has no weight in the score, so it stays disabled there and its benchmark enables it on a copy.
+    """
+
+    with open(SETUP_FILE, 'r') as f:
+        setup = json.load(f)
+
+    for analysis in setup['Analysis'].values():
+        for name, method in analysis.items():
+            if name != 'OBV':
+                method['enabled'] = 1
+
+    for filters in setup['Filters'].values():
+        for method in filters.values():
+            method['enabled'] = 1
+
+    setup['Risk']['SharpeRatio']['enabled'] = 1
+    setup['Risk']['Stop']['trailing'] = 0.1
+
+    return setup
+
+
+def time_benchmark(benchmark, context, repeat):
+    """Seconds of each of `repeat` calls, after an untimed warm up call."""
+
+    timings = []
+    for run in range(repeat + 1):
+        func, args = benchmark(context)
+
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func(*args)
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+
+        if run > 0:
+            timings.append(elapsed)
+
+    return timings
+
+
+def compare_results(rows, baseline_rows, threshold, min_delta):
+    """Add the baseline time to each row measured in both runs and return the rows that got slower."""
+
+    baseline = {(row['size'], row['name']): row['min_ms'] for row in baseline_rows}
+
+    regressions = []
+    for row in rows:
+        baseline_ms = baseline.get((row['size'], row['name']))
+        if baseline_ms is None:
+            continue
+        row['baseline_ms'] = baseline_ms
+        row['change'] = row['min_ms'] / baseline_ms - 1 if baseline_ms > 0 else 0.0
+        if row['change'] > threshold and row['min_ms'] - baseline_ms > min_delta:
+            regressions.append(row)
+
+    return regressions
+
+
+def print_results(rows, compared):
+
+    headers = ['size', 'benchmark', 'min [ms]', 'median [ms]']
+    if compared:
+        headers += ['baseline [ms]', 'change']
+
+    table = []
+    for row in rows:
+        line = [row['size'], row['name'], row['min_ms'], row['median_ms']]
+        if compared:
+            line += [row.get('baseline_ms'), f"{row['change']:+.1%}" if 'change' in row else None]
+        table.append(line)
+
+    print(tabulate(table, headers=headers, tablefmt="grid", floatfmt=".3f"))
+
+
+def import_main():
+    # Run from the working directory of the size, where main.py creates its logs directory
+    subprocess.run([sys.executable, '-c', f"import sys; sys.path.insert(0, {REPO_DIR!r}); import main"], check=True)
+
+
+def get_public_functions(modules):
+    return [f"{module.__name__}.{name}" for module in modules
+            for name, func in inspect.getmembers(module, inspect.isfunction)
+            if func.__module__ == module.__name__ and not name.startswith('_')]
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,288 @@
-import logging
-import pickle
-import yfinance as yf
+import json
+import os
+from collections import defaultdict
 
-from utils.utils import get_hash, search_file
+import numpy as np
+import pandas as pd
 
+from data_providers import PRICE_FIELDS, YahooProvider, get_data_provider
+from utils.logging_config import logger
+from utils.profiling import profiled
+from utils.utils import create_directories_if_not_exist
 
-def fetch_yahoo_stock_data(stock_list, start_date, end_date):
-    """Fetch historical stock data for the given ticker."""
+STORE_DIR = 'ticker_data'
+MANIFEST_FILE = 'manifest.json'
+
+# Calendar days of stored bars downloaded again next to a missing range, to cover at least one trading day
+OVERLAP_DAYS = 7
+
+# Relative difference of a stored close downloaded again beyond which the symbol history was re-adjusted
+ADJUSTMENT_TOLERANCE = 1e-4
 
-    # If no pickled data is found, then download it
-    stock_data_hash = get_hash(f"{str(stock_list)}_{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}")
 
-    stock_data = load_pickled_stock_data(stock_data_hash)
+@profiled
+def fetch_yahoo_stock_data(stock_list, start_date, end_date):
+    """Fetch historical stock data for the given tickers.
+
+    Data is served from the per-symbol store in ``ticker_data/``. Only the symbols and
+    date ranges not held locally yet are downloaded from the configured data provider
+    (Yahoo by default) and merged into the store.
 
-    if stock_data is None:
+    Returns:
+        pandas.DataFrame: Frame in the ``yf.download(group_by='ticker')`` layout, with the
+        ticker on the first column level and the price fields on the second.
+    """
 
-        stock_data = yf.download(stock_list, start=start_date, end=end_date,
-                                 threads=False, group_by='ticker', auto_adjust=True)
+    update_stock_store(stock_list, start_date, end_date)
 
-        save_pickled_stock_data(hash_value=stock_data_hash, data=stock_data)
+    stock_data = load_stock_data(stock_list, start_date, end_date)
 
     if stock_data.empty:
+        logger.error(f"Failed to fetch yahoo data!")
         raise ValueError(f"Failed to fetch yahoo data!")
-        logging.ERROR(f"Failed to fetch yahoo data!")
+
+    return stock_data
+
+
+@profiled
+def update_stock_store(stock_list, start_date, end_date, store_dir=STORE_DIR):
+    """Download the missing symbols and missing leading/trailing days into the store.
+
+    Symbols missing the same date range are grouped into a single provider download, so a
+    daily run appending one bar to every symbol costs one request. Symbols stored from
+    another provider are dropped and downloaded again in full.
+
+    Prices are adjusted for splits and dividends, which re-adjusts the whole history of a symbol
+    on every corporate action. Each download therefore also covers a few stored bars; when they
+    no longer match the store, the symbol is dropped and its full history downloaded again.
+    A symbol missing from a download keeps its coverage, so the next run asks for it again.
+    """
+
+    create_directories_if_not_exist(store_dir)
+    manifest = load_manifest(store_dir)
+    start, end = get_store_range(start_date, end_date)
+    provider = get_data_provider()
+
+    # Stores written before providers existed hold Yahoo data
+    replaced = [symbol for symbol in dict.fromkeys(stock_list)
+                if symbol in manifest and manifest[symbol].get('provider', YahooProvider.name) != provider.name]
+    for symbol in replaced:
+        remove_symbol_data(symbol, store_dir)
+        del manifest[symbol]
+    if replaced:
+        logger.info(f"Replacing {len(replaced)} symbols stored from another data provider")
+        save_manifest(manifest, store_dir)
+
+    # Group symbols by the date range they are missing
+    pending = defaultdict(list)
+    for symbol in dict.fromkeys(stock_list):
+        for missing_range in get_missing_ranges(manifest.get(symbol), start, end):
+            pending[get_overlap_range(manifest.get(symbol), *missing_range)].append(symbol)
+
+    readjusted = []
+    for (range_start, range_end), symbols in pending.items():
+        logger.info(f"Downloading {len(symbols)} symbols from {range_start.date()} to {range_end.date()}")
+
+        data = provider.download(symbols, range_start, range_end)
+
+        for symbol in symbols:
+            if symbol in readjusted:
+                continue
+
+            symbol_data = extract_symbol_data(data, symbol)
+            if symbol_data is None:
+                # Providers drop symbols of a request now and then, so retry this range on the next run
+                logger.warning(f"{symbol} - No data downloaded from {range_start.date()} to {range_end.date()}")
+                continue
+
+            stored_data = read_symbol_data(symbol, store_dir)
+            if stored_data is not None:
+                if is_readjusted(stored_data, symbol_data):
+                    readjusted.append(symbol)
+                    continue
+                symbol_data = pd.concat([stored_data, symbol_data])
+                symbol_data = symbol_data[~symbol_data.index.duplicated(keep='last')].sort_index()
+
+            write_symbol_data(symbol, symbol_data, store_dir)
+
+            coverage = manifest.get(symbol, {'start': range_start.isoformat(), 'end': range_end.isoformat()})
+            manifest[symbol] = {
+                'start': min(pd.Timestamp(coverage['start']), range_start).isoformat(),
+                'end': max(pd.Timestamp(coverage['end']), range_end).isoformat(),
+                'provider': provider.name,
+                # Price panels of the symbol are stale whenever its data is written
+                'updated': pd.Timestamp.now().isoformat()
+            }
+
+        save_manifest(manifest, store_dir)
+
+    if readjusted:
+        logger.info(f"Downloading again the full history of {len(readjusted)} symbols re-adjusted for a split or "
+                    f"dividend: {', '.join(readjusted)}")
+
+        full_start = min([start] + [pd.Timestamp(manifest[symbol]['start']) for symbol in readjusted])
+        full_end = max([end] + [pd.Timestamp(manifest[symbol]['end']) for symbol in readjusted])
+        for symbol in readjusted:
+            remove_symbol_data(symbol, store_dir)
+            del manifest[symbol]
+        save_manifest(manifest, store_dir)
+
+        update_stock_store(readjusted, full_start, full_end, store_dir)
+
+
+@profiled
+def load_stock_data(stock_list, start_date, end_date, store_dir=STORE_DIR):
+    """Slice the given symbols and date range from the local store, without any download."""
+
+    start, end = get_store_range(start_date, end_date)
+
+    frames = {}
+    for symbol in dict.fromkeys(stock_list):
+        symbol_data = read_symbol_data(symbol, store_dir)
+        if symbol_data is not None:
+            frames[symbol] = symbol_data[(symbol_data.index >= start) & (symbol_data.index < end)]
+
+    if not frames:
+        return pd.DataFrame()
+
+    stock_data = pd.concat(frames, axis=1).sort_index()
+    stock_data.columns.names = ['Ticker', 'Price']
+    stock_data.index.name = 'Date'
+
     return stock_data
 
 
-def load_pickled_stock_data(hash_value):
+def get_store_range(start_date, end_date):
+    """Convert requested dates to the whole-day ``[start, end)`` range the store works with.
+
+    The end is exclusive as in ``yf.download`` and is capped at today, so incomplete
+    intraday bars are never stored.
+    """
+    start = pd.Timestamp(start_date).normalize()
+    end = pd.Timestamp(end_date)
+    if end != end.normalize():
+        end = end.normalize() + pd.Timedelta(days=1)
+
+    return start, min(end, pd.Timestamp.now().normalize())
+
+
+def get_missing_ranges(coverage, start, end):
+    """Return the ``[start, end)`` ranges of the request not covered by the store."""
 
-    filename = f"{hash_value}.pkl"
+    if start >= end:
+        return []
 
-    if search_file('ticker_data', filename) is not None:
-        with open(f"ticker_data/{filename}", "rb") as f:
-            return pickle.load(f)
-    else:
+    if coverage is None:
+        return [(start, end)]
+
+    missing = []
+    covered_start = pd.Timestamp(coverage['start'])
+    covered_end = pd.Timestamp(coverage['end'])
+
+    if start < covered_start:
+        missing.append((start, covered_start))
+    if end > covered_end:
+        missing.append((covered_end, end))
+
+    return missing
+
+
+def get_overlap_range(coverage, range_start, range_end):
+    """Widen a missing range by OVERLAP_DAYS into the stored days it touches, to check them against the store."""
+
+    if coverage is None:
+        return range_start, range_end
+
+    if range_start == pd.Timestamp(coverage['end']):
+        range_start -= pd.Timedelta(days=OVERLAP_DAYS)
+    if range_end == pd.Timestamp(coverage['start']):
+        range_end += pd.Timedelta(days=OVERLAP_DAYS)
+
+    return range_start, range_end
+
+
+def is_readjusted(stored_data, symbol_data):
+    """Whether the closes of the stored days downloaded again differ from the stored ones."""
+
+    dates = stored_data.index.intersection(symbol_data.index)
+    stored = stored_data['Close'].reindex(dates).to_numpy()
+    downloaded = symbol_data['Close'].reindex(dates).to_numpy()
+
+    valid = ~np.isnan(stored) & ~np.isnan(downloaded)
+    return not np.allclose(downloaded[valid], stored[valid], rtol=ADJUSTMENT_TOLERANCE, atol=0)
+
+
+def extract_symbol_data(data, symbol):
+    """Extract a single symbol OHLCV frame from a provider download."""
+
+    if data is None or data.empty:
+        return None
+
+    if isinstance(data.columns, pd.MultiIndex):
+        if symbol not in data.columns.get_level_values(0):
+            return None
+        data = data[symbol]
+
+    symbol_data = data.reindex(columns=PRICE_FIELDS).dropna(how='all')
+    if symbol_data.empty:
         return None
 
+    symbol_data.index = pd.DatetimeIndex(symbol_data.index).tz_localize(None)
+    symbol_data.index.name = 'Date'
+
+    return symbol_data.astype('float64')
+
+
+def get_symbol_path(symbol, store_dir=STORE_DIR):
+    return os.path.join(store_dir, f"{symbol.replace('/', '_')}.npz")
+
+
+def read_symbol_data(symbol, store_dir=STORE_DIR):
+
+    path = get_symbol_path(symbol, store_dir)
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as stored:
+        index = pd.DatetimeIndex(stored['Date'].view('datetime64[ns]'), name='Date')
+        return pd.DataFrame({field: stored[field] for field in PRICE_FIELDS}, index=index)
+
+
+def write_symbol_data(symbol, data, store_dir=STORE_DIR):
+
+    path = get_symbol_path(symbol, store_dir)
+    tmp_path = f"{path[:-len('.npz')]}.tmp.npz"
+
+    columns = {field: data[field].to_numpy(dtype='float64') for field in PRICE_FIELDS}
+    np.savez(tmp_path, Date=data.index.values.astype('datetime64[ns]').view('int64'), **columns)
+
+    # Replace atomically so readers never see a partially written file
+    os.replace(tmp_path, path)
+
+
+def remove_symbol_data(symbol, store_dir=STORE_DIR):
+
+    path = get_symbol_path(symbol, store_dir)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def load_manifest(store_dir=STORE_DIR):
 
-def save_pickled_stock_data(hash_value, data):
+    path = os.path.join(store_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
 
-    filename = f"{hash_value}.pkl"
+    with open(path, 'r') as f:
+        return json.load(f)
 
-    if search_file('ticker_data', filename) is None:
-        with open(f"ticker_data/{filename}", "wb") as file:
-            pickle.dump(data, file)
 
+def save_manifest(manifest, store_dir=STORE_DIR):
 
+    path = os.path.join(store_dir, MANIFEST_FILE)
+    tmp_path = f"{path}.tmp"
 
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
 
+    os.replace(tmp_path, path)
@@ -0,0 +1,192 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from synthetic_data import generate_stock_data
+from utils.logging_config import logger
+
+PRICE_FIELDS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+
+class YahooProvider:
+    """Bars downloaded from Yahoo Finance."""
+
+    name = 'yfinance'
+
+    def download(self, symbols, start_date, end_date, interval='1d', auto_adjust=True):
+        """
+        Bars of the symbols over ``[start_date, end_date)``, in the ``yf.download(group_by='ticker')``
+        layout every provider returns, without the symbols it has no data for.
+        """
+        # yfinance is slow to import, and a store holding every requested day never needs it
+        import yfinance as yf
+
+        return yf.download(list(symbols), start=start_date, end=end_date, interval=interval, threads=False,
+                           group_by='ticker', auto_adjust=auto_adjust)
+
+
+class LocalDirectoryProvider:
+    """
+    Daily bars read from a directory of per-symbol files, such as a vendor dump.
+
+    Each symbol is a ``<symbol>.parquet``, ``<symbol>.csv`` or ``<symbol>.csv.gz`` file ('/' in the symbol
+    replaced by '_') with a date column or index and Open, High, Low, Close and Volume columns, in any
+    case. With an 'Adj Close' column, prices are adjusted by its ratio to Close, as Yahoo auto_adjust does.
+    The files of a request are read by max_workers threads.
+    """
+
+    name = 'local'
+    extensions = ['.parquet', '.csv', '.csv.gz']
+
+    def __init__(self, data_dir, max_workers=8):
+        if not os.path.isdir(data_dir):
+            raise ValueError(f"Data directory {data_dir} does not exist")
+        self.data_dir = data_dir
+        self.max_workers = max_workers
+
+    def download(self, symbols, start_date, end_date, interval='1d', auto_adjust=True):
+        check_daily_interval(self.name, interval)
+
+        symbols = list(dict.fromkeys(symbols))
+        start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            frames = executor.map(lambda symbol: self.read_symbol(symbol, auto_adjust), symbols)
+            frames = {symbol: frame[(frame.index >= start) & (frame.index < end)]
+                      for symbol, frame in zip(symbols, frames) if frame is not None}
+
+        return concat_symbol_frames(frames)
+
+    def get_symbol_file(self, symbol):
+        for extension in self.extensions:
+            path = os.path.join(self.data_dir, f"{symbol.replace('/', '_')}{extension}")
+            if os.path.exists(path):
+                return path
+        return None
+
+    def read_symbol(self, symbol, auto_adjust=True):
+
+        path = self.get_symbol_file(symbol)
+        if path is None:
+            logger.warning(f"{symbol} - No file in {self.data_dir}")
+            return None
+
+        try:
+            data = pd.read_parquet(path) if path.endswith('.parquet') else pd.read_csv(path)
+            return normalize_symbol_frame(data, auto_adjust)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"{symbol} - Ignoring unreadable file {path} - {str(e)}")
+            return None
+
+
+class SyntheticProvider:
+    """Deterministic daily bars from synthetic_data, to run the pipeline offline."""
+
+    name = 'synthetic'
+
+    def __init__(self, seed=0):
+        self.seed = seed
+
+    def download(self, symbols, start_date, end_date, interval='1d', auto_adjust=True):
+        check_daily_interval(self.name, interval)
+        return generate_stock_data(symbols, start_date, end_date, seed=self.seed)
+
+
+PROVIDERS = {
+    YahooProvider.name: YahooProvider,
+    LocalDirectoryProvider.name: LocalDirectoryProvider,
+    SyntheticProvider.name: SyntheticProvider,
+}
+
+# Provider every download of the process goes through
+_provider = YahooProvider()
+
+
+def configure_data_provider(name=YahooProvider.name, data_dir=None, seed=0):
+    """
+    Select the provider of the market data: 'yfinance', 'local' (files of data_dir) or 'synthetic'.
+
+    The ticker_data store keeps serving what it holds, so a provider only receives the symbols and
+    days the store lacks; symbols stored from another provider are fetched again in full.
+    """
+    global _provider
+
+    if name == LocalDirectoryProvider.name:
+        if data_dir is None:
+            raise ValueError("The local provider needs a data directory")
+        _provider = LocalDirectoryProvider(data_dir)
+    elif name == SyntheticProvider.name:
+        _provider = SyntheticProvider(seed)
+    elif name == YahooProvider.name:
+        _provider = YahooProvider()
+    else:
+        raise ValueError(f"Unknown data provider {name}, expected one of {', '.join(PROVIDERS)}")
+
+    return _provider
+
+
+def get_data_provider():
+    return _provider
+
+
+def download_symbol_data(symbol, start_date, end_date, interval='1d', auto_adjust=True):
+    """Bars of a single symbol from the configured provider, as a flat OHLCV frame, empty if none."""
+
+    data = _provider.download([symbol], start_date, end_date, interval=interval, auto_adjust=auto_adjust)
+    if data is None or data.empty:
+        return pd.DataFrame()
+
+    if isinstance(data.columns, pd.MultiIndex):
+        if symbol not in data.columns.get_level_values(0):
+            return pd.DataFrame()
+        data = data[symbol]
+
+    return data.dropna(how='all')
+
+
+def check_daily_interval(name, interval):
+    if interval != '1d':
+        raise ValueError(f"The {name} provider only has daily bars, not {interval}")
+
+
+def normalize_symbol_frame(data, auto_adjust=True):
+    """Date indexed OHLCV frame of a symbol file, whatever the case of its columns."""
+
+    columns = {column: str(column).strip().lower() for column in data.columns}
+    data = data.rename(columns=columns)
+
+    if 'date' in data.columns:
+        data = data.set_index('date')
+    elif 'datetime' in data.columns:
+        data = data.set_index('datetime')
+
+    fields = {field.lower(): field for field in PRICE_FIELDS}
+    missing = [field for field in fields if field not in data.columns]
+    if missing:
+        raise KeyError(f"Missing columns {', '.join(missing)}")
+
+    frame = data[list(fields)].rename(columns=fields).astype('float64')
+    frame.index = pd.DatetimeIndex(pd.to_datetime(frame.index)).tz_localize(None)
+    frame.index.name = 'Date'
+
+    if auto_adjust and 'adj close' in data.columns:
+        ratio = data['adj close'].to_numpy(dtype='float64') / frame['Close'].to_numpy()
+        ratio = np.where(np.isfinite(ratio), ratio, 1.0)
+        for field in ['Open', 'High', 'Low', 'Close']:
+            frame[field] *= ratio
+
+    return frame[~frame.index.duplicated(keep='last')].sort_index()
+
+
+def concat_symbol_frames(frames):
+
+    if not frames:
+        return pd.DataFrame()
+
+    data = pd.concat(frames, axis=1).sort_index()
+    data.columns.names = ['Ticker', 'Price']
+    data.index.name = 'Date'
+
+    return data
@@ -0,0 +1,244 @@
+import functools
+import hashlib
+import os
+import pickle
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from utils.logging_config import logger
+from utils.profiling import count, profiled
+from utils.utils import get_hash, create_directories_if_not_exist
+
+DEFAULT_CACHE_SIZE = 256 * 1024 ** 2
+
+# Files kept in the cache directory per (symbol, indicator, parameters), one per input data version. A new
+# daily bar changes the input of every indicator, so older versions are removed past this count
+DISK_VERSIONS = 2
+
+
+class IndicatorCache(OrderedDict):
+    """Indicator results in least recently used order, dropping the oldest above max_bytes."""
+
+    def __init__(self, max_bytes):
+        super().__init__()
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.nbytes += get_nbytes(value)
+
+    def clear(self):
+        super().clear()
+        self.nbytes = 0
+
+    def trim(self):
+        while self.nbytes > self.max_bytes and len(self) > 1:
+            key, value = self.popitem(last=False)
+            self.nbytes -= get_nbytes(value)
+
+
+# Process wide cache every memoized indicator goes through
+_cache = IndicatorCache(DEFAULT_CACHE_SIZE)
+_cache_dir = None
+
+# Symbol the indicators being computed belong to, None for universe matrices
+_symbol = None
+
+# Fingerprints of live index objects; indexes are immutable and shared by every column of a frame
+_index_fingerprints = {}
+
+
+def configure_indicator_cache(max_bytes=DEFAULT_CACHE_SIZE, cache_dir=None):
+    """
+    Set the memory cap of the indicator cache and the directory persisting it across runs.
+
+    A max_bytes of 0 keeps nothing in memory; without a cache_dir nothing is written to disk.
+    """
+    global _cache, _cache_dir
+
+    _cache = IndicatorCache(max_bytes)
+    _cache_dir = cache_dir
+    if cache_dir is not None:
+        create_directories_if_not_exist(cache_dir)
+
+
+def get_indicator_cache_config():
+    """Arguments of configure_indicator_cache matching the current cache, to set up worker processes."""
+    return _cache.max_bytes, _cache_dir
+
+
+@contextmanager
+def indicator_symbol(symbol):
+    """Key the indicators computed inside the block by symbol."""
+    global _symbol
+
+    previous, _symbol = _symbol, symbol
+    try:
+        yield
+    finally:
+        _symbol = previous
+
+
+def memoize_indicator(func):
+    """
+    Memoize an indicator function on (symbol, indicator, parameters, fingerprint of the input data).
+
+    Series and DataFrame arguments are identified by a hash of their values, index and labels, so
+    the same indicator over the same data is computed once whichever caller asks for it. The symbol
+    is the one set by indicator_symbol, if any.
+
+    Results are shared between callers and must not be modified in place.
+    """
+
+    @profiled(name=f"indicator {func.__name__}")
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+
+        if _cache.max_bytes <= 0 and _cache_dir is None:
+            return func(*args, **kwargs)
+
+        key = get_indicator_key(func, args, kwargs)
+        if key in _cache:
+            count('indicator cache hits')
+            return _cache[key]
+
+        value = read_indicator(key) if _cache_dir is not None else None
+        if value is None:
+            count('indicator cache misses')
+            value = func(*args, **kwargs)
+            if _cache_dir is not None:
+                write_indicator(key, value)
+        else:
+            count('indicator disk hits')
+
+        if _cache.max_bytes > 0:
+            _cache[key] = value
+            _cache.trim()
+
+        return value
+
+    return wrapper
+
+
+def get_indicator_key(func, args, kwargs):
+
+    params = []
+    digest = hashlib.sha1()
+
+    arguments = [(None, value) for value in args] + sorted(kwargs.items())
+    for name, value in arguments:
+        if isinstance(value, (pd.Series, pd.DataFrame)):
+            update_fingerprint(digest, value)
+            value = 'data'
+        params.append(repr(value) if name is None else f"{name}={value!r}")
+
+    return _symbol, func.__name__, tuple(params), digest.hexdigest()
+
+
+def update_fingerprint(digest, data):
+    """Add the values, index and labels of a Series or DataFrame to a hash."""
+
+    values = data.to_numpy()
+    if values.dtype == object:
+        values = pd.util.hash_pandas_object(data, index=False).to_numpy()
+
+    digest.update(f"{type(data).__name__}{values.shape}{values.dtype}".encode('utf-8'))
+    digest.update(np.ascontiguousarray(values).data)
+    digest.update(get_index_fingerprint(data.index))
+    if isinstance(data, pd.DataFrame):
+        digest.update(repr(list(data.columns)).encode('utf-8'))
+    else:
+        digest.update(repr(data.name).encode('utf-8'))
+
+
+def get_index_fingerprint(index):
+
+    entry = _index_fingerprints.get(id(index))
+    if entry is not None and entry[0]() is index:
+        return entry[1]
+
+    if isinstance(index, pd.DatetimeIndex):
+        fingerprint = hashlib.sha1(index.asi8.data).digest()
+    else:
+        fingerprint = hashlib.sha1(pd.util.hash_pandas_object(index, index=False).to_numpy().data).digest()
+
+    key = id(index)
+    _index_fingerprints[key] = (weakref.ref(index, lambda ref: _index_fingerprints.pop(key, None)), fingerprint)
+    return fingerprint
+
+
+def get_indicator_path(key):
+    symbol, name, fingerprint = key[0], key[1], key[3]
+    directory = os.path.join(_cache_dir, str(symbol or 'universe').replace('/', '_'))
+    return os.path.join(directory, f"{name}-{get_hash(repr(key[:3]))}-{fingerprint}.pkl")
+
+
+def read_indicator(key):
+
+    path = get_indicator_path(key)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'rb') as f:
+            value = pickle.load(f)
+        # Versions are evicted least recently used first
+        os.utime(path)
+        return value
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        logger.warning(f"Ignoring unreadable indicator cache file {path} - {str(e)}")
+        return None
+
+
+def write_indicator(key, value):
+
+    path = get_indicator_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to a temporary file first, so readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+    remove_old_versions(path)
+
+
+def remove_old_versions(path):
+    """Remove all but the DISK_VERSIONS most recently used files of the indicator and parameters of path."""
+
+    directory, filename = os.path.split(path)
+    prefix = filename[:filename.rindex('-') + 1]
+
+    versions = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith('.pkl'):
+            try:
+                versions.append((os.path.getmtime(os.path.join(directory, name)), name))
+            except OSError:
+                # Removed by another process meanwhile
+                continue
+
+    for _, name in sorted(versions, reverse=True)[DISK_VERSIONS:]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            continue
+
+
+def get_nbytes(value):
+    if isinstance(value, tuple):
+        return sum(get_nbytes(item) for item in value)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=False).sum())
+    return value.to_numpy().nbytes
@@ -1,12 +1,23 @@
+import time
+
+# Start of the module imports, reported by --profile
+IMPORT_START = time.perf_counter()
+
+from datetime import datetime
+
 import pandas as pd
-from portfolio_manager import portfolio_manager, calculate_trade_metrics, calculate_ticker_gain
+from data_providers import configure_data_provider
+from indicator_cache import configure_indicator_cache
 from risk import get_stock_from_rm
-from utils.analysis import *
+from utils.analysis import get_stock_signals, get_recommendations
 from utils.argument_parsing import argument_parsing
-from utils.mail import send_html_email
-from utils.utils import get_hash, create_directories_if_not_exist
+from utils.logging_config import logger
+from utils.profiling import start_profiling, stop_profiling, print_profile_report, record_stage
+from utils.utils import get_hash, create_directories_if_not_exist, position_results_to_file
 from tabulate import tabulate
-from pandas.tseries.offsets import BusinessDay
+
+# Stages only some runs need (update, backtest, positions, email) import their modules when they run
+IMPORT_TIME = time.perf_counter() - IMPORT_START
 
 pd.options.mode.chained_assignment = None
 
@@ -14,12 +25,22 @@ pd.options.mode.chained_assignment = None
 def main():
 
     args = argument_parsing()
+    configure_data_provider(args.provider, data_dir=args.data_dir)
 
     config = args.config
     backtest = args.backtest
     setup = args.setup
     ticker_list = args.input
     limit = args.limit
+    workers = args.workers
+
+    configure_indicator_cache(args.indicator_cache_size * 1024 ** 2, args.indicator_cache_dir)
+
+    if args.profile:
+        start_profiling(cprofile=args.profile_cprofile, memory=args.profile_memory)
+        record_stage('imports', IMPORT_TIME)
+        if workers > 1 and args.engine == 'ticker' and not args.update:
+            logger.warning("Profiling covers the main process only, indicators computed by workers are not timed")
 
     # Create required dirs if not exist
     create_directories_if_not_exist("reports")
@@ -35,9 +56,19 @@ def main():
           f"--------------------------------------------------------\n")
 
     # Get recommended stocks according to set up file
-    signal_data = get_stock_signals(ticker_list, setup, limit,
-                                    start_date=args.start_date,
-                                    end_date=args.end_date)
+    if args.update:
+        from signal_state import update_stock_signals
+        signal_data = update_stock_signals(ticker_list, setup, limit,
+                                           start_date=args.start_date,
+                                           end_date=args.end_date,
+                                           compact=args.compact)
+    else:
+        signal_data = get_stock_signals(ticker_list, setup, limit,
+                                        start_date=args.start_date,
+                                        end_date=args.end_date,
+                                        workers=workers,
+                                        engine=args.engine,
+                                        compact=args.compact)
 
     # Add Risk Management
     signal_data_filtered = get_stock_from_rm(signal_data, setup)
@@ -45,11 +76,18 @@ def main():
     # ----------- Backtest ------------ #
 
     if backtest:
+        from portfolio_manager import portfolio_manager, calculate_trade_metrics, calculate_ticker_gain
+        from utils.analysis import get_backtest_equity_curve
 
         # Add Signal Data to Position Manager
         trades = portfolio_manager(signal_data_filtered, setup)
         benchmark_index = calculate_ticker_gain('^SPX', args.start_date, args.end_date)
-        metrics = calculate_trade_metrics(trades, benchmark_index, setup)
+
+        # Daily mark-to-market equity of the trades
+        equity_curve = get_backtest_equity_curve(trades, ticker_list, setup, args.start_date, args.end_date)
+        equity_curve.to_csv(f"reports/{report_hash}-equity.csv")
+
+        metrics = calculate_trade_metrics(trades, benchmark_index, setup, equity_curve=equity_curve)
 
         # Prepare data for tabulate
         headers = list(metrics.keys())
@@ -61,31 +99,35 @@ def main():
     # ------------ Recommendations ---------- #
 
     # Provide recommended signals of last n days
-    recommendation_period = setup["Recommendation"]["Period"]
-    recommendation_keys = ['Symbol','Date', 'Close', 'Action']
-    current_date = pd.Timestamp.now()
-    start_date = current_date - BusinessDay(recommendation_period)
-    stock_recommended_df = pd.DataFrame(columns=recommendation_keys)
-    for ticker in signal_data_filtered.keys():
-        df = signal_data_filtered[ticker]
-        df = df[df.index >= start_date]
-        if not df.empty:
-            df.reset_index(inplace=True)
-            df['Symbol'] = ticker
-            df = df[recommendation_keys]
-            stock_recommended_df = pd.concat([stock_recommended_df, df])
-
-    # Sort Data
-    stock_recommended_df.sort_values(by=['Symbol', 'Date'])
+    stock_recommended_df = get_recommendations(signal_data_filtered, setup)
 
     tabulated_data = tabulate(stock_recommended_df, headers='keys', tablefmt='psql', showindex=False)
     print(tabulated_data)
 
+    # ------------ Positions ---------- #
+
+    # Stops, warnings and gains of the lots held in the position file
+    if args.position:
+        from utils.analysis import get_position_stops
+        positions = get_position_stops(args.position, setup, end_date=args.end_date)
+        position_results_to_file(positions, setup, report_hash)
+        print(tabulate(positions, headers='keys', tablefmt='psql', showindex=False))
+
     if args.email and not backtest: # If backtest do not send mail
+        from utils.mail import send_html_email
         tabulated_data_html = tabulate(stock_recommended_df, headers='keys', tablefmt='html', showindex=False)
+        if args.position:
+            tabulated_data_html += "<h3>Position Results</h3>" + tabulate(positions, headers='keys', tablefmt='html',
+                                                                          showindex=False)
         send_html_email(receiver_email=args.email, subject="Daily Stock Recommendation",
                         html_content=tabulated_data_html, config=config)
 
+    # ------------ Profiling ---------- #
+
+    if args.profile:
+        profile_report = stop_profiling(f"reports/{report_hash}-profile.json")
+        print_profile_report(profile_report)
+
 
 if __name__ == "__main__":
     main()
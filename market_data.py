@@ -0,0 +1,72 @@
+import pandas as pd
+
+from data_aquisition import fetch_yahoo_stock_data, get_store_range
+from utils.profiling import profiled
+
+# Frames served during the run, keyed by request, so every consumer of the same request shares one object
+_requests = {}
+
+# Per symbol range held in memory and its frame, None for a symbol the store has no data for
+_symbols = {}
+
+
+@profiled
+def get_market_data(stock_list, start_date, end_date):
+    """Market data of the given tickers, fetched at most once per run.
+
+    The first request of a symbol goes through fetch_yahoo_stock_data, so only what the ticker_data
+    store lacks is downloaded. Later requests within the range already held are sliced from memory,
+    and a repeated request returns the very same frame, which callers must not modify in place.
+
+    Returns:
+        pandas.DataFrame: Frame in the ``yf.download(group_by='ticker')`` layout, as
+        fetch_yahoo_stock_data returns it.
+    """
+
+    start, end = get_store_range(start_date, end_date)
+    symbols = tuple(dict.fromkeys(stock_list))
+
+    key = (symbols, start, end)
+    if key in _requests:
+        return _requests[key]
+
+    missing = [symbol for symbol in symbols if not is_held(symbol, start, end)]
+    if missing:
+        # Widen to the range already held, so a symbol keeps a single contiguous frame
+        fetch_start = min([start] + [_symbols[symbol][0] for symbol in missing if symbol in _symbols])
+        fetch_end = max([end] + [_symbols[symbol][1] for symbol in missing if symbol in _symbols])
+        data = fetch_yahoo_stock_data(missing, start_date=fetch_start, end_date=fetch_end)
+        tickers = set(data.columns.get_level_values(0))
+        for symbol in missing:
+            _symbols[symbol] = (fetch_start, fetch_end, data[symbol].dropna(how='all') if symbol in tickers else None)
+
+    frames = {}
+    for symbol in symbols:
+        frame = _symbols[symbol][2]
+        if frame is not None:
+            frames[symbol] = frame[(frame.index >= start) & (frame.index < end)]
+
+    if not frames:
+        raise ValueError(f"Failed to fetch yahoo data!")
+
+    stock_data = pd.concat(frames, axis=1).sort_index()
+    stock_data.columns.names = ['Ticker', 'Price']
+    stock_data.index.name = 'Date'
+
+    _requests[key] = stock_data
+    return stock_data
+
+
+def get_close(ticker, start_date, end_date):
+    """Close prices of a single ticker, from get_market_data."""
+    return get_market_data([ticker], start_date, end_date)[ticker]['Close'].dropna()
+
+
+def is_held(symbol, start, end):
+    return symbol in _symbols and _symbols[symbol][0] <= start and end <= _symbols[symbol][1]
+
+
+def clear_market_data():
+    """Forget the frames of the run, so the next requests read the store again."""
+    _requests.clear()
+    _symbols.clear()
@@ -1,8 +1,11 @@
 import pandas as pd
 import numpy as np
 from constants import *
+from indicator_cache import memoize_indicator
+from utils.profiling import profiled
 
 
+@profiled
 def add_rsi(stock_data, setup, backtest=False):
 
     if not setup['Analysis']['Momentum']['rsi']['enabled']:
@@ -11,33 +14,94 @@ def add_rsi(stock_data, setup, backtest=False):
     # Get period from setup
     period = setup['Analysis']['Momentum']['rsi']['period']
 
+    stock_data['RSI'] = calculate_rsi(stock_data['Close'], period)
+
+    rsi_add_cross_signal(stock_data, setup)
+
+    # Detect touches
+    crossings = stock_data[stock_data[f"rsi_Cross"] != HOLD]
+    crossings = crossings.reset_index()  # Reset index to access the Date column
+
+    return crossings
+
+
+@memoize_indicator
+def calculate_rsi(close, period, gain_seed=None, loss_seed=None):
+    """
+    Relative Strength Index with Wilder smoothing of average gains and losses.
+
+    :param close: Series, or DataFrame of days x symbols to compute every symbol at once
+    :param period: RSI period
+    :param gain_seed, loss_seed: Optional average gain and loss at the first row, see calculate_rsi_averages
+    :return: RSI with the shape of close
+    """
+
+    avg_gain, avg_loss = calculate_rsi_averages(close, period, gain_seed, loss_seed)
+
+    # Calculate RS and RSI
+    rs = avg_gain / avg_loss
+    return 100 - (100 / (1 + rs))
+
+
+@memoize_indicator
+def calculate_rsi_averages(close, period, gain_seed=None, loss_seed=None):
+    """
+    Wilder averages of the gains and losses of the close, the state the RSI recursion carries.
+
+    :param close: Series, or DataFrame of days x symbols
+    :param period: RSI period
+    :param gain_seed, loss_seed: Optional averages at the first row, carried over from an earlier
+        computation to continue the recursion over new rows only
+    :return: tuple of (average gain, average loss) with the shape of close
+    """
+
     # Calculate daily changes
-    delta = stock_data['Close'].diff()
+    delta = close.diff()
 
     # Separate gains and losses
     gain = delta.where(delta > 0, 0)
     loss = -delta.where(delta < 0, 0)
 
-    # Initialize smoothed averages
-    avg_gain = gain.rolling(window=period, min_periods=1).mean()  # Initial SMA for the first calculation
-    avg_loss = loss.rolling(window=period, min_periods=1).mean()
+    # Smooth averages with Wilder's method
+    return wilder_smoothing(gain, period, gain_seed), wilder_smoothing(loss, period, loss_seed)
 
-    # Use SMA for smoothing
-    for i in range(period, len(gain)):
-        avg_gain.iloc[i] = ((avg_gain.iloc[i - 1] * (period - 1)) + gain.iloc[i]) / period
-        avg_loss.iloc[i] = ((avg_loss.iloc[i - 1] * (period - 1)) + loss.iloc[i]) / period
 
-    # Calculate RS and RSI
-    rs = avg_gain / avg_loss
-    stock_data['RSI'] = 100 - (100 / (1 + rs))
+def wilder_smoothing(data, period, seed=None):
+    """
+    Wilder smoothing of a Series or a (days x symbols) DataFrame.
+
+    The first `period` values are the expanding mean of the data; from there on
+    avg[i] = (avg[i - 1] * (period - 1) + data[i]) / period. The recursion is an exponential
+    mean of factor 1 / period, so it runs through pandas' ewm seeded with avg[period - 1] instead
+    of a Python loop.
+
+    :param data: Series or DataFrame without NaN values
+    :param period: Smoothing period
+    :param seed: Optional average at the first row, one value per column for DataFrames. The
+        recursion then goes on from it at the second row, as it does over the full history
+    :return: Smoothed data with the same shape and index
+    """
 
-    rsi_add_cross_signal(stock_data, setup)
+    if seed is not None:
+        smoothed = data.astype(float)
+        values = smoothed.to_numpy(copy=True)
+        values[0] = np.asarray(seed, dtype=float)
+        first = 1
+    else:
+        # Initial SMA for the first calculation
+        smoothed = data.rolling(window=period, min_periods=1).mean()
+        values = smoothed.to_numpy(dtype=float, copy=True)
+        first = period
 
-    # Detect touches
-    crossings = stock_data[stock_data[f"rsi_Cross"] != HOLD]
-    crossings = crossings.reset_index()  # Reset index to access the Date column
+    if len(data) > first:
+        # An exponential mean of factor 1 / period started at avg[first - 1] is the same recursion
+        tail = pd.DataFrame(data.to_numpy(dtype=float)[first - 1:].reshape(len(data) - first + 1, -1))
+        tail.iloc[0] = values[first - 1]
+        tail = tail.ewm(alpha=1 / period, adjust=False).mean().to_numpy()[1:]
+        values[first:] = tail.reshape(values[first:].shape)
+    smoothed.iloc[:] = values
 
-    return crossings
+    return smoothed
 
 
 def rsi_add_cross_signal(stock_data, setup):
@@ -52,15 +116,30 @@ def rsi_add_cross_signal(stock_data, setup):
         :return: DataFrame with added 'cross' column
     """
 
-    conditions = [
-        stock_data['RSI'] < setup['Analysis']['Momentum']['rsi']['lower'],
-        stock_data['RSI'] > setup['Analysis']['Momentum']['rsi']['upper']
-    ]
+    stock_data['rsi_Cross'] = calculate_rsi_signal(stock_data['RSI'], setup['Analysis']['Momentum']['rsi']['lower'],
+                                                   setup['Analysis']['Momentum']['rsi']['upper'])
+
+
+@memoize_indicator
+def calculate_rsi_signal(rsi, lower, upper):
+    """
+        BUY when RSI is below `lower`, SELL when it is above `upper`, HOLD otherwise.
+
+        :param rsi: Series, or DataFrame of days x symbols
+        :return: Signal with the shape of rsi
+    """
+
+    conditions = [rsi < lower, rsi > upper]
     choices = [BUY, SELL]
 
-    stock_data['rsi_Cross'] = np.select(conditions, choices, default=HOLD)
+    signal = np.select(conditions, choices, default=HOLD)
+
+    if isinstance(rsi, pd.DataFrame):
+        return pd.DataFrame(signal, index=rsi.index, columns=rsi.columns)
+    return pd.Series(signal, index=rsi.index)
 
 
+@profiled
 def add_adx(df, setup):
     """
     Calculate ADX, +DI, and DI- for the given DataFrame.
@@ -78,34 +157,43 @@ def add_adx(df, setup):
 
     period = setup['Filters']['Momentum']['adx']['period']
 
+    df['ADX'] = calculate_adx(df['High'], df['Low'], df['Close'], period)
+
+
+@memoize_indicator
+def calculate_adx(high, low, close, period):
+    """
+    Average Directional Index.
+
+    Args:
+        high, low, close: Series, or DataFrames of days x symbols to compute every symbol at once.
+        period (int): Period for ADX calculation.
+
+    Returns:
+        Series or DataFrame: ADX with the shape of close.
+    """
+
     # Calculate True Range (TR)
-    df['High-Low'] = df['High'] - df['Low']
-    df['High-Close'] = abs(df['High'] - df['Close'].shift(1))
-    df['Low-Close'] = abs(df['Low'] - df['Close'].shift(1))
-    df['TR'] = df[['High-Low', 'High-Close', 'Low-Close']].max(axis=1)
+    prev_close = close.shift(1)
+    true_range = np.fmax(np.fmax(high - low, abs(high - prev_close)), abs(low - prev_close))
 
     # Calculate +DM and -DM
-    df['+DM'] = np.where((df['High'] - df['High'].shift(1)) > (df['Low'].shift(1) - df['Low']),
-                         np.maximum(df['High'] - df['High'].shift(1), 0), 0)
-    df['-DM'] = np.where((df['Low'].shift(1) - df['Low']) > (df['High'] - df['High'].shift(1)),
-                         np.maximum(df['Low'].shift(1) - df['Low'], 0), 0)
+    up_move = high - high.shift(1)
+    down_move = low.shift(1) - low
+    plus_dm = up_move.clip(lower=0).where(up_move > down_move, 0)
+    minus_dm = down_move.clip(lower=0).where(down_move > up_move, 0)
 
     # Smooth TR, +DM, -DM with Wilder's smoothing
-    df['TR_SMA'] = df['TR'].rolling(window=period).sum()
-    df['+DM_SMA'] = df['+DM'].rolling(window=period).sum()
-    df['-DM_SMA'] = df['-DM'].rolling(window=period).sum()
+    tr_sma = true_range.rolling(window=period).sum()
+    plus_dm_sma = plus_dm.rolling(window=period).sum()
+    minus_dm_sma = minus_dm.rolling(window=period).sum()
 
     # Calculate +DI and DI-
-    df['DI+'] = (df['+DM_SMA'] / df['TR_SMA']) * 100
-    df['DI-'] = (df['-DM_SMA'] / df['TR_SMA']) * 100
+    di_plus = (plus_dm_sma / tr_sma) * 100
+    di_minus = (minus_dm_sma / tr_sma) * 100
 
     # Calculate DX
-    df['DX'] = (abs(df['DI+'] - df['DI-']) / abs(df['DI+'] + df['DI-'])) * 100
+    dx = (abs(di_plus - di_minus) / abs(di_plus + di_minus)) * 100
 
     # Calculate ADX
-    df['ADX'] = df['DX'].rolling(window=period).mean()
-
-    # Clean up intermediate columns
-    df.drop(columns=['High-Low', 'High-Close', 'Low-Close', 'TR', '+DM', '-DM',
-                     'TR_SMA', '+DM_SMA', '-DM_SMA', 'DX', 'DI+', 'DI-'],
-            inplace=True)
+    return dx.rolling(window=period).mean()
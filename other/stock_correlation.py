@@ -1,18 +1,26 @@
 import argparse
-import yfinance as yf
+import sys
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-from scipy.stats import linregress
 from tabulate import tabulate
 import json
 import os
 import smtplib
 from email.mime.text import MIMEText
 
+# Modules of the repository root, for the shared ticker_data store
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_providers import configure_data_provider, download_symbol_data
+from market_data import get_market_data
+
 def download_data(symbol, start, end, interval='1d'):
     """
     Download historical data for a symbol, with caching.
+
+    Closes are not adjusted for splits and dividends, as the reference report has always used
+    them; --matrix takes the adjusted daily closes of the shared ticker_data store instead.
     """
     DATA_DIR = "yf_cache"
     os.makedirs(DATA_DIR, exist_ok=True)
@@ -31,13 +39,10 @@ def download_data(symbol, start, end, interval='1d'):
             print(f"Removed empty cache for {symbol}")
 
     print(f"Downloading data for {symbol}...")
-    data = yf.download(symbol, start=start, end=end, interval=interval, multi_level_index=False, progress=False,
-                       auto_adjust=False)
+    data = download_symbol_data(symbol, start, end, interval=interval, auto_adjust=False)
 
     if not data.empty:
         data = data.dropna()
-        if isinstance(data.columns, pd.MultiIndex):
-            data.columns = data.columns.droplevel(1)
         data.to_pickle(filepath)
         print(f"Saved data to {filepath}")
         return data
@@ -45,6 +50,58 @@ def download_data(symbol, start, end, interval='1d'):
         print(f"No data downloaded for {symbol}")
         return pd.DataFrame()
 
+def load_close_panel(symbols, start, end):
+    """
+    Days x symbols close prices from the shared ticker_data store, downloading only what it lacks.
+    """
+    data = get_market_data(symbols, start_date=pd.Timestamp(start), end_date=pd.Timestamp(end))
+    close = data.xs('Close', axis=1, level='Price')
+    return close[[sym for sym in dict.fromkeys(symbols) if sym in close.columns]]
+
+
+def calculate_correlation_matrices(returns, min_periods=2):
+    """
+    Correlation, beta and R-squared of every pair of symbols of a returns panel.
+
+    Each pair is measured over the days both symbols have a return, as DataFrame.corr does, so
+    the whole N x N set comes from four matrix products instead of one regression per pair.
+    beta.loc[sym, ref] is the slope of sym regressed on ref, as linregress(ref, sym) gives it.
+    Pairs sharing fewer than min_periods days are NaN.
+    """
+    values = returns.to_numpy(dtype=float)
+    observed = ~np.isnan(values)
+
+    # Centering does not change the moments and keeps the sums below from cancelling out
+    x = np.where(observed, values - np.nanmean(values, axis=0), 0.0)
+    m = observed.astype(float)
+
+    # [i, j] entries over the days shared by i and j
+    n = m.T @ m
+    sum_x = x.T @ m
+    sum_xx = (x * x).T @ m
+    sum_xy = x.T @ x
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sum_xy - sum_x * sum_x.T / n
+        var = sum_xx - sum_x * sum_x / n
+        corr = np.clip(cov / np.sqrt(var * var.T), -1.0, 1.0)
+        beta = cov / var.T
+
+    insufficient = n < max(min_periods, 2)
+    corr[insufficient] = np.nan
+    beta[insufficient] = np.nan
+    np.fill_diagonal(corr, np.where(np.diag(insufficient), np.nan, 1.0))
+
+    frame = lambda matrix: pd.DataFrame(matrix, index=returns.columns, columns=returns.columns)
+    return frame(corr), frame(beta), frame(corr ** 2)
+
+
+def get_top_peers(corr, symbol, k):
+    """The k most and the k least correlated symbols to symbol, from the correlation matrix."""
+    peers = corr[symbol].drop(symbol).dropna()
+    return peers.nlargest(k), peers.nsmallest(k)
+
+
 def send_email(smtp_server, smtp_port, from_email, to_email, password, table_str):
     subject = 'Stock Comparison Results'
     body = f'<html><body><pre style="font-family: monospace; white-space: pre-wrap;">Comparison Metrics:\n\n{table_str}</pre></body></html>'
@@ -77,7 +134,24 @@ def main():
     parser.add_argument('--email-to', type=str, help='Recipient email address')
     parser.add_argument('--settings-file', type=str, help='Path to JSON settings file for email configuration')
     parser.add_argument('--min-relative-gain', type=float, help='Minimum relative gain (%) to include in results')
+    parser.add_argument('--matrix', action='store_true',
+                        help='Correlation, beta and R-squared of every pair of symbols, from the ticker_data store')
+    parser.add_argument('--peers', nargs='+', help='Symbols to list the top correlated peers of with --matrix '
+                                                   '(default: the first symbol)')
+    parser.add_argument('--top-k', type=int, default=5, help='Most and least correlated peers listed per symbol '
+                                                             '(default: 5)')
+    parser.add_argument('--min-periods', type=int, default=20, help='Minimum days a pair must share with --matrix '
+                                                                    '(default: 20)')
+    parser.add_argument('--output-dir', type=str, help='Directory to save the correlation, beta and R-squared '
+                                                       'matrices to as CSV with --matrix')
+    parser.add_argument('--provider', choices=['yfinance', 'local', 'synthetic'], default='yfinance',
+                        help='Source of the prices: Yahoo, the files of --data-dir or synthetic (default: yfinance)')
+    parser.add_argument('--data-dir', type=str, help='Directory of per-symbol Parquet/CSV files for --provider local')
     args = parser.parse_args()
+    if args.provider == 'local' and args.data_dir is None:
+        parser.error('--provider local requires --data-dir')
+
+    configure_data_provider(args.provider, data_dir=args.data_dir)
 
     if args.symbols:
         symbols = args.symbols
@@ -114,6 +188,12 @@ def main():
     print(f"Interval: {args.interval}")
     print()
 
+    if args.matrix:
+        table_str = correlation_matrix_report(args, symbols, stock_data if use_json else None, start_date, end_date)
+        if table_str is not None and args.send_email:
+            email_results(args, table_str)
+        return
+
     # Download close prices for all symbols
     price_series = {}
     for sym in symbols:
@@ -145,25 +225,17 @@ def main():
     # Compute daily returns
     returns = prices.pct_change().dropna()
 
-    # Reference returns
-    ref_ret = returns[reference]
-
     # Reference gains and vol
     gain_ref = (prices[reference].iloc[-1] / prices[reference].iloc[0] - 1) * 100
     vol_ref = returns[reference].std() * np.sqrt(252) * 100  # Annualized volatility
 
+    # Correlation, beta and R-squared against the reference, in one batch
+    corr, beta, r2 = calculate_correlation_matrices(returns[[reference] + others])
+
     results = []
     for sym in others:
         stock_ret = returns[sym]
 
-        # Correlation
-        corr = stock_ret.corr(ref_ret)
-
-        # Linear regression for beta and R-squared
-        slope, intercept, r_value, p_value, std_err = linregress(ref_ret, stock_ret)
-        beta = slope
-        r2 = r_value ** 2
-
         # Gains
         gain_stock = (prices[sym].iloc[-1] / prices[sym].iloc[0] - 1) * 100
         relative_gain = gain_stock - gain_ref
@@ -173,9 +245,9 @@ def main():
 
         row = {
             'Symbol': sym,
-            'Correlation': corr,
-            'Beta': beta,
-            'R-squared': r2,
+            'Correlation': corr.at[sym, reference],
+            'Beta': beta.at[sym, reference],
+            'R-squared': r2.at[sym, reference],
             'Relative Gain (%)': relative_gain,
             'Annualized Vol (%)': vol_stock
         }
@@ -198,20 +270,81 @@ def main():
 
         # Send email if requested
         if args.send_email:
-            if not args.email_to:
-                raise ValueError("--email-to is required when --send-email is used.")
-            if not args.settings_file:
-                raise ValueError("--settings-file is required when --send-email is used.")
-            with open(args.settings_file, 'r') as f:
-                settings = json.load(f)
-            email_settings = settings['Email']
-            from_email = email_settings['from_email']
-            from_password = email_settings['from_password']
-            smtp_server = email_settings['smtp_server']
-            smtp_port = email_settings['smtp_port']
-            send_email(smtp_server, smtp_port, from_email, args.email_to, from_password, table_str)
+            email_results(args, table_str)
     else:
         print("No results meet the minimum relative gain threshold.")
 
+
+def correlation_matrix_report(args, symbols, stock_data, start_date, end_date):
+    """
+    Compute the N x N matrices of the symbols and print the top correlated peers of args.peers.
+
+    Returns the printed table, or None when there is nothing to report.
+    """
+    if args.interval != '1d':
+        raise ValueError("--matrix works on the daily bars of the ticker_data store only.")
+
+    prices = load_close_panel(symbols, start_date, end_date)
+    returns = prices.pct_change(fill_method=None).dropna(how='all')
+    if len(returns) < 2:
+        raise ValueError("Insufficient data points for analysis.")
+
+    corr, beta, r2 = calculate_correlation_matrices(returns, args.min_periods)
+    print(f"Correlation matrix of {len(corr)} symbols over {len(returns)} days")
+    print()
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for name, matrix in [('correlation', corr), ('beta', beta), ('r_squared', r2)]:
+            matrix.to_csv(os.path.join(args.output_dir, f"{name}.csv"))
+        print(f"Saved matrices to {args.output_dir}")
+
+    info = {item['Symbol']: item for item in stock_data} if stock_data is not None else {}
+
+    results = []
+    for sym in args.peers or symbols[:1]:
+        if sym not in corr.columns:
+            print(f"No data available for {sym}")
+            continue
+        most, least = get_top_peers(corr, sym, args.top_k)
+        for rank, peers in [('Most', most), ('Least', least)]:
+            for peer, peer_corr in peers.items():
+                row = {
+                    'Symbol': sym,
+                    'Rank': rank,
+                    'Peer': peer,
+                    'Correlation': peer_corr,
+                    'Beta': beta.at[peer, sym],
+                    'R-squared': r2.at[peer, sym]
+                }
+                if peer in info:
+                    row['Security'] = info[peer]['Security']
+                    row['GICS Sector'] = info[peer]['GICS Sector']
+                results.append(row)
+
+    if not results:
+        print("No correlated peers found.")
+        return None
+
+    print("Top Correlated Peers:")
+    table_str = tabulate(pd.DataFrame(results).round(4), headers='keys', tablefmt='psql', showindex=False)
+    print(table_str)
+    return table_str
+
+
+def email_results(args, table_str):
+    if not args.email_to:
+        raise ValueError("--email-to is required when --send-email is used.")
+    if not args.settings_file:
+        raise ValueError("--settings-file is required when --send-email is used.")
+    with open(args.settings_file, 'r') as f:
+        settings = json.load(f)
+    email_settings = settings['Email']
+    from_email = email_settings['from_email']
+    from_password = email_settings['from_password']
+    smtp_server = email_settings['smtp_server']
+    smtp_port = email_settings['smtp_port']
+    send_email(smtp_server, smtp_port, from_email, args.email_to, from_password, table_str)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,17 +1,33 @@
-import yfinance as yf
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import random
 import argparse
+import sys
 from tabulate import tabulate
 import os
 
+# Modules of the repository root, for the shared ticker_data store
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_providers import configure_data_provider, download_symbol_data
+from market_data import get_market_data
+from utils.argument_parsing import add_provider_arguments, check_provider_arguments
+
 
 def download_data(symbol, start, end, interval='1d'):
     """
     Download historical data for a symbol, with caching.
+
+    Daily bars come from the run's market data over the shared ticker_data store; other
+    intervals are downloaded from the data provider and cached in yf_cache.
     """
+    if interval == '1d':
+        try:
+            return get_market_data([symbol], start, end)[symbol].dropna()
+        except ValueError:
+            return pd.DataFrame()
+
     DATA_DIR = "yf_cache"
     os.makedirs(DATA_DIR, exist_ok=True)
 
@@ -24,10 +40,8 @@ def download_data(symbol, start, end, interval='1d'):
         return data
 
     print(f"Downloading data for {symbol}...")
-    data = yf.download(symbol, start=start, end=end, interval=interval)
+    data = download_symbol_data(symbol, start, end, interval=interval)
     data = data.dropna()
-    if isinstance(data.columns, pd.MultiIndex):
-        data.columns = data.columns.droplevel(1)
     data.to_pickle(filepath)
     print(f"Saved data to {filepath}")
     return data
@@ -37,45 +51,75 @@ def run_simulation(symbol, data, buy_indices, max_bars, tp_pct, sl_pct):
     """
     Run simulations for a single strategy on a symbol.
     """
-    gains = []
-    sl_count = 0
-    tp_count = 0
-    expired_count = 0
+    gains, sl_counts, tp_counts, expired_counts = run_simulations(data, buy_indices, max_bars, [tp_pct], [sl_pct])
+
+    return gains[0].tolist(), int(sl_counts[0]), int(tp_counts[0]), int(expired_counts[0])
+
+
+def run_simulations(data, buy_indices, max_bars, tp_pcts, sl_pcts):
+    """
+    Run the simulations of every (take profit, stop loss) pair over the same buy dates.
+
+    Each buy is closed on the first of the next max_bars bars reaching the take profit (checked
+    first) or the stop loss, or on the close of its last bar. The highs and lows after each buy
+    are gathered once into (buys x max_bars) windows; their running maximum and minimum are
+    monotonic, so the bar of the first hit is the number of bars before the running extreme
+    crosses the threshold, counted for all pairs at once.
+
+    Returns:
+        tuple: gains (pairs x buys) and the stop loss, take profit and expired counts of each pair.
+    """
+    buy_prices, highs, lows, expiry_prices = get_price_windows(data, buy_indices, max_bars)
+
+    running_high = np.maximum.accumulate(highs, axis=1)
+    running_low = np.minimum.accumulate(lows, axis=1)
+
+    tp_pcts = np.asarray(tp_pcts, dtype=float)
+    sl_pcts = np.asarray(sl_pcts, dtype=float)
+    tp_prices = buy_prices[np.newaxis, :] * (1 + tp_pcts[:, np.newaxis] / 100)
+    stop_prices = buy_prices[np.newaxis, :] * (1 - sl_pcts[:, np.newaxis] / 100)
+
+    # Bar of the first hit of each pair and buy, max_bars when never hit; pairs go in blocks to bound memory
+    tp_bars = np.empty(tp_prices.shape, dtype=int)
+    sl_bars = np.empty(stop_prices.shape, dtype=int)
+    block = max(1, 2 ** 23 // max(highs.size, 1))
+    for first in range(0, len(tp_pcts), block):
+        pairs = slice(first, first + block)
+        tp_bars[pairs] = (running_high[np.newaxis] < tp_prices[pairs, :, np.newaxis]).sum(axis=2)
+        sl_bars[pairs] = (running_low[np.newaxis] > stop_prices[pairs, :, np.newaxis]).sum(axis=2)
+
+    take_profit = (tp_bars < max_bars) & (tp_bars <= sl_bars)
+    stop_loss = (sl_bars < max_bars) & ~take_profit
+    expired = ~take_profit & ~stop_loss
+
+    gains = np.where(take_profit, tp_pcts[:, np.newaxis],
+                     np.where(stop_loss, (stop_prices - buy_prices) / buy_prices * 100,
+                              (expiry_prices - buy_prices) / buy_prices * 100))
+
+    return gains, stop_loss.sum(axis=1), take_profit.sum(axis=1), expired.sum(axis=1)
+
+
+def get_price_windows(data, buy_indices, max_bars):
+    """
+    Buy prices, (buys x max_bars) windows of the highs and lows of the bars following each buy,
+    and the close each buy expires at. Bars past the end of the data never hit a threshold.
+    """
+    close = data['Close'].to_numpy(dtype=float)
+    high = data['High'].to_numpy(dtype=float)
+    low = data['Low'].to_numpy(dtype=float)
     total_len = len(data)
 
-    for buy_idx in buy_indices:
-        buy_price = data['Close'].iloc[buy_idx]
-        stop_price = buy_price * (1 - sl_pct / 100)
-        tp_price = buy_price * (1 + tp_pct / 100)
-
-        closed = False
-        for i in range(1, max_bars + 1):
-            sim_idx = buy_idx + i
-            if sim_idx >= total_len:
-                break
-            high = data['High'].iloc[sim_idx]
-            low = data['Low'].iloc[sim_idx]
-
-            if high >= tp_price:
-                gain = tp_pct
-                closed = True
-                tp_count += 1
-                break
-            if low <= stop_price:
-                gain = (stop_price - buy_price) / buy_price * 100
-                closed = True
-                sl_count += 1
-                break
-
-        if not closed:
-            close_idx = min(buy_idx + max_bars, total_len - 1)
-            close_price = data['Close'].iloc[close_idx]
-            gain = (close_price - buy_price) / buy_price * 100
-            expired_count += 1
-
-        gains.append(gain)
-
-    return gains, sl_count, tp_count, expired_count
+    buy_indices = np.asarray(buy_indices, dtype=int)
+    bars = buy_indices[:, np.newaxis] + np.arange(1, max_bars + 1)
+    inside = bars < total_len
+    bars = np.minimum(bars, total_len - 1)
+
+    highs = np.where(inside, high[bars], -np.inf)
+    lows = np.where(inside, low[bars], np.inf)
+    highs[np.isnan(highs)] = -np.inf
+    lows[np.isnan(lows)] = np.inf
+
+    return close[buy_indices], highs, lows, close[np.minimum(buy_indices + max_bars, total_len - 1)]
 
 
 def main():
@@ -95,8 +139,12 @@ def main():
     parser.add_argument('--slope_threshold', type=float, default=0.0, help='Minimum EMA slope threshold (default: 0.0)')
     parser.add_argument('--export_csv', action='store_true', default=False,
                         help='Export results to CSV (default: False)')
+    add_provider_arguments(parser)
 
     args = parser.parse_args()
+    check_provider_arguments(parser, args)
+
+    configure_data_provider(args.provider, data_dir=args.data_dir)
 
     if args.start is None:
         end_date = datetime.now()
@@ -107,6 +155,13 @@ def main():
 
     results = []
 
+    # Daily bars of every symbol in one request, then served from memory to download_data
+    if args.interval == '1d':
+        try:
+            get_market_data(args.symbols, args.start, args.end)
+        except ValueError:
+            pass
+
     for symbol in args.symbols:
         data = download_data(symbol, args.start, args.end, args.interval)
 
@@ -125,8 +180,8 @@ def main():
 
         # Possible buy indices: enough history for EMA and slope, slope > threshold, enough room after
         min_start_idx = args.slope_period
-        possible_buy_indices = [i for i in range(min_start_idx, total_len - args.max_bars)
-                                if data['EMA_slope'].iloc[i] > args.slope_threshold]
+        candidates = np.arange(min_start_idx, total_len - args.max_bars)
+        possible_buy_indices = candidates[data['EMA_slope'].to_numpy()[candidates] > args.slope_threshold].tolist()
 
         num_possible = len(possible_buy_indices)
         if num_possible == 0:
@@ -138,29 +193,32 @@ def main():
 
         print(f"Running simulations for {symbol} with {actual_n} filtered buy dates...")
 
-        for rr in args.risk_reward_ratios:
-            for sl_pct in args.stop_losses:
-                tp_pct = sl_pct * rr
-                gains, sl_count, tp_count, expired_count = run_simulation(symbol, data, buy_indices, args.max_bars,
-                                                                          tp_pct, sl_pct)
-                avg_gain = np.mean(gains)
-                std_gain = np.std(gains)
-                win_rate = (tp_count / (sl_count + tp_count) * 100) if (sl_count + tp_count) > 0 else 0
-                margin_pct = round((win_rate / 100 - 1 / rr) * 100, 2)
-                results.append({
-                    'Symbol': symbol,
-                    'SL %': round(sl_pct, 2),
-                    'TP %': round(tp_pct, 2),
-                    'RR': f"{rr}:1",
-                    'Avg Gain %': round(avg_gain, 2),
-                    'Std Dev %': round(std_gain, 2),
-                    'Num Sims': actual_n,
-                    'Num SL': sl_count,
-                    'Num TP': tp_count,
-                    'Num Expired': expired_count,
-                    'Win Rate %': round(win_rate, 2),
-                    'Margin %': margin_pct
-                })
+        # Every ratio and stop loss pair runs against the same price windows
+        pairs = [(rr, sl_pct, sl_pct * rr) for rr in args.risk_reward_ratios for sl_pct in args.stop_losses]
+        all_gains, sl_counts, tp_counts, expired_counts = run_simulations(
+            data, buy_indices, args.max_bars, [tp_pct for _, _, tp_pct in pairs], [sl_pct for _, sl_pct, _ in pairs])
+
+        for i, (rr, sl_pct, tp_pct) in enumerate(pairs):
+            gains = all_gains[i]
+            sl_count, tp_count, expired_count = int(sl_counts[i]), int(tp_counts[i]), int(expired_counts[i])
+            avg_gain = np.mean(gains)
+            std_gain = np.std(gains)
+            win_rate = (tp_count / (sl_count + tp_count) * 100) if (sl_count + tp_count) > 0 else 0
+            margin_pct = round((win_rate / 100 - 1 / rr) * 100, 2)
+            results.append({
+                'Symbol': symbol,
+                'SL %': round(sl_pct, 2),
+                'TP %': round(tp_pct, 2),
+                'RR': f"{rr}:1",
+                'Avg Gain %': round(avg_gain, 2),
+                'Std Dev %': round(std_gain, 2),
+                'Num Sims': actual_n,
+                'Num SL': sl_count,
+                'Num TP': tp_count,
+                'Num Expired': expired_count,
+                'Win Rate %': round(win_rate, 2),
+                'Margin %': margin_pct
+            })
 
     if results:
         df = pd.DataFrame(results)
@@ -0,0 +1,274 @@
+import numpy as np
+import pandas as pd
+
+from constants import *
+from momentum import calculate_rsi, calculate_rsi_signal, calculate_adx
+from risk import calculate_sharpe_ratio, calculate_sortino_ratio
+from trend import calculate_sma, calculate_ema, calculate_rolling_slope, calculate_crossing_signal, \
+    calculate_bollinger_signal, calculate_week_rule_signal, calculate_macd, calculate_on_balance_volume, \
+    calculate_stochastic_oscillator
+from utils.profiling import profiled
+
+
+class SignalPanel:
+    """Indicator and signal matrices (days x symbols) of a whole universe.
+
+    Columns keep the names and order the per-ticker pipeline gives them, so a ticker frame
+    materialized from the panel matches what get_ticker_signals produces for that ticker.
+    """
+
+    def __init__(self, columns, valid, errors):
+        self.columns = columns
+        self.valid = valid
+        self.errors = errors
+        self.symbols = list(valid.columns)
+        self.dates = valid.index
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self._arrays = None
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def get_frame(self, symbol, signals_only=True):
+        """Materialize the frame of a single symbol.
+
+        Args:
+            symbol (str): Ticker symbol.
+            signals_only (bool): Keep only the BUY and SELL rows, as get_ticker_signals does.
+
+        Returns:
+            pandas.DataFrame: Valid rows of the symbol with every indicator column.
+        """
+        if self._arrays is None:
+            self._arrays = {name: matrix.to_numpy() for name, matrix in self.columns.items()}
+
+        column = self.symbol_index[symbol]
+        rows = self.valid[symbol].to_numpy()
+        if signals_only:
+            rows = rows & (self._arrays['Action'][:, column] != HOLD)
+
+        return pd.DataFrame({name: values[rows, column] for name, values in self._arrays.items()},
+                            index=self.dates[rows])
+
+    def get_frames(self, signals_only=True):
+        """Frames of every symbol with at least one row, keyed by symbol."""
+        frames = {}
+        for symbol in self.symbols:
+            if symbol in self.errors:
+                continue
+            frame = self.get_frame(symbol, signals_only)
+            if not frame.empty:
+                frames[symbol] = frame
+        return frames
+
+
+@profiled
+def get_price_matrices(price_panel, start_date=None, end_date=None):
+    """Days x symbols frame of each OHLCV field, built on views of the price panel."""
+
+    date_slice = price_panel.get_date_slice(start_date, end_date)
+    dates = price_panel.dates[date_slice]
+
+    return {field: pd.DataFrame(price_panel.values[:, date_slice, i].T, index=dates, columns=price_panel.symbols,
+                                copy=False)
+            for i, field in enumerate(price_panel.fields)}
+
+
+@profiled
+def compute_signal_panel(prices, risk_free, setup, start_date, cache=None, seeds=None):
+    """
+    Run the whole indicator pipeline of get_ticker_signals over every symbol at once.
+
+    Each indicator is a single call on (days x symbols) matrices, so the pandas overhead is paid
+    once per indicator instead of once per indicator and ticker.
+
+    Args:
+        prices (dict): Days x symbols DataFrame for each of 'Open', 'High', 'Low', 'Close', 'Volume'.
+        risk_free (pandas.DataFrame): Risk-free rate with a 'Close' column (^IRX).
+        setup (dict): Setup file.
+        start_date (datetime): First date of the signals; earlier rows only warm up the indicators.
+        cache (dict): Optional indicator matrices keyed by indicator and parameters. Runs sharing the
+            same prices, risk-free rate and seeds can pass the same cache so each indicator is computed once.
+        seeds (dict): Optional values of the recursive indicators at the first row, keyed by
+            ('ema', span), ('rsi_gain', period), ('rsi_loss', period) and ('obv',), each a Series
+            over the columns of the prices. The EMAs, RSI and OBV then continue from them instead
+            of starting over, as signal_state does to advance the signals by the new bars only.
+
+    Returns:
+        SignalPanel: Indicator, score and action matrices.
+    """
+
+    def cached(key, compute):
+        if cache is None:
+            return compute()
+        if key not in cache:
+            cache[key] = compute()
+        return cache[key]
+
+    close = prices['Close']
+    high = prices['High']
+    low = prices['Low']
+
+    columns = {field: prices[field] for field in ['Open', 'High', 'Low', 'Close', 'Volume']}
+    errors = {}
+
+    columns['daily_return'] = cached(('daily_return',), lambda: close.pct_change(fill_method=None))
+
+    # Sharpe Ratio
+    lookback_period = setup['Risk']['SharpeRatio']['LoopbackPeriod']
+    trading_days = setup['Risk']['SharpeRatio']['TradingDays']
+    sharpe_ratio, valid = cached(('sharpe_ratio', lookback_period, trading_days),
+                                 lambda: calculate_sharpe_ratio(columns['daily_return'], risk_free, lookback_period,
+                                                                trading_days))
+    for symbol in valid.columns[~valid.any()]:
+        errors[symbol] = "No common index found after alignment. Check data consistency."
+    columns['sharpe_ratio'] = sharpe_ratio
+
+    # Sortino Ratio
+    lookback_period = setup['Risk']['SortinoRatio']['LoopbackPeriod']
+    trading_days = setup['Risk']['SortinoRatio']['TradingDays']
+    daily_rf = (1 + risk_free['Close']) ** (1 / trading_days) - 1
+    columns['sortino_ratio'] = cached(('sortino_ratio', lookback_period, trading_days),
+                                      lambda: calculate_sortino_ratio(columns['daily_return'], daily_rf,
+                                                                      lookback_period, trading_days))
+
+    # Moving average slopes
+    for ma, ma_setup in setup['Filters']['Trend'].items():
+        if not ma_setup['enabled']:
+            continue
+        if 'ma_cross' in ma:
+            periods = {f"{ma}_short": ma_setup['period_short'], f"{ma}_long": ma_setup['period_long']}
+        else:
+            periods = {ma: ma_setup['period']}
+        for moving_average_type, period in periods.items():
+            moving_average = cached(('sma', period), lambda: calculate_sma(close, period))
+            columns[f"MA_{moving_average_type}"] = moving_average
+            columns[f"MA_Slope_{moving_average_type}"] = cached(
+                ('ma_slope', period, ma_setup['slope_period']),
+                lambda: calculate_rolling_slope(moving_average, ma_setup['slope_period']))
+
+    # ADX
+    adx = setup['Filters']['Momentum']['adx']
+    if adx['enabled']:
+        columns['ADX'] = cached(('adx', adx['period']), lambda: calculate_adx(high, low, close, adx['period']))
+
+    # RSI
+    rsi = setup['Analysis']['Momentum']['rsi']
+    if rsi['enabled']:
+        columns['RSI'] = cached(('rsi', rsi['period']),
+                                lambda: calculate_rsi(close, rsi['period'], get_seed(seeds, 'rsi_gain', rsi['period']),
+                                                      get_seed(seeds, 'rsi_loss', rsi['period'])))
+        columns['rsi_Cross'] = cached(('rsi_Cross', rsi['period'], rsi['lower'], rsi['upper']),
+                                      lambda: calculate_rsi_signal(columns['RSI'], rsi['lower'], rsi['upper']))
+
+    # OBV
+    if setup['Analysis']['Volume']['OBV']['enabled']:
+        columns['OBV'] = cached(('obv',), lambda: calculate_on_balance_volume(close, prices['Volume'],
+                                                                                      get_seed(seeds, 'obv')))
+
+    trend = setup['Analysis']['Trend']
+
+    # Stochastic
+    stochastic = trend['stochastic']
+    if stochastic['enabled']:
+        columns['Stoch_%K'], columns['Stoch_%D'] = cached(
+            ('stochastic', stochastic['period'], stochastic['smooth_k'], stochastic['smooth_d']),
+            lambda: calculate_stochastic_oscillator(high, low, close, stochastic['period'], stochastic['smooth_k'],
+                                                    stochastic['smooth_d']))
+
+    # Long Term Crossing
+    long_term = trend['long_term']
+    if long_term['enabled']:
+        if long_term['avg_type'] == "SMA":
+            columns['LT_MA'] = cached(('sma', long_term['period']), lambda: calculate_sma(close, long_term['period']))
+        else:
+            columns['LT_MA'] = cached(('ema', long_term['period']),
+                                      lambda: calculate_ema(close, long_term['period'],
+                                                            get_seed(seeds, 'ema', long_term['period'])))
+        columns['long_term_Cross'] = cached(('long_term_Cross', long_term['avg_type'] == "SMA", long_term['period']),
+                                            lambda: calculate_crossing_signal(close, columns['LT_MA']))
+
+    # MA Crossing
+    ma_cross = trend['ma_cross']
+    if ma_cross['enabled']:
+        if ma_cross['avg_type'] == "sma":
+            columns['Cross_Short'] = cached(('sma', ma_cross['short']), lambda: calculate_sma(close, ma_cross['short']))
+            columns['Cross_Long'] = cached(('sma', ma_cross['long']), lambda: calculate_sma(close, ma_cross['long']))
+        elif ma_cross['avg_type'] == "ema":
+            columns['Cross_Short'] = cached(('ema', ma_cross['short']),
+                                            lambda: calculate_ema(close, ma_cross['short'],
+                                                                  get_seed(seeds, 'ema', ma_cross['short'])))
+            columns['Cross_Long'] = cached(('ema', ma_cross['long']),
+                                           lambda: calculate_ema(close, ma_cross['long'],
+                                                                 get_seed(seeds, 'ema', ma_cross['long'])))
+        columns['ma_cross_Cross'] = cached(
+            ('ma_cross_Cross', ma_cross['avg_type'], ma_cross['short'], ma_cross['long']),
+            lambda: calculate_crossing_signal(columns['Cross_Short'], columns['Cross_Long']))
+
+    # Bollinger Bands
+    bollinger_bands = trend['bollinger_bands']
+    if bollinger_bands['enabled']:
+        columns['StdDev'], columns['bollinger_bands_Cross'] = cached(
+            ('bollinger_bands', bollinger_bands['period'], bollinger_bands['std_dev']),
+            lambda: calculate_bollinger_signal(close, bollinger_bands['period'], bollinger_bands['std_dev']))
+
+    # Week Rule
+    if trend['week_rule']['enabled']:
+        columns['WR_Cross'] = cached(('week_rule', trend['week_rule']['period']),
+                                     lambda: calculate_week_rule_signal(close, high, low, trend['week_rule']['period']))
+
+    # MACD Crossing
+    macd = trend['macd']
+    if macd['enabled']:
+        key = ('macd', macd['short'], macd['long'], macd['signal_window'])
+        columns['MACD_short_long'], columns['MACD_SIGNAL'] = cached(
+            key, lambda: calculate_macd(close, macd['short'], macd['long'], macd['signal_window'],
+                                        get_seed(seeds, 'ema', macd['short']), get_seed(seeds, 'ema', macd['long'])))
+        columns['macd_Cross'] = cached(key + ('Cross',), lambda: calculate_crossing_signal(columns['MACD_short_long'],
+                                                                                             columns['MACD_SIGNAL']))
+
+    # Rows the per-ticker pipeline keeps after dropna and the start date cut
+    valid = pd.DataFrame(np.ones(close.shape, dtype=bool), index=close.index, columns=close.columns)
+    for matrix in columns.values():
+        valid &= matrix.notna()
+    valid &= (close.index >= start_date)[:, np.newaxis]
+
+    columns['Score'], columns['Action'] = calculate_score_action(columns, setup)
+
+    return SignalPanel(columns, valid, errors)
+
+
+def get_seed(seeds, *key):
+    """Seed of a recursive indicator, or None to start it over."""
+    return seeds.get(key) if seeds else None
+
+
+def calculate_score_action(columns, setup):
+    """Weighted score of the enabled method crossings and the action it implies, for every symbol.
+
+    Same weighting and thresholds as set_score_action, on matrices.
+    """
+
+    score = 0.0
+    total_score = 0.0
+
+    for analysis in setup['Analysis'].keys():
+        for method in setup['Analysis'][analysis].keys():
+            if setup['Analysis'][analysis][method]['enabled']:
+                if f'{method}_Cross' in columns:
+                    # Assign weights to results
+                    score = score + setup['Analysis'][analysis][method]['weight'] * columns[f"{method}_Cross"]
+                total_score += setup['Analysis'][analysis][method]['weight']
+
+    close = columns['Close']
+    score = (score + pd.DataFrame(0.0, index=close.index, columns=close.columns)) / total_score
+
+    buy_thold = setup['Thresholds']['Buy']
+    sell_thold = setup['Thresholds']['Sell']
+
+    action = np.where(score >= buy_thold, BUY, np.where(score <= sell_thold, SELL, HOLD))
+
+    return score, pd.DataFrame(action, index=score.index, columns=score.columns)
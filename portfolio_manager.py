@@ -1,17 +1,42 @@
+import numpy as np
 import pandas as pd
-import yfinance as yf
-from constants import BUY, SELL
-from data_aquisition import fetch_yahoo_stock_data
+from constants import BUY, SELL, HOLD
+from market_data import get_close
 from tabulate import tabulate
+from utils.profiling import profiled
 
 
+@profiled
 def portfolio_manager(signals_dict, setup):
     """
         Process raw trading signals for multiple tickers into executed trades, managing portfolio state.
 
         Parameters:
-        - signals_dict: Dict where keys are ticker symbols and values are DataFrames with
-                        columns ['date', 'signal', 'price'] (signal: 'buy', 'sell', 'hold')
+        - signals_dict: Dict where keys are ticker symbols and values are DataFrames indexed by 'Date'
+                        with columns ['Action', 'Close'] (Action: BUY, SELL or HOLD)
+        - setup: Setup file
+
+        Returns:
+        - trades_df: DataFrame with executed trades ['date', 'symbol', 'action', 'price', 'quantity', 'cash_remaining']
+        """
+    # Create a unified timeline of all signals as flat arrays
+    symbols = list(signals_dict.keys())
+    frames = [signals_dict[symbol] for symbol in symbols] or [pd.DataFrame(columns=['Action', 'Close'])]
+    dates = np.concatenate([df.index.values for df in frames]).astype('datetime64[ns]')
+    symbol_ids = np.concatenate([np.full(len(df), i) for i, df in enumerate(frames)])
+    actions = np.concatenate([df['Action'].to_numpy(dtype=int) for df in frames])
+    prices = np.concatenate([df['Close'].to_numpy(dtype=float) for df in frames])
+
+    return backtest_signals(symbols, dates, symbol_ids, actions, prices, setup)
+
+
+def backtest_signals(symbols, dates, symbol_ids, actions, prices, setup):
+    """
+        Execute flat signal arrays, grouped by symbol as portfolio_manager lays them out, into a trades table.
+
+        Parameters:
+        - symbols: Ticker symbols indexed by symbol_ids
+        - dates, symbol_ids, actions, prices: Arrays of the signals
         - setup: Setup file
 
         Returns:
@@ -20,81 +45,99 @@ def portfolio_manager(signals_dict, setup):
     # Initialize portfolio state
     initial_cash = setup['Portfolio']['cash']             # Starting cash balance (default $10,000)
     position_size = setup['Portfolio']['position_size']   # Fraction of cash to use per trade per ticker (default 10%)
-    holdings = {}  # Dict to track shares owned per ticker
-    trades = []  # List to store trade records
+
+    # Sort by date
+    order = np.argsort(dates, kind='quicksort')
+
+    trades = run_backtest(actions[order], symbol_ids[order], prices[order], initial_cash, position_size)
+
+    # Convert trades to DataFrame
+    rows = order[trades['row']]
+    trades_df = pd.DataFrame({
+        'date': dates[rows],
+        'symbol': np.array(list(symbols) + [None], dtype=object)[symbol_ids[rows]],
+        'action': np.where(actions[rows] == BUY, 'buy', 'sell'),
+        'price': prices[rows],
+        'quantity': trades['quantity'],
+        'cash_remaining': trades['cash_remaining']
+    })
+    return trades_df
+
+
+def run_backtest(actions, symbol_ids, prices, initial_cash, position_size):
+    """
+        Execute chronologically ordered signals against the cash and position size rules.
+
+        A BUY spends min(cash, initial_cash * position_size) on whole shares of a symbol not held yet;
+        a SELL closes the whole position of a held symbol. HOLD and unmatched signals do nothing.
+
+        Parameters:
+        - actions: int array of BUY, SELL or HOLD
+        - symbol_ids: int array of symbol indexes
+        - prices: float array of execution prices
+        - initial_cash: Starting cash balance
+        - position_size: Fraction of the initial cash to use per trade
+
+        Returns:
+        - dict: Arrays 'row' (index of the executed signals), 'quantity' and 'cash_remaining'
+        """
     cash = initial_cash
+    max_trade_value = initial_cash * position_size
+    holdings = {}  # Dict to track shares owned per symbol id
 
-    # Create a unified timeline of all signals
-    all_signals = []
-    for ticker, df in signals_dict.items():
-        df = df.copy()  # Avoid modifying input
-        df.reset_index(inplace=True)
-        df['Symbol'] = ticker  # Add ticker column
-        all_signals.append(df[['Date', 'Symbol', 'Action', 'Close']])
-
-    # Combine and sort by date
-    combined_signals = pd.concat(all_signals, ignore_index=True)
-    combined_signals = combined_signals.sort_values('Date').reset_index(drop=True)
-
-    # Iterate through each signal in chronological order
-    for index, row in combined_signals.iterrows():
-        date = row['Date']
-        symbol = row['Symbol']
-        signal = row['Action']
-        price = row['Close']
-
-        # Initialize holdings for this symbol if not present
-        if symbol not in holdings:
-            holdings[symbol] = 0
+    executed = []
+    quantities = []
+    cash_remaining = []
+
+    # Only BUY and SELL signals can change the portfolio
+    rows = np.flatnonzero(actions != HOLD)
+
+    for row, signal, symbol, price in zip(rows.tolist(), actions[rows].tolist(), symbol_ids[rows].tolist(),
+                                          prices[rows].tolist()):
+
+        held = holdings.get(symbol, 0)
 
         # Handle BUY signal
-        if signal == BUY and holdings[symbol] == 0:  # Only buy if not already holding
+        if signal == BUY and held == 0:  # Only buy if not already holding
             # Calculate how much to spend (fixed % of initial cash or remaining cash)
-            trade_value = min(cash, initial_cash * position_size)
+            trade_value = min(cash, max_trade_value)
             if trade_value >= price:  # Ensure enough cash for at least 1 share
                 quantity = trade_value // price  # Integer shares only
                 cost = quantity * price
                 if cash >= cost:  # Double-check cash sufficiency
                     cash -= cost
-                    holdings[symbol] += quantity
-                    trades.append({
-                        'date': date,
-                        'symbol': symbol,
-                        'action': 'buy',
-                        'price': price,
-                        'quantity': quantity,
-                        'cash_remaining': cash
-                    })
+                    holdings[symbol] = quantity
+                    executed.append(row)
+                    quantities.append(quantity)
+                    cash_remaining.append(cash)
 
         # Handle SELL signal
-        elif signal == SELL and holdings[symbol] > 0:  # Only sell if holding shares
-            quantity = holdings[symbol]  # Sell all shares for this symbol
-            proceeds = quantity * price
-            cash += proceeds
+        elif signal == SELL and held > 0:  # Only sell if holding shares
+            cash += held * price  # Sell all shares for this symbol
             holdings[symbol] = 0
-            trades.append({
-                'date': date,
-                'symbol': symbol,
-                'action': 'sell',
-                'price': price,
-                'quantity': quantity,
-                'cash_remaining': cash
-            })
-
-        # 'Hold' or invalid signals do nothing
-
-    # Convert trades list to DataFrame
-    trades_df = pd.DataFrame(trades)
-    return trades_df
+            executed.append(row)
+            quantities.append(held)
+            cash_remaining.append(cash)
+
+    return {
+        'row': np.array(executed, dtype=int),
+        'quantity': np.array(quantities, dtype=float),
+        'cash_remaining': np.array(cash_remaining, dtype=float)
+    }
 
 
-def calculate_trade_metrics(trades_df, benchmark, setup):
+@profiled
+def calculate_trade_metrics(trades_df, benchmark, setup, print_trades=True, equity_curve=None):
     """
     Calculate trading metrics, handling multiple trades per symbol chronologically.
 
     Parameters:
     - trades_df: DataFrame with ['date', 'symbol', 'action', 'price', 'quantity', 'cash_remaining']
-    - initial_cash: Starting cash balance (default $10,000)
+    - benchmark: Benchmark gain reported next to the metrics
+    - setup: Setup file
+    - print_trades: Print the trades table
+    - equity_curve: Optional daily equity of the trades, from calculate_equity_curve. The drawdown is then
+      the mark-to-market one, and its Sharpe, Sortino and exposure are reported too.
 
     Returns:
     - dict: Metrics including 'win_ratio', 'total_profit', 'total_return', 'avg_trade_profit', 'max_drawdown'
@@ -103,74 +146,27 @@ def calculate_trade_metrics(trades_df, benchmark, setup):
     initial_cash = setup['Portfolio']['cash']
     trade_fee = 1.0     # TODO: get this from setup
 
-    # Sort trades by date to ensure chronological order
-    trades_df = trades_df.sort_values('date').reset_index(drop=True)
-
-    # Track completed trades
-    completed_trades = []
-    open_positions = {}  # {symbol: {'price': float, 'quantity': float}}
-
-    # Process trades chronologically
-    for _, row in trades_df.iterrows():
-        symbol = row['symbol']
-        action = row['action']
-        price = row['price']
-        quantity = row['quantity']
-
-        if action == 'buy':
-            if symbol not in open_positions:
-                open_positions[symbol] = {'price': price, 'quantity': quantity}
-            else:
-                # Average price for multiple buys (optional, assuming full sells for now)
-                current = open_positions[symbol]
-                total_qty = current['quantity'] + quantity
-                avg_price = (current['price'] * current['quantity'] + price * quantity) / total_qty
-                open_positions[symbol] = {'price': avg_price, 'quantity': total_qty}
-
-        elif action == 'sell' and symbol in open_positions:
-            buy_price = open_positions[symbol]['price']
-            buy_qty = open_positions[symbol]['quantity']
-            sell_qty = quantity
-            if sell_qty <= buy_qty:  # Full or partial sell
-                profit = (price - buy_price) * sell_qty
-                completed_trades.append({
-                    'symbol': symbol,
-                    'profit': profit,
-                    'quantity': sell_qty,
-                    'is_win': price > buy_price
-                })
-                if sell_qty == buy_qty:
-                    del open_positions[symbol]
-                else:
-                    open_positions[symbol]['quantity'] -= sell_qty
+    # Sort trades by date to ensure chronological order, keeping same day trades in execution order
+    trades_df = trades_df.sort_values('date', kind='stable').reset_index(drop=True)
 
-    # Calculate metrics
-    trades_summary = pd.DataFrame(completed_trades)
-    if trades_summary.empty:
-        return {
-            'win_ratio': 0.0, 'total_profit': 0.0, 'total_return': 0.0,
-            'avg_trade_profit': 0.0, 'max_drawdown': 0.0
-        }
+    profits, wins = match_trades(trades_df['symbol'].to_numpy(), trades_df['action'].to_numpy(),
+                                 trades_df['price'].to_numpy(dtype=float),
+                                 trades_df['quantity'].to_numpy(dtype=float))
 
-    total_trades = len(trades_summary)
-    winning_trades = trades_summary['is_win'].sum()
+    # Calculate metrics, all zero until a trade closes
+    total_trades = len(profits)
+    winning_trades = wins.sum()
     win_ratio = (winning_trades / total_trades) * 100 if total_trades > 0 else 0.0
-    total_profit = trades_summary['profit'].sum()
+    total_profit = profits.sum()
     total_return = (total_profit / initial_cash) * 100 if initial_cash > 0 else 0.0
     avg_trade_profit = total_profit / total_trades if total_trades > 0 else 0.0
 
-    # Maximum Drawdown (based on cash_remaining only for now)
-    equity_curve = trades_df['cash_remaining'].tolist()
-    peak = equity_curve[0]
-    max_drawdown = 0.0
-    for equity in equity_curve:
-        if equity > peak:
-            peak = equity
-        drawdown = (peak - equity) / peak * 100 if peak > 0 else 0.0
-        max_drawdown = max(max_drawdown, drawdown)
+    # Maximum Drawdown, from the cash after each trade when there is no daily equity curve
+    max_drawdown = get_max_drawdown(trades_df['cash_remaining']) if total_trades > 0 else 0.0
 
-    tabulated_data = tabulate(trades_df, headers='keys', tablefmt='psql', showindex=False)
-    print(tabulated_data)
+    if print_trades and total_trades > 0:
+        tabulated_data = tabulate(trades_df, headers='keys', tablefmt='psql', showindex=False)
+        print(tabulated_data)
 
     output = {
         'win_ratio': win_ratio,
@@ -183,12 +179,139 @@ def calculate_trade_metrics(trades_df, benchmark, setup):
         'benchmark': benchmark
     }
 
+    # Open positions are marked to market by the equity curve, even before any trade closes
+    if equity_curve is not None:
+        output.update(calculate_equity_metrics(equity_curve, setup['Risk']['SharpeRatio']['TradingDays']))
+
     return output
 
 
+@profiled
+def calculate_equity_curve(trades_df, close, initial_cash, benchmark_close=None):
+    """
+    Daily mark-to-market equity of the trades over the calendar of the close prices.
+
+    Holdings are the running sum of the signed trade quantities on a (days x symbols) matrix, valued at
+    the last known close of each day, so the curve is a row-wise product of the holdings and price
+    matrices instead of a loop over days.
+
+    Parameters:
+    - trades_df: DataFrame with ['date', 'symbol', 'action', 'price', 'quantity', 'cash_remaining'] in
+      execution order
+    - close: Days x symbols DataFrame of close prices, covering the traded symbols
+    - initial_cash: Starting cash balance
+    - benchmark_close: Optional benchmark close Series, rebased to initial_cash on the same calendar
+
+    Returns:
+    - DataFrame: 'cash', 'invested' and 'equity' of each day, plus 'benchmark' if given
+    """
+    dates = close.index
+    codes, symbols = pd.factorize(trades_df['symbol'])
+
+    # Trades before the calendar count from its first day
+    days = np.maximum(dates.searchsorted(trades_df['date'].to_numpy(), side='right') - 1, 0)
+    quantities = trades_df['quantity'].to_numpy(dtype=float)
+    signed = np.where(trades_df['action'].to_numpy() == 'buy', quantities, -quantities)
+
+    holdings = np.zeros((len(dates), len(symbols)))
+    np.add.at(holdings, (days, codes), signed)
+    holdings = np.cumsum(holdings, axis=0)
+
+    prices = close.reindex(columns=symbols).ffill().to_numpy(dtype=float)
+    invested = np.einsum('ij,ij->i', holdings, np.nan_to_num(prices))
+
+    # Cash after the last trade of each day, the initial cash before the first one
+    cash_remaining = np.concatenate([[initial_cash], trades_df['cash_remaining'].to_numpy(dtype=float)])
+    cash = cash_remaining[np.searchsorted(days, np.arange(len(dates)), side='right')]
+
+    equity_curve = pd.DataFrame({'cash': cash, 'invested': invested, 'equity': cash + invested}, index=dates)
+
+    if benchmark_close is not None:
+        benchmark = benchmark_close.reindex(benchmark_close.index.union(dates)).ffill().reindex(dates)
+        first = benchmark.first_valid_index()
+        equity_curve['benchmark'] = initial_cash * benchmark / benchmark[first] if first is not None else np.nan
+
+    return equity_curve
+
+
+def calculate_equity_metrics(equity_curve, trading_days):
+    """
+    Drawdown, Sharpe, Sortino and exposure of a daily equity curve, plus the benchmark return and drawdown.
+
+    Ratios are annualized from the daily returns of the equity, without a risk-free rate; Sortino uses
+    the root mean square of the negative returns. Exposure is the average invested fraction of the equity.
+    """
+    equity = equity_curve['equity']
+    returns = equity.pct_change().dropna()
+
+    std = returns.std()
+    downside = np.sqrt((returns.clip(upper=0) ** 2).mean())
+
+    metrics = {
+        'max_drawdown': get_max_drawdown(equity),
+        'sharpe_ratio': float(returns.mean() / std * np.sqrt(trading_days)) if std > 0 else np.nan,
+        'sortino_ratio': float(returns.mean() / downside * np.sqrt(trading_days)) if downside > 0 else np.nan,
+        'exposure': float((equity_curve['invested'] / equity).mean() * 100)
+    }
+
+    if 'benchmark' in equity_curve:
+        benchmark = equity_curve['benchmark'].dropna()
+        if not benchmark.empty:
+            metrics['benchmark_return'] = float((benchmark.iloc[-1] / benchmark.iloc[0] - 1) * 100)
+            metrics['benchmark_max_drawdown'] = get_max_drawdown(benchmark)
+
+    return metrics
+
+
+def get_max_drawdown(equity):
+    """Largest fall from a previous peak, in percent."""
+    values = equity.to_numpy(dtype=float)
+    peak = np.maximum.accumulate(values)
+    drawdown = np.divide(peak - values, peak, out=np.zeros_like(values), where=peak > 0) * 100
+    return max(0.0, float(drawdown.max())) if len(values) else 0.0
+
+
+def match_trades(symbols, actions, prices, quantities):
+    """
+    Match chronologically ordered sells against the open buys of the same symbol.
+
+    Returns:
+    - tuple: Arrays of the profit and of the win flag of each completed trade
+    """
+    open_positions = {}  # {symbol: [price, quantity]}
+    profits = []
+    wins = []
+
+    for symbol, action, price, quantity in zip(symbols.tolist(), actions.tolist(), prices.tolist(),
+                                               quantities.tolist()):
+
+        if action == 'buy':
+            if symbol not in open_positions:
+                open_positions[symbol] = [price, quantity]
+            else:
+                # Average price for multiple buys (optional, assuming full sells for now)
+                current_price, current_qty = open_positions[symbol]
+                total_qty = current_qty + quantity
+                avg_price = (current_price * current_qty + price * quantity) / total_qty
+                open_positions[symbol] = [avg_price, total_qty]
+
+        elif action == 'sell' and symbol in open_positions:
+            buy_price, buy_qty = open_positions[symbol]
+            if quantity <= buy_qty:  # Full or partial sell
+                profit = (price - buy_price) * quantity
+                profits.append(profit)
+                wins.append(price > buy_price)
+                if quantity == buy_qty:
+                    del open_positions[symbol]
+                else:
+                    open_positions[symbol][1] -= quantity
+
+    return np.array(profits, dtype=float), np.array(wins, dtype=bool)
+
+
 def calculate_ticker_gain(ticker, start_date, end_date):
     """
-    Fetch ticker data from Yahoo Finance and calculate the percentage gain over the period.
+    Calculate the percentage gain of a ticker over the period, from the run's market data.
 
     Parameters:
     - ticker (str): Ticker symbol (e.g., 'AAPL').
@@ -202,17 +325,13 @@ def calculate_ticker_gain(ticker, start_date, end_date):
     - ValueError: If data retrieval fails or insufficient data is available.
     """
     try:
-        # Fetch historical data
-        stock = yf.Ticker(ticker)
-        data = stock.history(start=start_date, end=end_date)
+        # Fetch historical data, already adjusted for splits and dividends
+        adj_close = get_close(ticker, start_date, end_date)
 
         # Check if data is empty
-        if data.empty:
+        if adj_close.empty:
             raise ValueError(f"No data retrieved for {ticker} from {start_date} to {end_date}")
 
-        # Extract adjusted closing prices
-        adj_close = data['Close']
-
         # Get start and end prices
         start_price = adj_close.iloc[0]
         end_price = adj_close.iloc[-1]
@@ -222,7 +341,7 @@ def calculate_ticker_gain(ticker, start_date, end_date):
 
         # Return result as dictionary
         return {
-            ticker: round(gain, 2)  # Round to 2 decimal places
+            ticker: round(float(gain), 2)  # Round to 2 decimal places
         }
 
     except Exception as e:
@@ -0,0 +1,150 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_aquisition import STORE_DIR, PRICE_FIELDS, update_stock_store, read_symbol_data, load_manifest
+from utils.logging_config import logger
+from utils.profiling import profiled
+from utils.utils import get_hash, create_directories_if_not_exist
+
+PANEL_DIR = os.path.join(STORE_DIR, 'panel')
+
+
+class PricePanel:
+    """Symbols x trading days x OHLCV array with its symbol and date indexes.
+
+    The values are usually a read-only memory map, so every accessor below returns a view
+    on the mapped pages instead of a copy, and processes loading the same panel share them.
+    """
+
+    def __init__(self, values, symbols, dates, path=None):
+        self.path = path
+        self.values = values
+        self.symbols = list(symbols)
+        self.dates = pd.DatetimeIndex(dates, name='Date')
+        self.fields = list(PRICE_FIELDS)
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+
+    def __contains__(self, symbol):
+        return symbol in self.symbol_index
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def get_date_slice(self, start_date=None, end_date=None):
+        """Positional slice of the trading days within ``[start_date, end_date)``."""
+        start = 0 if start_date is None else self.dates.searchsorted(pd.Timestamp(start_date), side='left')
+        end = len(self.dates) if end_date is None else self.dates.searchsorted(pd.Timestamp(end_date), side='left')
+        return slice(start, end)
+
+    def get_ticker(self, symbol, start_date=None, end_date=None):
+        """Days x fields view for a single symbol."""
+        return self.values[self.symbol_index[symbol], self.get_date_slice(start_date, end_date)]
+
+    def get_window(self, start_date=None, end_date=None):
+        """Symbols x days x fields view for a date window."""
+        return self.values[:, self.get_date_slice(start_date, end_date)]
+
+    def get_field(self, field, start_date=None, end_date=None):
+        """Symbols x days view of a single price field."""
+        return self.values[:, self.get_date_slice(start_date, end_date), self.fields.index(field)]
+
+    def get_frame(self, symbol, start_date=None, end_date=None):
+        """Single symbol OHLCV frame backed by the panel memory, as ``stock_data[ticker]`` used to be."""
+        date_slice = self.get_date_slice(start_date, end_date)
+        return pd.DataFrame(self.values[self.symbol_index[symbol], date_slice], index=self.dates[date_slice],
+                            columns=self.fields, copy=False)
+
+    def to_frame(self, start_date=None, end_date=None):
+        """Materialize the window in the ``yf.download(group_by='ticker')`` layout."""
+        date_slice = self.get_date_slice(start_date, end_date)
+        window = self.values[:, date_slice]
+        columns = pd.MultiIndex.from_product([self.symbols, self.fields], names=['Ticker', 'Price'])
+        values = np.transpose(window, (1, 0, 2)).reshape(window.shape[1], -1)
+        return pd.DataFrame(values, index=self.dates[date_slice], columns=columns)
+
+
+@profiled
+def fetch_price_panel(stock_list, start_date, end_date, panel_dir=PANEL_DIR, store_dir=STORE_DIR):
+    """Make sure the store holds the requested data and return the universe panel over it."""
+
+    update_stock_store(stock_list, start_date, end_date, store_dir=store_dir)
+
+    return load_price_panel(stock_list, panel_dir=panel_dir, store_dir=store_dir)
+
+
+def load_price_panel(stock_list, panel_dir=PANEL_DIR, store_dir=STORE_DIR):
+    """Memory-map the panel of the given universe, rebuilding it when the store has changed."""
+
+    symbols = sorted(set(stock_list))
+    path = get_panel_path(symbols, panel_dir)
+    coverage = get_panel_coverage(symbols, store_dir)
+
+    meta_file = os.path.join(path, 'meta.json')
+    if os.path.exists(meta_file):
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        if meta['coverage'] == coverage:
+            return open_price_panel(path)
+
+    return build_price_panel(symbols, path, coverage, store_dir=store_dir)
+
+
+def build_price_panel(symbols, path, coverage, store_dir=STORE_DIR):
+    """Write the symbols x days x fields array from the per-symbol store."""
+
+    logger.info(f"Building price panel for {len(symbols)} symbols in {path}")
+    create_directories_if_not_exist(path)
+
+    frames = {}
+    for symbol in symbols:
+        symbol_data = read_symbol_data(symbol, store_dir)
+        if symbol_data is not None and not symbol_data.empty:
+            frames[symbol] = symbol_data
+
+    panel_symbols = list(frames.keys())
+    dates = pd.DatetimeIndex(sorted(set().union(*[frame.index for frame in frames.values()])))
+
+    values_file = os.path.join(path, 'values.npy')
+    tmp_values_file = os.path.join(path, 'values.tmp.npy')
+    values = np.lib.format.open_memmap(tmp_values_file, mode='w+', dtype='float64',
+                                       shape=(len(panel_symbols), len(dates), len(PRICE_FIELDS)))
+    values[:] = np.nan
+    for i, symbol in enumerate(panel_symbols):
+        values[i, dates.get_indexer(frames[symbol].index)] = frames[symbol][PRICE_FIELDS].to_numpy()
+    values.flush()
+    del values
+
+    np.save(os.path.join(path, 'dates.tmp.npy'), dates.values.astype('datetime64[ns]'))
+    with open(os.path.join(path, 'meta.tmp.json'), 'w') as f:
+        json.dump({'symbols': panel_symbols, 'fields': PRICE_FIELDS, 'coverage': coverage}, f)
+
+    # Replace the meta file last, so a panel is only picked up once it is complete
+    os.replace(tmp_values_file, values_file)
+    os.replace(os.path.join(path, 'dates.tmp.npy'), os.path.join(path, 'dates.npy'))
+    os.replace(os.path.join(path, 'meta.tmp.json'), os.path.join(path, 'meta.json'))
+
+    return open_price_panel(path)
+
+
+def open_price_panel(path):
+
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+
+    values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+    dates = np.load(os.path.join(path, 'dates.npy'))
+
+    return PricePanel(values, meta['symbols'], dates, path=path)
+
+
+def get_panel_path(symbols, panel_dir=PANEL_DIR):
+    return os.path.join(panel_dir, get_hash(','.join(symbols)))
+
+
+def get_panel_coverage(symbols, store_dir=STORE_DIR):
+    """Store manifest entries of the universe; a panel is stale as soon as they change."""
+    manifest = load_manifest(store_dir)
+    return {symbol: manifest[symbol] for symbol in symbols if symbol in manifest}
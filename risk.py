@@ -1,23 +1,125 @@
 from datetime import datetime
 from constants import *
+from indicator_cache import memoize_indicator
+from utils.logging_config import logger
+from utils.profiling import profiled
 
 import numpy as np
+import pandas as pd
 
 def get_stop_data(stock_data, setup, start_price, start_date: datetime, initial_recommendation):
     # Search for Stops based on setup and add info to ticker
 
+    close = stock_data['Close']
     if initial_recommendation == 'Buy':
-        for date, row in stock_data.iterrows():
-            if (row['Close'] <= start_price * (1.0 - setup['Risk']['Stop']['margin'])) and date >= start_date:
-                return date.date(), row['Close']
+        hit = close <= start_price * (1.0 - setup['Risk']['Stop']['margin'])
     else:
-        for date, row in stock_data.iterrows():
-            if row['Close'] >= start_price * (1.0 + setup['Risk']['Stop']['margin']) and date >= start_date:
-                return date.date(), row['Close']
+        hit = close >= start_price * (1.0 + setup['Risk']['Stop']['margin'])
+    hit &= close.index >= start_date
 
-    return None, None
+    if not hit.any():
+        return None, None
 
+    date = hit.idxmax()
+    return date.date(), close[date]
 
+
+@profiled
+def evaluate_positions(position, price_panel, setup, end_date=None):
+    """
+    Stop analysis of every lot of a position file in one pass over the price panel.
+
+    Lots become the rows of a (lots x days) matrix of closes, each masked before the first trading
+    day on or after its date, so the first breach, the highest close and the current gain of all
+    lots are array reductions instead of a scan of each ticker history.
+
+    Lots are long positions, stopped Risk.Stop.margin below their price. A lot still above its stop
+    is flagged as a warning when its last close is within Risk.Stop.warning of it, both fractions
+    of the lot price. With a Risk.Stop.trailing fraction, a trailing stop that far below the highest
+    close since the lot date is tracked too.
+
+    Parameters:
+    - position (dict): Position file, lots keyed by symbol and date under 'Position'.
+    - price_panel (PricePanel): Panel covering the symbols of the position from the first lot date.
+    - setup (dict): Setup file.
+    - end_date (datetime): Last day considered (exclusive), up to the end of the panel by default.
+
+    Returns:
+    - pd.DataFrame: One row per lot in position file order, with its last close and gain (%), the
+      stop price with the date and close of its first breach (NaT/NaN if none), the warning flag and,
+      with a trailing stop, its current level and first breach.
+    """
+
+    lots = []
+    for symbol, symbol_lots in position['Position'].items():
+        if symbol not in price_panel:
+            logger.warning(f"{symbol} - No price data to evaluate the position")
+            continue
+        for date, lot in symbol_lots.items():
+            lots.append((symbol, pd.Timestamp(date), lot['price'], lot['volume']))
+
+    if not lots:
+        return pd.DataFrame(columns=['symbol', 'date', 'price_start', 'volume', 'last_date', 'price_end', 'gain',
+                                     'period', 'stop_price', 'stop_date', 'stop_close', 'warning'])
+
+    symbols, dates, prices, volumes = zip(*lots)
+    dates = pd.DatetimeIndex(dates)
+    prices = np.asarray(prices, dtype=float)
+
+    date_slice = price_panel.get_date_slice(dates.min(), end_date)
+    panel_dates = price_panel.dates[date_slice]
+    close = price_panel.get_field('Close')[[price_panel.symbol_index[symbol] for symbol in symbols], date_slice]
+
+    rows = np.arange(len(lots))
+    starts = panel_dates.searchsorted(dates)
+    observed = (np.arange(len(panel_dates)) >= starts[:, np.newaxis]) & ~np.isnan(close)
+
+    # Last close of each lot
+    has_close = observed.any(axis=1)
+    last = len(panel_dates) - 1 - np.argmax(observed[:, ::-1], axis=1)
+    last_close = np.where(has_close, close[rows, last], np.nan)
+
+    stop = setup['Risk']['Stop']
+    stop_price = prices * (1.0 - stop['margin'])
+    stop_distance = (last_close - stop_price) / prices
+
+    result = pd.DataFrame({
+        'symbol': symbols,
+        'date': dates,
+        'price_start': prices,
+        'volume': volumes,
+        'last_date': np.where(has_close, panel_dates.values[last], np.datetime64('NaT')),
+        'price_end': last_close,
+        'gain': np.round((last_close - prices) / prices * 100, 2),
+    })
+    result['period'] = result['last_date'] - result['date']
+    result['stop_price'] = stop_price
+    result['stop_date'], result['stop_close'] = get_first_hit(observed & (close <= stop_price[:, np.newaxis]), close,
+                                                              panel_dates)
+    result['warning'] = (stop_distance > 0) & (stop_distance <= stop['warning'])
+
+    trailing = stop.get('trailing', 0)
+    if trailing:
+        highest = np.fmax.accumulate(np.where(observed, close, -np.inf), axis=1)
+        trailing_stop = highest * (1.0 - trailing)
+        result['trailing_stop'] = np.where(has_close, trailing_stop[rows, last], np.nan)
+        result['trailing_date'], result['trailing_close'] = get_first_hit(observed & (close <= trailing_stop), close,
+                                                                          panel_dates)
+
+    return result
+
+
+def get_first_hit(hit, close, dates):
+    """Date and close of the first True of each row of a (lots x days) mask, NaT and NaN if none."""
+
+    hit_any = hit.any(axis=1)
+    first = np.argmax(hit, axis=1)
+
+    return (np.where(hit_any, dates.values[first], np.datetime64('NaT')),
+            np.where(hit_any, close[np.arange(len(first)), first], np.nan))
+
+
+@profiled
 def add_shape_ratio(data, risk_free, setup):
 
     # Constants
@@ -28,87 +130,133 @@ def add_shape_ratio(data, risk_free, setup):
     #if data['daily_return'].isna().any() or risk_free['Close'].isna().any():
     #    raise ValueError("Input data contains NaN values. Please clean the data.")
 
+    sharpe_ratio, valid = calculate_sharpe_ratio(data['daily_return'], risk_free, LOOKBACK_PERIOD, TRADING_DAYS)
+
+    # Align indices
+    if not valid.any():
+        raise ValueError("No common index found after alignment. Check data consistency.")
+
+    # Calculate annualized Sharpe Ratio
+    data['sharpe_ratio'] = sharpe_ratio
+
+
+@memoize_indicator
+def calculate_sharpe_ratio(returns, risk_free, lookback_period, trading_days):
+    """
+    Rolling annualized Sharpe ratio.
+
+    Parameters:
+    - returns (pd.Series or pd.DataFrame): Daily returns of one ticker, or a (days x symbols)
+      frame to compute the whole universe in one pass.
+    - risk_free (pd.DataFrame): DataFrame with the annual risk-free rate in percent on 'Close'.
+    - lookback_period (int): Number of days for the rolling calculation.
+    - trading_days (int): Number of trading days in a year.
+
+    Returns:
+    - tuple: (Sharpe ratio with the shape of `returns`, mask of the rows where the rolling return,
+      deviation and risk-free rate are all available)
+    """
+
     # Calculate rolling metrics
-    std = data['daily_return'].rolling(LOOKBACK_PERIOD).std().dropna()
-    daily_return = data['daily_return'].rolling(LOOKBACK_PERIOD).mean().dropna()
+    std = returns.rolling(lookback_period).std()
+    daily_return = returns.rolling(lookback_period).mean()
 
     # Convert risk-free rate to daily (assuming risk_free['Close'] is an annual rate in percentage)
-    risk_free_daily = (risk_free['Close'] / 100) / TRADING_DAYS
-    risk_free_daily = risk_free_daily.rolling(LOOKBACK_PERIOD).mean().dropna()
+    risk_free_daily = (risk_free['Close'] / 100) / trading_days
+    risk_free_daily = risk_free_daily.rolling(lookback_period).mean().dropna().reindex(returns.index)
 
-    # Align indices
-    common_index = std.index.intersection(daily_return.index).intersection(risk_free_daily.index)
-    if common_index.empty:
-        raise ValueError("No common index found after alignment. Check data consistency.")
+    valid = std.notna() & daily_return.notna()
+    if isinstance(returns, pd.DataFrame):
+        valid = valid.mul(risk_free_daily.notna(), axis=0).astype(bool)
+        excess_return = daily_return.sub(risk_free_daily, axis=0)
+    else:
+        valid = valid & risk_free_daily.notna()
+        excess_return = daily_return - risk_free_daily
 
     # Calculate annualized excess return and standard deviation
-    excess_return = daily_return.loc[common_index] - risk_free_daily.loc[common_index]
-    annualized_excess_return = excess_return * np.sqrt(TRADING_DAYS)
-    annualized_std = std.loc[common_index] * np.sqrt(TRADING_DAYS)
+    annualized_excess_return = excess_return * np.sqrt(trading_days)
+    annualized_std = std * np.sqrt(trading_days)
 
-    # Calculate annualized Sharpe Ratio
-    data.loc[common_index, 'sharpe_ratio'] = annualized_excess_return / annualized_std
+    # Handle edge cases where std is zero to avoid division errors
+    sharpe_ratio = (annualized_excess_return / annualized_std).replace([np.inf, -np.inf], np.nan)
 
-    # Optional: Handle edge cases where std is zero to avoid division errors
-    data.loc[common_index, 'sharpe_ratio'] = data.loc[common_index, 'sharpe_ratio'].replace([np.inf, -np.inf], np.nan)
+    return sharpe_ratio.where(valid), valid
 
 
-def add_sortino_ratio(df, risk_free):
+@profiled
+def add_sortino_ratio(df, risk_free, setup):
     """
     Add Sortino ratio to a DataFrame with stock price data from Yahoo Finance,
     using a risk-free rate from a DataFrame.
 
     Parameters:
-    - df (pd.DataFrame): DataFrame with 'Adj Close' column from yfinance.
-    - risk_free_df (pd.DataFrame): DataFrame with a column of daily risk-free rates.
-    - risk_free_col (str): Name of the column in risk_free_df with risk-free rates (default: 'Rate').
-    - lookback_period (int): Number of days for rolling Sortino calculation (default: 30).
-    - trading_days (int): Number of trading days in a year (default: 252).
+    - df (pd.DataFrame): DataFrame with 'daily_return' column.
+    - risk_free (pd.DataFrame): DataFrame with the risk-free rate on its 'Close' column.
+    - setup (dict): Setup file, providing 'LoopbackPeriod' (number of days for rolling Sortino
+      calculation) and 'TradingDays' (number of trading days in a year) under Risk.SortinoRatio.
 
     Returns:
-    - pd.DataFrame: Original DataFrame with a new 'Sortino_Ratio' column.
-
-    Raises:
-    - ValueError: If risk_free_df index does not match df index or risk_free_col is missing.
+    - pd.DataFrame: Original DataFrame with a new 'sortino_ratio' column.
     """
 
-    # Initialize Sortino ratio column
-    df['sortino_ratio'] = np.nan
-
-    lookback_period = 20
-    trading_days = 252
+    lookback_period = setup['Risk']['SortinoRatio']['LoopbackPeriod']
+    trading_days = setup['Risk']['SortinoRatio']['TradingDays']
 
     # Extract risk-free rate series
     daily_rf = (1 + risk_free['Close']) ** (1 / trading_days) - 1
 
-    # Calculate rolling Sortino ratio
-    for i in range(lookback_period, len(df)):
-        # Get returns and risk-free rates for the lookback period
-        returns = df['daily_return'].iloc[i - lookback_period:i]
-        rf_window = daily_rf.iloc[i - lookback_period:i]
+    df['sortino_ratio'] = calculate_sortino_ratio(df['daily_return'], daily_rf, lookback_period, trading_days)
 
-        # Excess returns (returns - risk-free rate)
-        excess_returns = returns - rf_window
+    return df
 
-        # Mean excess return
-        mean_excess_return = excess_returns.mean()
 
-        # Downside deviation (negative excess returns only)
-        downside_returns = excess_returns[excess_returns < 0]
-        downside_deviation = np.sqrt(np.mean(downside_returns ** 2)) if len(downside_returns) > 0 else np.nan
+@memoize_indicator
+def calculate_sortino_ratio(returns, daily_rf, lookback_period, trading_days):
+    """
+    Rolling annualized Sortino ratio over the `lookback_period` rows preceding each row.
 
-        # Sortino ratio: (mean excess return) / downside deviation
-        # Annualize by multiplying by sqrt(trading_days)
-        if downside_deviation and not np.isnan(downside_deviation) and downside_deviation != 0:
-            sortino = (mean_excess_return / downside_deviation) * np.sqrt(trading_days)
-        else:
-            sortino = np.nan
+    Downside deviation is the root mean square of the negative excess returns of the window,
+    computed from rolling sums of the clipped squared excess returns and of the negative
+    return count, so the cost is O(n) whatever the window.
 
-        df.iloc[i, df.columns.get_loc('sortino_ratio')] = sortino
+    Parameters:
+    - returns (pd.Series or pd.DataFrame): Daily returns of one ticker, or a (days x symbols)
+      frame to compute the whole universe in one pass.
+    - daily_rf (pd.Series): Daily risk-free rate, aligned to the returns by date.
+    - lookback_period (int): Number of days for the rolling calculation.
+    - trading_days (int): Number of trading days in a year.
 
-    return df
+    Returns:
+    - pd.Series or pd.DataFrame: Sortino ratio with the shape of `returns`.
+    """
+
+    # Excess returns (returns - risk-free rate)
+    daily_rf = daily_rf.reindex(returns.index)
+    if isinstance(returns, pd.DataFrame):
+        excess_returns = returns.sub(daily_rf, axis=0)
+    else:
+        excess_returns = returns - daily_rf
+
+    # Mean excess return
+    mean_excess_return = excess_returns.rolling(lookback_period, min_periods=1).mean()
+
+    # Downside deviation (negative excess returns only)
+    downside_square_sum = (excess_returns.clip(upper=0) ** 2).rolling(lookback_period, min_periods=1).sum()
+    downside_count = (excess_returns < 0).astype(float).rolling(lookback_period, min_periods=1).sum()
+    downside_deviation = np.sqrt(downside_square_sum / downside_count.where(downside_count > 0))
+
+    # Sortino ratio: (mean excess return) / downside deviation
+    # Annualize by multiplying by sqrt(trading_days)
+    sortino = (mean_excess_return / downside_deviation.where(downside_deviation != 0)) * np.sqrt(trading_days)
+
+    # Each value only uses the window before its own row
+    sortino = sortino.shift(1)
+    sortino.iloc[:lookback_period] = np.nan
 
+    return sortino
 
+
+@profiled
 def get_stock_from_rm(df, setup):
 
     for ticker in df.keys():
@@ -146,4 +294,29 @@ def get_stock_from_rm(df, setup):
                     pass
                     # TODO: IMPLEMENT FILTER FOR MOVING AVERAGES
 
-    return df
\ No newline at end of file
+    return df
+
+
+def calculate_risk_filter(data, setup):
+    """
+    Mask of the signal rows get_stock_from_rm keeps.
+
+    Its moving average filter never stores the filtered frame back, so only the Sharpe ratio
+    filter affects the output and only that one is applied here.
+
+    Parameters:
+    - data: Ticker frame, or SignalPanel of (days x symbols) matrices.
+    - setup (dict): Setup file.
+
+    Returns:
+    - pd.Series or pd.DataFrame: True where the row is kept.
+    """
+
+    # Action is never NaN, so every row starts as kept
+    keep = data['Action'].notna()
+
+    # Sharpe Ratio Filter
+    if setup['Risk']['SharpeRatio']['enabled']:
+        keep &= data['sharpe_ratio'] >= setup['Risk']['SharpeRatio']['min']
+
+    return keep
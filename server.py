@@ -0,0 +1,410 @@
+import json
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import urlparse, parse_qsl
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from data_providers import configure_data_provider
+from indicator_cache import configure_indicator_cache
+from market_data import clear_market_data
+from portfolio_manager import portfolio_manager, calculate_trade_metrics, calculate_ticker_gain
+from risk import get_stock_from_rm
+from utils.analysis import get_stock_signals, get_recommendations, get_backtest_equity_curve, get_position_stops
+from utils.argument_parsing import server_argument_parsing
+from utils.logging_config import logger
+from utils.utils import get_hash, create_directories_if_not_exist
+
+pd.options.mode.chained_assignment = None
+
+# Universe, default setup and engine options of the service, set once by main
+_config = {}
+
+# Date range of the current refresh and when it finished
+_state = {'start_date': None, 'end_date': None, 'refreshed': None}
+
+# Query results of the current refresh, keyed by query and setup hash, dropped by the next refresh. Beyond
+# _config['max_results'], results other than the default setup signals are evicted least recently used first
+_results = OrderedDict()
+
+# Guards the order of _results, which reads update too, without waiting for a computation holding _lock
+_results_lock = threading.Lock()
+
+# Market data and the indicator cache are process globals, so computations run one at a time. Reentrant, as
+# cached results are built from other cached results
+_lock = threading.RLock()
+
+# Marks a result missing from _results, as None may be a result
+_MISSING = object()
+
+
+class QueryError(Exception):
+    """Error of the query itself, answered with its HTTP status instead of 500."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def main():
+
+    args = server_argument_parsing()
+    configure_data_provider(args.provider, data_dir=args.data_dir)
+    configure_indicator_cache(args.indicator_cache_size * 1024 ** 2, args.indicator_cache_dir)
+
+    create_directories_if_not_exist("logs")
+    create_directories_if_not_exist("ticker_data")
+
+    _config.update(input=args.input, setup=args.setup, setup_key=get_setup_key(args.setup), limit=args.limit,
+                   workers=args.workers, engine=args.engine, lookback=args.lookback, max_results=args.max_results)
+
+    # Serve only once the default setup is warm, so the first query is as fast as the next ones
+    refresh_state()
+
+    server = create_server(args.host, args.port, args.socket)
+
+    stop = threading.Event()
+    if args.refresh > 0:
+        threading.Thread(target=schedule_refresh, args=(args.refresh * 60, stop), daemon=True).start()
+
+    # Stop on a service manager's SIGTERM as on Ctrl+C, removing the socket file
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    logger.info(f"Serving on {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(host, port, socket_path=None):
+
+    if socket_path is None:
+        return ThreadingHTTPServer((host, port), QueryHandler)
+
+    # A socket left by a service that did not shut down cleanly would fail the bind
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    return ThreadingUnixHTTPServer(socket_path, QueryHandler)
+
+
+def schedule_refresh(interval, stop):
+    """Refresh every interval seconds until stop is set, keeping the previous state when a refresh fails."""
+
+    while not stop.wait(interval):
+        try:
+            refresh_state()
+        except Exception as e:
+            logger.error(f"Refresh failed, still serving the data of {_state['refreshed']} - {str(e)}")
+
+
+def refresh_state():
+    """
+    Read the prices added to the store since the last refresh (downloading what it lacks) and recompute
+    the signals and recommendations of the default setup over the last lookback days.
+
+    Every cached query result belongs to the previous data, so they are all dropped.
+    """
+
+    end_date = datetime.combine(datetime.now().date(), datetime.min.time()) - relativedelta(hours=1)
+    start_date = end_date - relativedelta(days=_config['lookback'])
+
+    with _lock:
+        started = time.perf_counter()
+
+        clear_market_data()
+        with _results_lock:
+            _results.clear()
+        _state.update(start_date=start_date, end_date=end_date)
+
+        get_cached(('recommendations', _config['setup_key']), get_recommendations_records, _config['setup'])
+        _state['refreshed'] = datetime.now()
+
+    logger.info(f"Refreshed {len(get_setup_signals(_config['setup']))} symbols from {start_date.date()} to "
+                f"{end_date.date()} in {time.perf_counter() - started:.1f} s")
+
+
+def get_cached(key, compute, *args):
+    """Result of compute(*args), computed once per refresh."""
+
+    value = get_result(key)
+    if value is not _MISSING:
+        return value
+
+    with _lock:
+        value = get_result(key)
+        if value is _MISSING:
+            value = compute(*args)
+            store_result(key, value)
+        return value
+
+
+def get_result(key):
+
+    # A refresh may clear the results at any time, so read them in one step
+    with _results_lock:
+        value = _results.get(key, _MISSING)
+        if value is not _MISSING:
+            _results.move_to_end(key)
+        return value
+
+
+def store_result(key, value):
+    """Keep a result, evicting the least recently used ones beyond max_results."""
+
+    with _results_lock:
+        _results[key] = value
+
+        # Refreshes compute the signals and recommendations of the default setup, every other result may go
+        kept = {('signals', _config['setup_key']), ('recommendations', _config['setup_key'])}
+        evictable = [cached for cached in _results if cached not in kept]
+        for cached in evictable[:max(len(evictable) - _config['max_results'], 0)]:
+            del _results[cached]
+
+
+def get_setup_key(setup):
+    return get_hash(json.dumps(setup, sort_keys=True))
+
+
+def get_setup_signals(setup):
+    """Risk filtered signals of every ticker over the range of the refresh."""
+    return get_cached(('signals', get_setup_key(setup)), compute_setup_signals, setup)
+
+
+def compute_setup_signals(setup, start_date=None, end_date=None):
+
+    signal_data = get_stock_signals(_config['input'], setup, _config['limit'],
+                                    start_date=start_date or _state['start_date'],
+                                    end_date=end_date or _state['end_date'],
+                                    workers=_config['workers'],
+                                    engine=_config['engine'])
+
+    return get_stock_from_rm(signal_data, setup)
+
+
+def get_recommendations_records(setup):
+    return frame_to_records(get_recommendations(get_setup_signals(setup), setup))
+
+
+def run_backtest(setup, start_date, end_date):
+    """Metrics, trades and daily equity of a backtest, as main.py runs it with --backtest."""
+
+    signal_data_filtered = compute_setup_signals(setup, start_date, end_date)
+
+    trades = portfolio_manager(signal_data_filtered, setup)
+    benchmark_index = calculate_ticker_gain('^SPX', start_date, end_date)
+    equity_curve = get_backtest_equity_curve(trades, _config['input'], setup, start_date, end_date)
+    metrics = calculate_trade_metrics(trades, benchmark_index, setup, print_trades=False, equity_curve=equity_curve)
+
+    # json writes NaN, which is not valid JSON
+    metrics = {key: None if isinstance(value, float) and np.isnan(value) else value for key, value in metrics.items()}
+
+    return {'metrics': metrics, 'trades': frame_to_records(trades),
+            'equity_curve': frame_to_records(equity_curve.reset_index())}
+
+
+# ------------ Queries ---------- #
+
+def query_health(params):
+    return {
+        'status': 'ok',
+        'refreshed': _state['refreshed'],
+        'start_date': _state['start_date'],
+        'end_date': _state['end_date'],
+        'symbols': len(get_setup_signals(_config['setup'])),
+        'cached_results': len(_results)
+    }
+
+
+def query_recommendations(params):
+    setup = get_query_setup(params)
+    return get_cached(('recommendations', get_setup_key(setup)), get_recommendations_records, setup)
+
+
+def query_signals(params, symbol):
+
+    signal_data = get_setup_signals(get_query_setup(params))
+    if symbol not in signal_data:
+        raise QueryError(404, f"No signals for {symbol}")
+
+    df = signal_data[symbol]
+    if 'days' in params:
+        df = df[df.index >= pd.Timestamp.now().normalize() - pd.Timedelta(days=get_int_param(params, 'days'))]
+
+    return frame_to_records(df.reset_index())
+
+
+def query_backtest(params):
+
+    setup = get_query_setup(params)
+    start_date = get_date_param(params, 'start_date', _state['start_date'])
+    end_date = get_date_param(params, 'end_date', _state['end_date'])
+    if start_date >= end_date:
+        raise QueryError(400, f"start_date {start_date.date()} is not before end_date {end_date.date()}")
+
+    key = ('backtest', get_setup_key(setup), start_date, end_date)
+    return get_cached(key, run_backtest, setup, start_date, end_date)
+
+
+def query_positions(params):
+
+    if not isinstance(params.get('Position'), dict) or not params['Position']:
+        raise QueryError(400, "Expected a position file, with its lots under 'Position'")
+
+    setup = get_query_setup(params)
+    with _lock:
+        positions = get_position_stops(params, setup, end_date=_state['end_date'])
+
+    return frame_to_records(positions)
+
+
+def query_refresh(params):
+    refresh_state()
+    return query_health(params)
+
+
+# Method and first path segment of each query, to the query and the number of later segments it takes
+QUERIES = {
+    ('GET', 'health'): (query_health, 0),
+    ('GET', 'recommendations'): (query_recommendations, 0),
+    ('POST', 'recommendations'): (query_recommendations, 0),
+    ('GET', 'signals'): (query_signals, 1),
+    ('POST', 'signals'): (query_signals, 1),
+    ('GET', 'backtest'): (query_backtest, 0),
+    ('POST', 'backtest'): (query_backtest, 0),
+    ('POST', 'positions'): (query_positions, 0),
+    ('POST', 'refresh'): (query_refresh, 0),
+}
+
+
+def handle_query(method, path, params):
+    """Run the query of a request, returning its HTTP status and JSON payload."""
+
+    name, *arguments = [part for part in path.split('/') if part] or ['health']
+    query, argument_count = QUERIES.get((method, name), (None, None))
+    if query is None or len(arguments) != argument_count:
+        return 404, {'error': f"Unknown query {method} {path}"}
+
+    try:
+        return 200, query(params, *arguments)
+    except QueryError as e:
+        return e.status, {'error': str(e)}
+    except Exception as e:
+        logger.error(f"{method} {path} - {type(e).__name__} {str(e)}")
+        return 500, {'error': f"{type(e).__name__} {str(e)}"}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    JSON queries over HTTP. GET parameters come from the query string; a POST body is a JSON object
+    of the same parameters, which may also hold a full 'setup' to query instead of the default one.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.send_json(*handle_query('GET', url.path, dict(parse_qsl(url.query))))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            try:
+                params.update(json.loads(self.rfile.read(length)))
+            except (ValueError, TypeError) as e:
+                self.send_json(400, {'error': f"Invalid JSON body - {str(e)}"})
+                return
+
+        self.send_json(*handle_query('POST', url.path, params))
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, default=to_json_value).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Unix socket clients have no address, so log the request line and status only
+        logger.debug(format % args)
+
+
+def frame_to_records(df):
+    """Rows of a frame as JSON objects, NaN as null and dates in ISO format."""
+    return json.loads(df.to_json(orient='records', date_format='iso'))
+
+
+def to_json_value(value):
+
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def get_query_setup(params):
+    """Setup sent with the query, checked against the default one, or the default setup."""
+
+    if 'setup' not in params:
+        return _config['setup']
+
+    missing = get_missing_fields(_config['setup'], params['setup'])
+    if missing:
+        raise QueryError(400, f"Setup is missing {', '.join(missing)}")
+    return params['setup']
+
+
+def get_missing_fields(expected, setup, prefix=''):
+    """Dotted paths of the fields of expected that setup lacks."""
+
+    if not isinstance(setup, dict):
+        return [prefix.rstrip('.') or 'setup']
+
+    missing = []
+    for field, value in expected.items():
+        if field not in setup:
+            missing.append(f"{prefix}{field}")
+        elif isinstance(value, dict):
+            missing += get_missing_fields(value, setup[field], f"{prefix}{field}.")
+    return missing
+
+
+def get_int_param(params, name):
+    try:
+        return int(params[name])
+    except (TypeError, ValueError):
+        raise QueryError(400, f"{name} is not an integer: {params[name]!r}")
+
+
+def get_date_param(params, name, default):
+    if name not in params:
+        return default
+    try:
+        return datetime.strptime(params[name], "%Y-%m-%d")
+    except (TypeError, ValueError):
+        raise QueryError(400, f"{name} is not a date in YYYY-MM-DD format: {params[name]!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+import json
+import os
+import pickle
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+from data_aquisition import STORE_DIR, PRICE_FIELDS, update_stock_store, load_stock_data, read_symbol_data, \
+    is_readjusted
+from market_data import get_market_data
+from momentum import calculate_rsi_averages
+from panel_indicators import get_price_matrices, compute_signal_panel, get_seed
+from price_panel import fetch_price_panel
+from trend import calculate_ema, calculate_on_balance_volume
+from utils.analysis import compact_signal_frame, get_frames_nbytes, log_compact_footprint
+from utils.logging_config import logger
+from utils.profiling import profiled
+from utils.utils import get_hash, get_ticker_list, get_stock_selection_dates, create_directories_if_not_exist
+
+STATE_DIR = os.path.join(STORE_DIR, 'state')
+
+
+@profiled
+def update_stock_signals(stock_list, setup, limit, start_date=None, end_date=None, state_dir=STATE_DIR,
+                         compact=False):
+    """Compute the BUY/SELL signals of every ticker by advancing the state of the previous run.
+
+    Each symbol keeps the last rows of prices its windowed indicators need and the values of its
+    recursive indicators (EMA, RSI averages, OBV) at the first of those rows. A run only downloads
+    the bars after the last processed one and runs the panel engine over the tails, so the daily
+    cost does not grow with the history. Symbols without a state are computed in full once, from
+    the pre-analysis start of start_date, which then stays the origin of their recursive indicators.
+    So are symbols whose stored closes no longer match their state, as the store downloads the
+    whole history again after a split or dividend re-adjusted it.
+
+    States are kept per setup, since every parameter change invalidates them. With compact, the
+    returned frames are reduced by compact_signal_frame; the states keep every column.
+
+    Returns:
+        dict: Ticker symbol to a DataFrame of its BUY and SELL rows since start_date, as
+        get_stock_signals returns them.
+    """
+
+    signal_data = {}
+    errors = {}
+    full_nbytes = 0
+
+    symbols = sorted(set(get_ticker_list(stock_list)))
+    state_path = os.path.join(state_dir, get_hash(json.dumps(setup, sort_keys=True)))
+    states = {symbol: read_signal_state(symbol, state_path) for symbol in symbols}
+
+    stated = [symbol for symbol in symbols if states[symbol] is not None]
+    if stated:
+        # Bring the store up to date first, so the symbols it re-adjusted for a split or dividend are known
+        new_start = min(states[symbol]['prices'].index[-1] for symbol in stated) + pd.Timedelta(days=1)
+        update_stock_store(symbols, new_start, end_date)
+
+        for symbol in stated:
+            stored_data = read_symbol_data(symbol)
+            if stored_data is not None and is_readjusted(stored_data, states[symbol]['prices']):
+                logger.info(f"{symbol} - Computing again the indicator state of a re-adjusted price history")
+                states[symbol] = None
+
+    missing = [symbol for symbol in symbols if states[symbol] is None]
+    if missing:
+        new_states, new_errors = init_signal_states(symbols, missing, setup, start_date, end_date)
+        states.update(new_states)
+        errors.update(new_errors)
+
+    tracked = [symbol for symbol in symbols if states[symbol] is not None]
+    new_data = pd.DataFrame()
+    if tracked:
+        # New bars of every symbol, on the calendar of the whole universe as the price panel has it
+        new_start = min(states[symbol]['prices'].index[-1] for symbol in tracked) + pd.Timedelta(days=1)
+        update_stock_store(symbols, new_start, end_date)
+        new_data = load_stock_data(symbols, new_start, end_date)
+
+    if not new_data.empty:
+        # Risk-free rate over the tails, with room for its own rolling window
+        lookback_period = setup['Risk']['SharpeRatio']['LoopbackPeriod']
+        tail_start = min(states[symbol]['prices'].index[0] for symbol in tracked)
+        benchmark_idx = get_market_data(['^SPX', '^IRX'],
+                                        start_date=tail_start - relativedelta(days=2 * lookback_period),
+                                        end_date=end_date)
+        irx = benchmark_idx['^IRX']
+
+        # Tails covering the same days are advanced together as one panel
+        groups = defaultdict(list)
+        for symbol in tracked:
+            tail = states[symbol]['prices']
+            if new_data.index[-1] > tail.index[-1]:
+                groups[(tail.index[0], tail.index[-1])].append(symbol)
+
+        for group in groups.values():
+            new_states, new_errors = advance_signal_states({symbol: states[symbol] for symbol in group}, new_data,
+                                                           irx, setup)
+            states.update(new_states)
+            errors.update(new_errors)
+
+    for symbol in symbols:
+
+        if symbol in errors:
+            logger.error(f"{symbol} - {errors[symbol]}")
+            continue
+
+        state = states[symbol]
+        if state is None:
+            continue
+
+        # Drop the signals that left the reported period
+        if state['signals'] is not None and start_date is not None:
+            state['signals'] = state['signals'][state['signals'].index >= start_date]
+            if state['signals'].empty:
+                state['signals'] = None
+
+        write_signal_state(symbol, state, state_path)
+
+        if state['signals'] is not None:
+            if compact:
+                full_nbytes += get_frames_nbytes([state['signals']])
+                signal_data[symbol] = compact_signal_frame(state['signals'], setup)
+            else:
+                signal_data[symbol] = state['signals']
+
+        # Break loop if limit is exceeded
+        limit -= 1
+        if limit == 0:
+            break
+
+    if compact:
+        log_compact_footprint(full_nbytes, signal_data)
+
+    return signal_data
+
+
+def init_signal_states(symbols, missing, setup, start_date, end_date):
+    """Run the full pipeline for the symbols without a state.
+
+    Returns:
+        tuple: (states, errors) keyed by symbol.
+    """
+
+    analysis_start_date, analysis_end_date = get_stock_selection_dates(start_date, end_date, setup=setup)
+
+    # The panel of the whole universe, so the missing symbols get the calendar the others have
+    price_panel = fetch_price_panel(symbols, start_date=analysis_start_date, end_date=analysis_end_date)
+    benchmark_idx = get_market_data(['^SPX', '^IRX'],
+                                    start_date=analysis_start_date,
+                                    end_date=analysis_end_date)
+
+    missing = [symbol for symbol in missing if symbol in price_panel]
+    if not missing:
+        return {}, {}
+
+    prices = {field: matrix[missing]
+              for field, matrix in get_price_matrices(price_panel, analysis_start_date, analysis_end_date).items()}
+    signal_panel = compute_signal_panel(prices, benchmark_idx['^IRX'], setup, start_date)
+
+    return collect_signal_states(prices, signal_panel, setup)
+
+
+def advance_signal_states(states, new_data, irx, setup):
+    """
+    Run the panel engine over the kept tails and the new bars only.
+
+    The tails must cover the same days. The recursive indicators continue from the seeds of
+    their first row; every other indicator only looks get_signal_window rows back, so from that
+    row on the tails give the values a run over the whole history gives.
+
+    Returns:
+        tuple: (states after the new bars with their signals appended, errors) keyed by symbol.
+    """
+
+    symbols = list(states)
+    last_date = states[symbols[0]]['prices'].index[-1]
+    new_index = new_data.index[new_data.index > last_date]
+
+    prices = {}
+    for field in PRICE_FIELDS:
+        tails = pd.DataFrame({symbol: states[symbol]['prices'][field] for symbol in symbols})
+        new_bars = new_data.xs(field, axis=1, level='Price').reindex(index=new_index, columns=symbols)
+        prices[field] = pd.concat([tails, new_bars])
+
+    seeds = {key: pd.Series([states[symbol]['seeds'][key] for symbol in symbols], index=symbols)
+             for key in states[symbols[0]]['seeds']}
+
+    start_date = prices['Close'].index[get_signal_window(setup)]
+    signal_panel = compute_signal_panel(prices, irx, setup, start_date, seeds=seeds)
+
+    return collect_signal_states(prices, signal_panel, setup, seeds, states)
+
+
+def collect_signal_states(prices, signal_panel, setup, seeds=None, previous=None):
+    """
+    Split a panel run into the state of each symbol: the tail of prices the next run needs, the
+    recursive indicators at its first row and the signals, appended to the previous ones.
+
+    The tail starts on the last observed close at least get_signal_window rows before the end,
+    since the EMA recursion can only restart from a row that had an observation.
+
+    Returns:
+        tuple: (states, errors) keyed by symbol.
+    """
+
+    states = {}
+    errors = dict(signal_panel.errors)
+
+    window = get_signal_window(setup)
+    close = prices['Close']
+
+    observed = close.notna().to_numpy()
+    observed[max(len(close) - window, 0):] = False
+    rows = len(close) - 1 - np.argmax(observed[::-1], axis=0)
+
+    seed_matrices = get_indicator_seeds(prices, setup, seeds)
+
+    for i, symbol in enumerate(close.columns):
+
+        if symbol in errors:
+            continue
+        if not observed[:, i].any():
+            errors[symbol] = "Not enough history to keep an indicator state"
+            continue
+
+        row = rows[i]
+        signals = signal_panel.get_frame(symbol)
+
+        if previous is not None:
+            # The tail overlaps the rows reported by earlier runs
+            signals = signals[signals.index > previous[symbol]['prices'].index[-1]]
+            if previous[symbol]['signals'] is not None:
+                signals = pd.concat([previous[symbol]['signals'], signals]) if not signals.empty \
+                    else previous[symbol]['signals']
+
+        states[symbol] = {
+            'prices': pd.DataFrame({field: prices[field].iloc[row:, i] for field in PRICE_FIELDS}),
+            'seeds': {key: float(matrix.iat[row, i]) for key, matrix in seed_matrices.items()},
+            'signals': signals if not signals.empty else None
+        }
+
+    return states, errors
+
+
+def get_indicator_seeds(prices, setup, seeds=None):
+    """Matrices of the recursive indicators the states keep, continuing from the seeds of the first row."""
+
+    close = prices['Close']
+    matrices = {}
+
+    for period in get_ema_periods(setup):
+        matrices[('ema', period)] = calculate_ema(close, period, get_seed(seeds, 'ema', period))
+
+    rsi = setup['Analysis']['Momentum']['rsi']
+    if rsi['enabled']:
+        period = rsi['period']
+        matrices[('rsi_gain', period)], matrices[('rsi_loss', period)] = calculate_rsi_averages(
+            close, period, get_seed(seeds, 'rsi_gain', period), get_seed(seeds, 'rsi_loss', period))
+
+    if setup['Analysis']['Volume']['OBV']['enabled']:
+        matrices[('obv',)] = calculate_on_balance_volume(close, prices['Volume'], get_seed(seeds, 'obv'))
+
+    return matrices
+
+
+def get_ema_periods(setup):
+    """Spans of every EMA of the close the enabled methods use."""
+
+    trend = setup['Analysis']['Trend']
+    periods = set()
+
+    if trend['long_term']['enabled'] and trend['long_term']['avg_type'] != "SMA":
+        periods.add(trend['long_term']['period'])
+    if trend['ma_cross']['enabled'] and trend['ma_cross']['avg_type'] == "ema":
+        periods.update([trend['ma_cross']['short'], trend['ma_cross']['long']])
+    if trend['macd']['enabled']:
+        periods.update([trend['macd']['short'], trend['macd']['long']])
+
+    return sorted(periods)
+
+
+def get_signal_window(setup):
+    """
+    Number of preceding rows the indicators of a row depend on, with the recursive ones seeded.
+
+    Windows nest (a slope of a moving average, a shifted rolling max, ...), so each term adds up
+    the windows of one indicator plus the row its crossing compares against.
+    """
+
+    windows = [
+        setup['Risk']['SharpeRatio']['LoopbackPeriod'] + 1,
+        setup['Risk']['SortinoRatio']['LoopbackPeriod'] + 2,
+        # RSI, OBV and crossings of seeded EMAs only look one row back
+        2
+    ]
+
+    for ma_setup in setup['Filters']['Trend'].values():
+        if ma_setup['enabled']:
+            period = max(ma_setup.get('period', 0), ma_setup.get('period_short', 0), ma_setup.get('period_long', 0))
+            windows.append(period + ma_setup['slope_period'])
+
+    adx = setup['Filters']['Momentum']['adx']
+    if adx['enabled']:
+        windows.append(2 * adx['period'] + 1)
+
+    trend = setup['Analysis']['Trend']
+    if trend['stochastic']['enabled']:
+        windows.append(trend['stochastic']['period'] + trend['stochastic']['smooth_k'] + trend['stochastic']['smooth_d'])
+    if trend['long_term']['enabled']:
+        windows.append(trend['long_term']['period'] + 1)
+    if trend['ma_cross']['enabled']:
+        windows.append(trend['ma_cross']['long'] + 1)
+    if trend['bollinger_bands']['enabled']:
+        windows.append(trend['bollinger_bands']['period'] + 1)
+    if trend['week_rule']['enabled']:
+        windows.append(trend['week_rule']['period'] * 5 + 1)
+    if trend['macd']['enabled']:
+        windows.append(trend['macd']['signal_window'] + 1)
+
+    return max(windows)
+
+
+def get_state_file(symbol, state_path):
+    return os.path.join(state_path, f"{symbol.replace('/', '_')}.pkl")
+
+
+def read_signal_state(symbol, state_path):
+
+    path = get_state_file(symbol, state_path)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError) as e:
+        logger.warning(f"{symbol} - Ignoring unreadable indicator state {path} - {str(e)}")
+        return None
+
+
+def write_signal_state(symbol, state, state_path):
+
+    create_directories_if_not_exist(state_path)
+    path = get_state_file(symbol, state_path)
+
+    # Write to a temporary file first, so an interrupted run never leaves a partial state
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
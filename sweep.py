@@ -0,0 +1,202 @@
+import copy
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+
+from constants import HOLD
+from data_providers import configure_data_provider
+from indicator_cache import IndicatorCache, configure_indicator_cache
+from market_data import get_market_data
+from panel_indicators import get_price_matrices, compute_signal_panel
+from portfolio_manager import backtest_signals, calculate_trade_metrics, calculate_ticker_gain, calculate_equity_curve
+from price_panel import fetch_price_panel, open_price_panel
+from risk import calculate_risk_filter
+from utils.argument_parsing import sweep_argument_parsing
+from utils.logging_config import logger
+from utils.utils import get_ticker_list, get_stock_selection_dates
+
+pd.options.mode.chained_assignment = None
+
+
+def main():
+
+    args = sweep_argument_parsing()
+    configure_data_provider(args.provider, data_dir=args.data_dir)
+
+    keys, combinations = get_combinations(args.grid)
+
+    try:
+        setups = [set_parameters(args.setup, keys, values) for values in combinations]
+    except KeyError as e:
+        logger.error(f"Invalid parameter grid - {e}")
+        return
+
+    # Combinations with the same warm-up period share their indicators, so keep them next to each other
+    analysis_start_dates = [get_stock_selection_dates(args.start_date, args.end_date, setup=setup)[0]
+                            for setup in setups]
+    order = sorted(range(len(combinations)), key=lambda i: analysis_start_dates[i])
+    combinations = [combinations[i] for i in order]
+
+    print(f"--------------------------------------------------------\n"
+          f"Sweeping {len(combinations)} combinations of {', '.join(keys)}\n"
+          f"--------------------------------------------------------\n")
+
+    analysis_start_date = min(analysis_start_dates)
+    price_panel = fetch_price_panel(get_ticker_list(args.input), start_date=analysis_start_date,
+                                    end_date=args.end_date)
+
+    # Get 3Mo Treasury bills data as risk free rate
+    benchmark_idx = get_market_data(['^SPX', '^IRX'], start_date=analysis_start_date, end_date=args.end_date)
+
+    try:
+        benchmark = calculate_ticker_gain('^SPX', args.start_date, args.end_date)
+    except ValueError as e:
+        logger.warning(str(e))
+        benchmark = None
+
+    context = (price_panel.path, benchmark_idx['^IRX'], args.setup, keys, args.start_date, args.end_date, args.limit,
+               benchmark, args.cache_size * 1024 ** 2)
+
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=init_sweep_worker, initargs=context)
+        chunksize = max(1, len(combinations) // (args.workers * 4))
+        results = executor.map(run_combination, combinations, chunksize=chunksize)
+    else:
+        executor = None
+        init_sweep_worker(*context)
+        results = map(run_combination, combinations)
+
+    rows = []
+    for values, metrics, error in results:
+        if error is not None:
+            logger.error(f"{dict(zip(keys, values))} - {error}")
+            continue
+        rows.append({**dict(zip(keys, values)), **metrics})
+
+    if executor is not None:
+        executor.shutdown()
+
+    if not rows:
+        logger.error("No combination could be backtested")
+        return
+
+    ranking = pd.DataFrame(rows).drop(columns='benchmark', errors='ignore')
+    ranking = ranking.sort_values(args.sort, ascending=args.ascending, kind='stable')
+
+    if args.output:
+        ranking.to_csv(args.output, index=False)
+
+    print(f"Benchmark: {benchmark}")
+    print(tabulate(ranking.head(args.top).to_dict('records'), headers='keys', tablefmt="grid", floatfmt=".2f"))
+
+
+def get_combinations(grid):
+    """Grid keys and the cartesian product of their values, the last key varying fastest."""
+
+    keys = list(grid.keys())
+    return keys, list(itertools.product(*[get_grid_values(grid[key]) for key in keys]))
+
+
+def get_grid_values(spec):
+    """Values of a grid entry, either listed or given as an inclusive {start, stop, step} range."""
+
+    if isinstance(spec, dict):
+        count = int(round((spec['stop'] - spec['start']) / spec['step'])) + 1
+        values = [spec['start'] + i * spec['step'] for i in range(count)]
+        return [round(value, 10) if isinstance(value, float) else value for value in values]
+    return list(spec)
+
+
+def set_parameters(setup, keys, values):
+    """Copy of the setup with each dotted path of keys set to its value."""
+
+    setup = copy.deepcopy(setup)
+    for key, value in zip(keys, values):
+        *path, name = key.split('.')
+        node = setup
+        for part in path:
+            node = node[part]
+        if name not in node:
+            raise KeyError(f"{key} is not a setup parameter")
+        node[name] = value
+    return setup
+
+
+# Per process state of sweep workers, sent once by the pool initializer instead of with every task
+_worker_context = None
+
+
+def init_sweep_worker(panel_path, irx, setup, keys, start_date, end_date, limit, benchmark, cache_size):
+    global _worker_context
+
+    # Combinations share indicators through the worker cache below, keyed by parameters only, so the
+    # indicator functions do not need to hash the price matrices to memoize them as well
+    configure_indicator_cache(0)
+
+    _worker_context = {
+        'price_panel': open_price_panel(panel_path), 'irx': irx, 'setup': setup, 'keys': keys,
+        'start_date': start_date, 'end_date': end_date, 'limit': limit, 'benchmark': benchmark,
+        'cache': IndicatorCache(cache_size), 'analysis_start_date': None
+    }
+
+
+def run_combination(values):
+    """Backtest the base setup with the grid parameters set to values, returning ``(values, metrics, error)``."""
+
+    context = _worker_context
+    setup = set_parameters(context['setup'], context['keys'], values)
+    analysis_start_date, analysis_end_date = get_stock_selection_dates(context['start_date'], context['end_date'],
+                                                                       setup=setup)
+
+    # Indicators depend on where their history starts, so they are only reused within the same warm-up period
+    if analysis_start_date != context['analysis_start_date']:
+        context['analysis_start_date'] = analysis_start_date
+        context['prices'] = get_price_matrices(context['price_panel'], analysis_start_date, analysis_end_date)
+        context['close'] = context['prices']['Close'].loc[context['start_date']:]
+        context['risk_free'] = context['irx'][context['irx'].index >= analysis_start_date]
+        context['cache'].clear()
+
+    try:
+        signal_panel = compute_signal_panel(context['prices'], context['risk_free'], setup, context['start_date'],
+                                            cache=context['cache'])
+        trades = backtest_signal_panel(signal_panel, setup, context['limit'])
+        equity_curve = calculate_equity_curve(trades, context['close'], setup['Portfolio']['cash'])
+        metrics = calculate_trade_metrics(trades, context['benchmark'], setup, print_trades=False,
+                                          equity_curve=equity_curve)
+    except ValueError as e:
+        return values, None, str(e)
+    finally:
+        context['cache'].trim()
+
+    return values, metrics, None
+
+
+def backtest_signal_panel(signal_panel, setup, limit):
+    """
+    Backtest the panel signals that pass the risk filters, as main.py does with its ticker frames.
+
+    Only the first `limit` symbols without errors take part, like in get_stock_signals.
+    """
+
+    symbols = [symbol for symbol in signal_panel.symbols if symbol not in signal_panel.errors]
+    if limit > 0:
+        symbols = symbols[:limit]
+    columns = [signal_panel.symbol_index[symbol] for symbol in symbols]
+
+    actions = signal_panel['Action'].to_numpy()[:, columns]
+    prices = signal_panel['Close'].to_numpy()[:, columns]
+    keep = (signal_panel.valid.to_numpy()[:, columns] & (actions != HOLD) &
+            calculate_risk_filter(signal_panel, setup).to_numpy()[:, columns])
+
+    # Symbol by symbol, as the signal frames are concatenated by portfolio_manager
+    symbol_ids, days = np.nonzero(keep.T)
+
+    return backtest_signals(symbols, signal_panel.dates.values[days], symbol_ids, actions[days, symbol_ids],
+                            prices[days, symbol_ids], setup)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import zlib
+
+import numpy as np
+import pandas as pd
+
+# Every path starts here, so a symbol has the same prices on a given day whatever range is requested
+ORIGIN_DATE = pd.Timestamp('1990-01-01')
+
+# Every path is scaled to its initial price on this day, as decades of drift from the origin take prices far
+# from any realistic level
+ANCHOR_DATE = pd.Timestamp('2020-01-01')
+
+# Yahoo symbols quoting an annual rate in percent instead of a price
+RATE_SYMBOLS = ['^IRX', '^FVX', '^TNX', '^TYX']
+
+TRADING_DAYS = 252
+
+
+def generate_stock_data(stock_list, start_date, end_date, seed=0, drift=0.08, volatility=0.3):
+    """
+    Synthetic OHLCV of the given symbols over the business days of ``[start_date, end_date)``.
+
+    Closes follow a geometric Brownian motion of annual drift and volatility drawn around the
+    given ones per symbol, opens gap from the previous close, highs and lows extend the open-close
+    range by a fraction of the daily volatility and volume grows with the size of the move. Rate
+    symbols (^IRX and other treasury yields) follow a mean reverting rate in percent instead.
+
+    Each symbol is seeded by seed and its name, and each of its series drawn from its own stream,
+    so the same symbol gets the same prices in any list and any date range. Prices are drawn from
+    ORIGIN_DATE and scaled to the initial price of the symbol on ANCHOR_DATE, so they stay within
+    a realistic range in the years around it.
+
+    Returns:
+        pandas.DataFrame: Frame in the ``yf.download(group_by='ticker')`` layout.
+    """
+
+    start = max(pd.Timestamp(start_date).normalize(), ORIGIN_DATE)
+    end = pd.Timestamp(end_date)
+    # Paths always reach ANCHOR_DATE, so their scale does not depend on the requested range
+    dates = pd.bdate_range(ORIGIN_DATE, max(end, ANCHOR_DATE + pd.Timedelta(days=1)), inclusive='left', name='Date')
+
+    frames = {}
+    for symbol in dict.fromkeys(stock_list):
+        streams = [np.random.default_rng(sequence)
+                   for sequence in np.random.SeedSequence([seed, zlib.crc32(symbol.encode('utf-8'))]).spawn(6)]
+        if symbol in RATE_SYMBOLS:
+            symbol_data = generate_rate_data(streams, dates)
+        else:
+            symbol_data = generate_price_data(streams, dates, drift, volatility)
+        frames[symbol] = symbol_data[(symbol_data.index >= start) & (symbol_data.index < end)]
+
+    stock_data = pd.concat(frames, axis=1)
+    stock_data.columns.names = ['Ticker', 'Price']
+
+    return stock_data
+
+
+def generate_price_data(streams, dates, drift, volatility):
+
+    days = len(dates)
+    params, returns_rng, gap_rng, high_rng, low_rng, volume_rng = streams
+
+    # Per symbol drift, volatility, price and volume level, so the universe is not made of identical walks
+    sigma = volatility * params.uniform(0.5, 1.5) / np.sqrt(TRADING_DAYS)
+    mu = params.normal(drift, volatility / 2) / TRADING_DAYS - sigma ** 2 / 2
+    price, average_volume = params.uniform(10, 500), params.uniform(1e5, 1e7)
+
+    returns = returns_rng.normal(mu, sigma, days)
+    level = np.exp(np.cumsum(returns))
+    scale = price / level[dates.searchsorted(ANCHOR_DATE)]
+    close = scale * level
+
+    # Part of each move happens overnight
+    open_ = np.concatenate([[scale], close[:-1]]) * np.exp(gap_rng.normal(0, sigma / 3, days))
+
+    high = np.maximum(open_, close) * np.exp(np.abs(high_rng.normal(0, sigma / 2, days)))
+    low = np.minimum(open_, close) * np.exp(-np.abs(low_rng.normal(0, sigma / 2, days)))
+
+    volume = np.round(average_volume * volume_rng.lognormal(0, 0.3, days) * (1 + np.abs(returns) / sigma))
+
+    return pd.DataFrame({'Open': open_, 'High': high, 'Low': low, 'Close': close, 'Volume': volume}, index=dates)
+
+
+def generate_rate_data(streams, dates):
+
+    days = len(dates)
+    params, shock_rng, range_rng = streams[:3]
+
+    # Ornstein-Uhlenbeck rate around a long term mean, floored at zero
+    mean, reversion, sigma = params.uniform(1, 5), 0.01, 0.05
+    shocks = shock_rng.normal(0, sigma, days)
+    rate = np.empty(days)
+    rate[0] = mean
+    for day in range(1, days):
+        rate[day] = max(rate[day - 1] + reversion * (mean - rate[day - 1]) + shocks[day], 0.0)
+
+    spread = np.abs(range_rng.normal(0, sigma / 2, days))
+
+    return pd.DataFrame({'Open': rate, 'High': rate + spread, 'Low': np.maximum(rate - spread, 0.0), 'Close': rate,
+                         'Volume': np.zeros(days)}, index=dates)
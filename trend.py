@@ -1,17 +1,38 @@
 import numpy as np
-import talib
-from scipy import stats
+import pandas as pd
 from constants import *
+from indicator_cache import memoize_indicator
+from utils.profiling import profiled
 
 
-def calculate_ema(data, period=14):
+@memoize_indicator
+def calculate_ema(data, period=14, seed=None):
+    """
+    Exponential moving average, optionally continued from a known value.
+
+    Parameters:
+    - data: Series, or DataFrame of days x symbols to compute every symbol at once
+    - period: int, EMA span
+    - seed: EMA value at the first row, carried over from an earlier computation; for a DataFrame,
+      a Series with one value per column in column order. The first row must be an observed
+      value, which restarts the ewm weights exactly as the full history does.
+
+    Returns:
+    - Series or DataFrame: EMA with the shape of data
+    """
+    if seed is not None:
+        data = data.copy()
+        data.iloc[0] = np.asarray(seed, dtype=float)
+
     return data.ewm(span=period, adjust=False).mean()
 
 
+@memoize_indicator
 def calculate_sma(data, window=5):
     return data.rolling(window=window).mean()
 
 
+@profiled
 def detect_long_term_crossings(stock_data, setup, end_date, backtest=False):
 
     if not setup['Analysis']['Trend']['long_term']['enabled']:
@@ -27,20 +48,7 @@ def detect_long_term_crossings(stock_data, setup, end_date, backtest=False):
     else:
         stock_data[f"LT_MA"] = calculate_ema(stock_data['Close'], period)
 
-    stock_data[f"Prev_Close"] = stock_data[f"Close"].shift(1)
-    stock_data[f"Prev_LT_MA"] = stock_data[f"LT_MA"].shift(1)
-
-    stock_data[f"{method}_Cross"] = np.where(
-        (stock_data[f"Prev_Close"] <= stock_data[f"Prev_LT_MA"]) &
-        (stock_data[f"Close"] > stock_data[f"LT_MA"]), BUY,
-        np.where(
-            (stock_data[f"Prev_Close"] >= stock_data[f"Prev_LT_MA"]) & (
-                    stock_data[f"Close"] < stock_data[f"LT_MA"]), SELL,
-            HOLD
-        )
-    )
-
-    stock_data.drop(columns=['Prev_Close', 'Prev_LT_MA'], inplace=True)
+    stock_data[f"{method}_Cross"] = calculate_crossing_signal(stock_data['Close'], stock_data[f"LT_MA"])
 
     """
     # Add a Date column and filter rows with crossings
@@ -60,6 +68,7 @@ def detect_long_term_crossings(stock_data, setup, end_date, backtest=False):
     """
 
 
+@profiled
 def detect_ma_crossings(stock_data, setup, end_date, backtest=False):
     """Detect days where SMA crosses."""
 
@@ -80,19 +89,7 @@ def detect_ma_crossings(stock_data, setup, end_date, backtest=False):
         stock_data[f"Cross_Long"] = calculate_ema(stock_data['Close'], long_window)
 
     # Identify crossing points
-    stock_data[f"Prev_Cross_Short"] = stock_data[f"Cross_Short"].shift(1)
-    stock_data[f"Prev_Cross_Long"] = stock_data[f"Cross_Long"].shift(1)
-
-    stock_data[f"{method}_Cross"] = np.where(
-        (stock_data[f"Prev_Cross_Short"] <= stock_data[f"Prev_Cross_Long"]) &
-        (stock_data[f"Cross_Short"] > stock_data[f"Cross_Long"]), BUY,
-        np.where(
-            (stock_data[f"Prev_Cross_Short"] >= stock_data[f"Prev_Cross_Long"])
-            & (stock_data[f"Cross_Short"] < stock_data[f"Cross_Long"]), SELL, HOLD
-        )
-    )
-
-    stock_data.drop(columns=['Prev_Cross_Short', 'Prev_Cross_Long'], inplace=True)
+    stock_data[f"{method}_Cross"] = calculate_crossing_signal(stock_data[f"Cross_Short"], stock_data[f"Cross_Long"])
 
     """
     # Add a Date column and filter rows with crossings
@@ -112,6 +109,7 @@ def detect_ma_crossings(stock_data, setup, end_date, backtest=False):
     """
 
 
+@profiled
 def detect_bollinger_crossings(stock_data, setup, end_date, backtest=False):
 
     method = "bollinger_bands"
@@ -122,25 +120,8 @@ def detect_bollinger_crossings(stock_data, setup, end_date, backtest=False):
     std_dev = setup['Analysis']['Trend'][method]['std_dev']
     output_window = setup['Analysis']['Trend'][method]['output_window']
 
-    stock_data[f"BB"] = stock_data['Close'].rolling(window=period).mean()
-    stock_data['StdDev'] = stock_data['Close'].rolling(window=period).std()
-    stock_data['Upper_Band'] = stock_data[f"BB"] + (std_dev * stock_data['StdDev'])
-    stock_data['Lower_Band'] = stock_data[f"BB"] - (std_dev * stock_data['StdDev'])
-
-    stock_data['Prev_Close'] = stock_data['Close'].shift(1)
-    stock_data['Prev_Lower_Band'] = stock_data['Lower_Band'].shift(1)
-    stock_data['Prev_Upper_Band'] = stock_data['Upper_Band'].shift(1)
-
-    stock_data[f"{method}_Cross"] = HOLD
-    stock_data.loc[
-        (stock_data['Close'] <= stock_data['Lower_Band']) &
-        (stock_data['Prev_Close'] > stock_data['Prev_Lower_Band']), f"{method}_Cross"] = BUY
-    stock_data.loc[
-        (stock_data['Close'] >= stock_data['Upper_Band']) &
-        (stock_data['Prev_Close'] < stock_data['Prev_Upper_Band']), f"{method}_Cross"] = SELL
-
-    stock_data.drop(columns=['Upper_Band', 'Lower_Band', 'BB', 'Prev_Close', 'Prev_Lower_Band', 'Prev_Upper_Band'],
-                    inplace=True)
+    stock_data['StdDev'], stock_data[f"{method}_Cross"] = calculate_bollinger_signal(stock_data['Close'], period,
+                                                                                     std_dev)
 
     """
     # Detect touches
@@ -160,6 +141,7 @@ def detect_bollinger_crossings(stock_data, setup, end_date, backtest=False):
     """
 
 
+@profiled
 def detect_wr_crossings(stock_data, setup, end_date, backtest=False):
 
     method = "week_rule"
@@ -168,16 +150,8 @@ def detect_wr_crossings(stock_data, setup, end_date, backtest=False):
 
     period = setup['Analysis']['Trend'][method]['period']
 
-    # Calculate prior 4-week highs and lows (shifted by 1 day)
-    stock_data[f"W_High"] = stock_data['High'].rolling(window=period * 5).max().shift(1)
-    stock_data[f"W_Low"] = stock_data['Low'].rolling(window=period * 5).min().shift(1)
-
-    # Detect touches
-    stock_data['WR_Cross'] = stock_data.apply(
-        lambda row: BUY if row['Close'] > row[f"W_High"] else (
-            SELL if row['Close'] >= row[f"W_Low"] else 0), axis=1)
-
-    stock_data.drop(columns=['W_High', 'W_Low'], inplace=True)
+    stock_data['WR_Cross'] = calculate_week_rule_signal(stock_data['Close'], stock_data['High'],
+                                                        stock_data['Low'], period)
 
     """
     crossings = stock_data[stock_data[f"{method}_Cross"] != HOLD]
@@ -197,6 +171,98 @@ def detect_wr_crossings(stock_data, setup, end_date, backtest=False):
     """
 
 
+@memoize_indicator
+def calculate_crossing_signal(fast, slow):
+    """
+    BUY where `fast` crosses above `slow`, SELL where it crosses below, HOLD otherwise.
+
+    Parameters:
+    - fast, slow: Series, or DataFrames of days x symbols to evaluate every symbol at once
+
+    Returns:
+    - Series or DataFrame: BUY, SELL or HOLD for each day
+    """
+    prev_fast = fast.shift(1)
+    prev_slow = slow.shift(1)
+
+    signal = np.where(
+        (prev_fast <= prev_slow) & (fast > slow), BUY,
+        np.where(
+            (prev_fast >= prev_slow) & (fast < slow), SELL, HOLD
+        )
+    )
+
+    return _like(fast, signal)
+
+
+@memoize_indicator
+def calculate_bollinger_signal(close, period, std_dev):
+    """
+    Bollinger Bands touches: BUY when the close reaches the lower band from above, SELL when it
+    reaches the upper band from below.
+
+    Parameters:
+    - close: Series, or DataFrame of days x symbols to evaluate every symbol at once
+    - period: int, moving average period
+    - std_dev: float, band width in standard deviations
+
+    Returns:
+    - tuple: (rolling standard deviation, BUY/SELL/HOLD signal)
+    """
+    middle_band = calculate_sma(close, period)
+    std = close.rolling(window=period).std()
+    upper_band = middle_band + (std_dev * std)
+    lower_band = middle_band - (std_dev * std)
+
+    prev_close = close.shift(1)
+    buy = (close <= lower_band) & (prev_close > lower_band.shift(1))
+    sell = (close >= upper_band) & (prev_close < upper_band.shift(1))
+
+    return std, _like(close, np.where(sell, SELL, np.where(buy, BUY, HOLD)))
+
+
+@memoize_indicator
+def calculate_macd(close, short_window, long_window, signal_window, short_seed=None, long_seed=None):
+    """
+    MACD line and its signal line, the SMA of the MACD line.
+
+    Parameters:
+    - close: Series, or DataFrame of days x symbols to compute every symbol at once
+    - short_window, long_window: int, EMA spans
+    - signal_window: int, signal line period
+    - short_seed, long_seed: optional EMA values at the first row, see calculate_ema
+
+    Returns:
+    - tuple: (MACD line, signal line)
+    """
+    macd = calculate_ema(close, short_window, short_seed) - calculate_ema(close, long_window, long_seed)
+
+    return macd, macd.rolling(window=signal_window).mean()
+
+
+@memoize_indicator
+def calculate_week_rule_signal(close, high, low, period):
+    """
+    Week rule signal from the highs and lows of the prior `period` weeks.
+
+    Parameters:
+    - close, high, low: Series, or DataFrames of days x symbols to evaluate every symbol at once
+    - period: int, number of weeks
+
+    Returns:
+    - Series or DataFrame: BUY, SELL or HOLD for each day
+    """
+    # Calculate prior 4-week highs and lows (shifted by 1 day)
+    week_high = high.rolling(window=period * 5).max().shift(1)
+    week_low = low.rolling(window=period * 5).min().shift(1)
+
+    # Detect touches
+    signal = np.select([close > week_high, close >= week_low], [BUY, SELL], default=HOLD)
+
+    return _like(close, signal)
+
+
+@profiled
 def detect_macd_trend(stock_data, setup, end_date, backtest=False):
     """
         Calculate MACD and Signal Line using SMA instead of EMA.
@@ -211,30 +277,12 @@ def detect_macd_trend(stock_data, setup, end_date, backtest=False):
     signal_window = setup['Analysis']['Trend'][method]['signal_window']
     output_window = setup['Analysis']['Trend'][method]['output_window']
 
-    stock_data[f"EMA_short"] = stock_data['Close'].ewm(span=short_window, adjust=False).mean()
-    stock_data[f"EMA_long"] = stock_data['Close'].ewm(span=long_window, adjust=False).mean()
-
-    stock_data[f"MACD_short_long"] = stock_data[f"EMA_short"] - stock_data[f"EMA_long"]
-
-    stock_data[f"MACD_SIGNAL"] = stock_data[f"MACD_short_long"].rolling(window=signal_window).mean()
-
-    stock_data[f"MACD_Prev_short_long"] = stock_data[f"MACD_short_long"].shift(1)
-    stock_data[f"MACD_Prev_SIGNAL"] = stock_data[f"MACD_SIGNAL"].shift(1)
+    stock_data[f"MACD_short_long"], stock_data[f"MACD_SIGNAL"] = calculate_macd(stock_data['Close'], short_window,
+                                                                                long_window, signal_window)
 
     # Identify crossing points
-    stock_data[f"{method}_Cross"] = np.where(
-        (stock_data[f"MACD_Prev_short_long"] <= stock_data[f"MACD_Prev_SIGNAL"]) &
-        (stock_data[f"MACD_short_long"] > stock_data[f"MACD_SIGNAL"]),
-        BUY,
-        np.where(
-            (stock_data[f"MACD_Prev_short_long"] >= stock_data[f"MACD_Prev_SIGNAL"]) &
-            (stock_data[f"MACD_short_long"] < stock_data[f"MACD_SIGNAL"]),
-            SELL,
-            HOLD
-        )
-    )
-
-    stock_data.drop(columns=['MACD_Prev_short_long', 'MACD_Prev_SIGNAL', 'EMA_short', 'EMA_long'], inplace=True)
+    stock_data[f"{method}_Cross"] = calculate_crossing_signal(stock_data[f"MACD_short_long"],
+                                                              stock_data[f"MACD_SIGNAL"])
 
 
     """
@@ -271,47 +319,89 @@ def calculate_ma_slope(stock_data, ma_period, slope_period, moving_average_type)
     - pandas.Series: Slope of the moving average for each period
     """
     # Calculate moving averages
-    stock_data[f"MA_{moving_average_type}"] = stock_data['Close'].rolling(window=ma_period).mean()
+    stock_data[f"MA_{moving_average_type}"] = calculate_sma(stock_data['Close'], ma_period)
 
     # Calculate slope using linear regression for each window of 'slope_period'
-    def slope_calc(window):
-        if len(window) == slope_period:
-            x = np.arange(slope_period)
-            slope, _, _, _, _ = stats.linregress(x, window)
-            return slope
-        return np.nan
+    stock_data[f"MA_Slope_{moving_average_type}"] = calculate_rolling_slope(
+        stock_data[f"MA_{moving_average_type}"], slope_period)
+
+
+@memoize_indicator
+def calculate_rolling_slope(data, window):
+    """
+    Rolling least squares slope of the data against x = 0, 1, ..., window - 1.
+
+    With a fixed x grid the slope is sum((x - mean(x)) * y) / sum((x - mean(x)) ** 2), and
+    sum(x * y) follows from rolling sums of y and of position * y, so no window is regressed
+    one at a time. Windows holding a NaN give NaN, as linregress does.
+
+    Parameters:
+    - data: Series, or DataFrame of days x symbols to compute every column at once
+    - window: int, number of points in each regression
+
+    Returns:
+    - Series or DataFrame: Slope of each window, aligned to its last row
+    """
+    position = np.arange(len(data), dtype=float)
+    x_mean = (window - 1) / 2
+    x_square_sum = window * (window ** 2 - 1) / 12
+
+    sum_y = data.rolling(window=window).sum()
+    sum_position_y = data.mul(position, axis=0).rolling(window=window).sum()
+
+    # Inside each window x = position - first position of the window
+    sum_xy = sum_position_y - sum_y.mul(position - window + 1, axis=0)
 
-    # Apply slope calculation to each moving average window
-    stock_data[f"MA_Slope_{moving_average_type}"] = stock_data[f"MA_{moving_average_type}"].rolling(
-        window=slope_period).apply(slope_calc, raw=False)
+    return (sum_xy - x_mean * sum_y) / x_square_sum
 
 
+@profiled
 def calculate_obv(stock_data, setup):
 
     if not setup['Analysis']['Volume']['OBV']['enabled']:
         return
 
-    # Calculate OBV
-    obv = [0]
+    # Add OBV to the dataframe
+    stock_data['OBV'] = calculate_on_balance_volume(stock_data['Close'], stock_data['Volume'])
 
-    for i in range(1, len(stock_data)):
-        close = stock_data['Close'].iloc[i]
-        prev_close = stock_data['Close'].iloc[i - 1]
-        volume = stock_data['Volume'].iloc[i]
+    return stock_data
 
-        if close > prev_close:
-            obv.append(obv[-1] + volume)
-        elif close < prev_close:
-            obv.append(obv[-1] - volume)
-        else:
-            obv.append(obv[-1])  # If price unchanged, OBV remains the same
 
-    # Add OBV to the dataframe
-    stock_data['OBV'] = obv
+@memoize_indicator
+def calculate_on_balance_volume(close, volume, seed=None):
+    """
+    On-balance volume as the cumulative sum of the volume signed by the close change.
 
-    return stock_data
+    Volume is added on up days, subtracted on down days and ignored when the price is
+    unchanged. OBV starts at 0 on the first day, or at `seed` when continuing an earlier run.
+
+    Parameters:
+    - close, volume: Series, or DataFrames of days x symbols to compute every symbol at once
+    - seed: optional OBV at the first row, one value per column for DataFrames
+
+    Returns:
+    - Series or DataFrame: OBV for each day
+    """
+    close_values = close.to_numpy(dtype=float)
+    volume_values = volume.to_numpy(dtype=float)
 
+    change = np.diff(close_values, axis=0)
+    signed_volume = np.where(change > 0, volume_values[1:], np.where(change < 0, -volume_values[1:], 0.0))
 
+    first = np.zeros_like(close_values[:1]) if seed is None else np.full_like(close_values[:1], seed)
+    obv = np.cumsum(np.concatenate([first, signed_volume]), axis=0)
+
+    return _like(close, obv)
+
+
+def _like(data, values):
+    """Wrap an array computed from a Series or DataFrame with the same index and columns."""
+    if isinstance(data, pd.DataFrame):
+        return pd.DataFrame(values, index=data.index, columns=data.columns)
+    return pd.Series(values, index=data.index)
+
+
+@profiled
 def add_stochastic_oscillator(stock_data, setup):
 
     if not setup['Analysis']['Trend']['stochastic']['enabled']:
@@ -322,13 +412,30 @@ def add_stochastic_oscillator(stock_data, setup):
     smooth_d=setup['Analysis']['Trend']['stochastic']['smooth_d']
 
     """Calculate the Stochastic Oscillator (%K and %D)."""
-    stock_data['Stoch_Low_Min'] = stock_data['Low'].rolling(window=period).min()
-    stock_data['Stoch_High_Max'] = stock_data['High'].rolling(window=period).max()
-    stock_data['Stoch_%K'] = ((stock_data['Close'] - stock_data['Stoch_Low_Min']) / (stock_data['Stoch_High_Max'] - stock_data['Stoch_Low_Min'])) * 100
-    stock_data['Stoch_%K'] = stock_data['Stoch_%K'].rolling(window=smooth_k).mean()  # Smooth %K
-    stock_data['Stoch_%D'] = stock_data['Stoch_%K'].rolling(window=smooth_d).mean()  # %D = SMA of %K
+    stock_data['Stoch_%K'], stock_data['Stoch_%D'] = calculate_stochastic_oscillator(
+        stock_data['High'], stock_data['Low'], stock_data['Close'], period, smooth_k, smooth_d)
+
+
+@memoize_indicator
+def calculate_stochastic_oscillator(high, low, close, period, smooth_k, smooth_d):
+    """
+    Smoothed %K and %D of the Stochastic Oscillator.
+
+    Parameters:
+    - high, low, close: Series, or DataFrames of days x symbols to compute every symbol at once
+    - period: int, lookback of the highest high and lowest low
+    - smooth_k, smooth_d: int, smoothing windows of %K and %D
+
+    Returns:
+    - tuple: (%K, %D)
+    """
+    low_min = low.rolling(window=period).min()
+    high_max = high.rolling(window=period).max()
+    stoch_k = ((close - low_min) / (high_max - low_min)) * 100
+    stoch_k = stoch_k.rolling(window=smooth_k).mean()  # Smooth %K
+    stoch_d = stoch_k.rolling(window=smooth_d).mean()  # %D = SMA of %K
 
-    stock_data.drop(columns=['Stoch_Low_Min', 'Stoch_High_Max'], inplace=True)
+    return stoch_k, stoch_d
 
 
 def detect_stochastic_crossings(stock_data):
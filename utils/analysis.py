@@ -1,110 +1,295 @@
 from momentum import add_adx, add_rsi
 import logging
-import talib
 from utils.logging_config import logger
-from risk import get_stop_data, add_shape_ratio, add_sortino_ratio
+from utils.profiling import profile_stage, profiled
+from risk import get_stop_data, add_shape_ratio, add_sortino_ratio, evaluate_positions
 from utils.utils import get_pre_analysis_period, store_filter_data, get_filter_data, get_ticker_list, \
     get_stock_selection_dates
-from data_aquisition import fetch_yahoo_stock_data
+from market_data import get_market_data
+from price_panel import fetch_price_panel, open_price_panel
+from panel_indicators import get_price_matrices, compute_signal_panel
+from indicator_cache import configure_indicator_cache, get_indicator_cache_config, indicator_symbol
 from dateutil.relativedelta import relativedelta
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from trend import *
 from datetime import datetime
+from pandas.tseries.offsets import BusinessDay
 from constants import Trade
 
 
-def get_stock_signals(stock_list, setup, limit, start_date=None, end_date=None):
+@profiled
+def get_stock_signals(stock_list, setup, limit, start_date=None, end_date=None, workers=1, engine='ticker',
+                      compact=False):
+    """Compute the BUY/SELL signals of every ticker in the list.
+
+    The 'ticker' engine runs the indicator pipeline ticker by ticker, optionally over `workers`
+    processes. The 'panel' engine computes each indicator once over the whole universe and only
+    materializes the per-ticker frames at the end. With compact, each frame is reduced by
+    compact_signal_frame as it arrives.
+
+    Returns:
+        dict: Ticker symbol to a DataFrame of its BUY and SELL rows.
+    """
 
     signal_data = {}
 
     # Compute extended dates to improve metrics calculation
     analysis_start_date, analysis_end_date = get_stock_selection_dates(start_date, end_date, setup=setup)
 
-    stock_data = fetch_yahoo_stock_data(get_ticker_list(stock_list),
-                                        start_date=analysis_start_date,
-                                        end_date=analysis_end_date)
+    price_panel = fetch_price_panel(get_ticker_list(stock_list),
+                                    start_date=analysis_start_date,
+                                    end_date=analysis_end_date)
 
     # Get SP500 and 3Mo Treasury bills data for benchmarks
-    benchmark_idx = fetch_yahoo_stock_data(['^SPX', '^IRX'],
-                                           start_date=analysis_start_date,
-                                           end_date=analysis_end_date)
+    benchmark_idx = get_market_data(['^SPX', '^IRX'],
+                                    start_date=analysis_start_date,
+                                    end_date=analysis_end_date)
 
     # Fetch VIX data
-    vix_idx = fetch_yahoo_stock_data(['^VIX'],
-                                           start_date=analysis_start_date,
-                                           end_date=analysis_end_date)
+    vix_idx = get_market_data(['^VIX'],
+                              start_date=analysis_start_date,
+                              end_date=analysis_end_date)
+
+    irx = benchmark_idx['^IRX']
+    context = (irx, setup, analysis_start_date, analysis_end_date, start_date, end_date)
+
+    if engine == 'panel':
+        executor = None
+        results = get_panel_ticker_signals(price_panel, *context)
+    elif workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=init_signal_worker,
+                                       initargs=(price_panel.path, get_indicator_cache_config(), *context))
+        chunksize = max(1, len(price_panel.symbols) // (workers * 4))
+        results = executor.map(get_worker_ticker_signals, price_panel.symbols, chunksize=chunksize)
+    else:
+        executor = None
+        results = (run_ticker_signals(price_panel, ticker, *context) for ticker in price_panel.symbols)
+
+    full_nbytes = 0
+
+    # Results arrive in symbol order, so limit applies to the same tickers as a serial run
+    for ticker, df, error in results:
+
+        if error is not None:
+            logger.error(f"{ticker} - {error}")
+            continue
 
-    for ticker in stock_data.columns.levels[0]:
-        # Extract data for this ticker into a new DataFrame
-        df = stock_data[ticker]
+        if df is not None:
+            if compact:
+                full_nbytes += get_frames_nbytes([df])
+                df = compact_signal_frame(df, setup)
+            signal_data[ticker] = df
 
-        # Add arithmetic return
-        df['daily_return'] = df['Close'].pct_change(fill_method=None)
+        # Break loop if limit is exceeded
+        limit -= 1
+        if limit == 0:
+            break
 
-        # Add VIX
-        #df['vix'] = vix_idx.Close
+    if executor is not None:
+        executor.shutdown(cancel_futures=True)
 
-        try:
-            # Add Sharpe Ratio
-            irx = benchmark_idx['^IRX']
-            add_shape_ratio(df, irx, setup)
+    if compact:
+        log_compact_footprint(full_nbytes, signal_data)
 
-            # Add Sortino Ratio
-            add_sortino_ratio(df, irx)
+    return signal_data
 
-            # Add slope information to stock data
-            add_moving_average_slope(df, setup)
 
-            # Add ADX
-            add_adx(df, setup)
+def compact_signal_frame(df, setup):
+    """Project a signal frame on the columns the later stages use, in the smallest dtypes holding them.
 
-            # Add RSI
-            add_rsi(df, setup)
+    Those are the Close and Action the backtest and recommendations read, plus the inputs of the
+    get_stock_from_rm filters the setup enables. Close stays float64 as the execution price;
+    indicators become float32 and the BUY/SELL/HOLD columns int8.
+    """
 
-            # Add OBV
-            calculate_obv(df, setup)
+    columns = ['Close', 'Action']
+    if setup['Risk']['SharpeRatio']['enabled']:
+        columns.append('sharpe_ratio')
+    if 'ma_cross' in setup['Filters']['Trend'] and setup['Filters']['Trend']['ma_cross']['enabled']:
+        columns += ['ma_cross_Cross', 'MA_Slope_ma_cross_short', 'MA_Slope_ma_cross_long']
 
-            # Add Stochastic data
-            add_stochastic_oscillator(df, setup)
+    df = df[[column for column in columns if column in df.columns]]
+    return df.astype({column: 'int8' if column == 'Action' or column.endswith('_Cross') else 'float32'
+                      for column in df.columns if column != 'Close'})
 
-            # Add Events Data
-            # Long Term Crossing
-            detect_long_term_crossings(stock_data=df, setup=setup, end_date=end_date)
 
-            # MA Crossing
-            detect_ma_crossings(stock_data=df, end_date=end_date, setup=setup)
+def get_frames_nbytes(frames):
+    return int(sum(df.memory_usage(deep=True).sum() for df in frames))
 
-            # Bollinger Bands
-            detect_bollinger_crossings(stock_data=df, end_date=end_date, setup=setup)
 
-            # Week Rule
-            detect_wr_crossings(stock_data=df, setup=setup, end_date=end_date)
+def log_compact_footprint(full_nbytes, signal_data):
+    compact_nbytes = get_frames_nbytes(signal_data.values())
+    logger.info(f"Signal frames use {compact_nbytes / 1024 ** 2:.2f} MB compacted, "
+                f"{full_nbytes / 1024 ** 2:.2f} MB in full")
 
-            # MACD Crossing
-            detect_macd_trend(df, setup=setup, end_date=end_date)
 
-            # Drop NA and remove auxiliary data
-            df.dropna(inplace=True)
-            df = df[df.index >= start_date]
+@profiled
+def get_ticker_signals(df, irx, setup, start_date, end_date):
+    """Run the indicator pipeline on a single ticker frame.
 
-            # Calculate score
-            set_score_action(df, setup)
+    Returns:
+        pandas.DataFrame: Rows with a BUY or SELL action, or None if the ticker has no signal.
+    """
 
-            if len(df[df['Action'] != HOLD]):
-                signal_data[ticker] = df
+    # Add arithmetic return
+    df['daily_return'] = df['Close'].pct_change(fill_method=None)
 
-            signal_data[ticker] = signal_data[ticker][signal_data[ticker]['Action'] != 0]
+    # Add VIX
+    #df['vix'] = vix_idx.Close
 
-            # Break loop if limit is exceeded
-            limit -= 1
-            if limit == 0:
-                break
-        except ValueError as e:
-            logger.error(f"{ticker} - {e}")
+    # Add Sharpe Ratio
+    add_shape_ratio(df, irx, setup)
 
-    return signal_data
+    # Add Sortino Ratio
+    add_sortino_ratio(df, irx, setup)
+
+    # Add slope information to stock data
+    add_moving_average_slope(df, setup)
+
+    # Add ADX
+    add_adx(df, setup)
+
+    # Add RSI
+    add_rsi(df, setup)
+
+    # Add OBV
+    calculate_obv(df, setup)
+
+    # Add Stochastic data
+    add_stochastic_oscillator(df, setup)
+
+    # Add Events Data
+    # Long Term Crossing
+    detect_long_term_crossings(stock_data=df, setup=setup, end_date=end_date)
+
+    # MA Crossing
+    detect_ma_crossings(stock_data=df, end_date=end_date, setup=setup)
+
+    # Bollinger Bands
+    detect_bollinger_crossings(stock_data=df, end_date=end_date, setup=setup)
+
+    # Week Rule
+    detect_wr_crossings(stock_data=df, setup=setup, end_date=end_date)
+
+    # MACD Crossing
+    detect_macd_trend(df, setup=setup, end_date=end_date)
+
+    # Drop NA and remove auxiliary data
+    df.dropna(inplace=True)
+    df = df[df.index >= start_date]
+
+    # Calculate score
+    set_score_action(df, setup)
+
+    if len(df[df['Action'] != HOLD]):
+        return df[df['Action'] != HOLD]
+
+    return None
+
+
+def get_panel_ticker_signals(price_panel, irx, setup, analysis_start_date, analysis_end_date, start_date,
+                             end_date):
+    """Compute the universe signal panel and yield ``(ticker, signals, error)`` in symbol order."""
+
+    prices = get_price_matrices(price_panel, analysis_start_date, analysis_end_date)
+    signal_panel = compute_signal_panel(prices, irx, setup, start_date)
+
+    for ticker in signal_panel.symbols:
+        if ticker in signal_panel.errors:
+            yield ticker, None, signal_panel.errors[ticker]
+        else:
+            df = signal_panel.get_frame(ticker)
+            yield ticker, (df if not df.empty else None), None
+
+
+def run_ticker_signals(price_panel, ticker, irx, setup, analysis_start_date, analysis_end_date, start_date,
+                       end_date):
+    """Compute signals of one panel ticker, returning ``(ticker, signals, error)``."""
+
+    # Extract data for this ticker as a view on the panel
+    df = price_panel.get_frame(ticker, analysis_start_date, analysis_end_date)
+
+    try:
+        with indicator_symbol(ticker), profile_stage('run_ticker_signals', ticker=ticker):
+            return ticker, get_ticker_signals(df, irx, setup, start_date, end_date), None
+    except ValueError as e:
+        return ticker, None, str(e)
+
+
+# Per process state of signal workers, sent once by the pool initializer instead of with every task
+_worker_context = None
+
+
+def init_signal_worker(panel_path, cache_config, irx, setup, analysis_start_date, analysis_end_date, start_date,
+                       end_date):
+    global _worker_context
+    configure_indicator_cache(*cache_config)
+    _worker_context = (open_price_panel(panel_path), irx, setup, analysis_start_date, analysis_end_date,
+                       start_date, end_date)
+
+
+def get_worker_ticker_signals(ticker):
+    price_panel, *context = _worker_context
+    return run_ticker_signals(price_panel, ticker, *context)
+
+
+@profiled
+def get_backtest_equity_curve(trades, stock_list, setup, start_date=None, end_date=None):
+    """Daily equity of the backtest trades over the stored closes, next to the S&P 500 on the same calendar.
+
+    Returns:
+        pandas.DataFrame: Equity curve, as calculate_equity_curve returns it.
+    """
+
+    # Imported here, so recommendation runs never load the backtest modules
+    from portfolio_manager import calculate_equity_curve
+
+    price_panel = fetch_price_panel(get_ticker_list(stock_list), start_date=start_date, end_date=end_date)
+    close = get_price_matrices(price_panel, start_date, end_date)['Close']
+    benchmark_idx = get_market_data(['^SPX'], start_date=start_date, end_date=end_date)
+
+    return calculate_equity_curve(trades, close, setup['Portfolio']['cash'], benchmark_idx['^SPX']['Close'])
+
+
+def get_position_stops(position, setup, end_date=None):
+    """Stop analysis of every lot of the position file, over the stored closes since its first lot.
+
+    Returns:
+        pandas.DataFrame: One row per lot, as evaluate_positions returns it.
+    """
+
+    start_date = min(pd.Timestamp(date) for lots in position['Position'].values() for date in lots)
+    price_panel = fetch_price_panel(list(position['Position']), start_date=start_date, end_date=end_date)
+
+    return evaluate_positions(position, price_panel, setup, end_date=end_date)
+
+
+def get_recommendations(signal_data, setup, current_date=None):
+    """Signals of the last setup['Recommendation']['Period'] business days before current_date (now by default).
+
+    Returns:
+        pandas.DataFrame: Symbol, Date, Close and Action of each recommended signal, ticker by ticker.
+    """
+
+    recommendation_period = setup["Recommendation"]["Period"]
+    recommendation_keys = ['Symbol', 'Date', 'Close', 'Action']
+    current_date = pd.Timestamp.now() if current_date is None else pd.Timestamp(current_date)
+    start_date = current_date - BusinessDay(recommendation_period)
+    stock_recommended_df = pd.DataFrame(columns=recommendation_keys)
+    for ticker in signal_data.keys():
+        df = signal_data[ticker]
+        df = df[df.index >= start_date]
+        if not df.empty:
+            df.reset_index(inplace=True)
+            df['Symbol'] = ticker
+            df = df[recommendation_keys]
+            stock_recommended_df = pd.concat([stock_recommended_df, df])
+
+    return stock_recommended_df
 
 
+@profiled
 def set_score_action(data, setup):
     """Calculates a normalized score for data based on analysis setup and assigns a trading action.
 
@@ -148,6 +333,7 @@ def set_score_action(data, setup):
     data['Action'] = data['Score'].apply(lambda x: BUY if x >= buy_thold else SELL if x <= sell_thold else HOLD)
 
 
+@profiled
 def add_moving_average_slope(stock_data, setup):
 
     # Add MA Period and calculate slope to data
@@ -18,8 +18,32 @@ def argument_parsing():
     parser.add_argument('-s', '--setup', required=True, action=LoadFromFile, help="Setup definition File.")
     parser.add_argument('-p', '--position', action=LoadFromFile, help="Setup position File.")
     parser.add_argument('-l', '--limit', type=int, default=500, help="Limit the number of stocks processed.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of worker processes computing ticker signals in parallel.")
+    parser.add_argument('--engine', choices=['ticker', 'panel'], default='ticker',
+                        help="Compute indicators ticker by ticker or over the whole universe at once.")
+    parser.add_argument('--compact', action="store_true", default=False,
+                        help="Keep only the signal columns later stages use, as float32 and int8, and report the "
+                             "memory saved.")
+    add_provider_arguments(parser)
+    parser.add_argument('--indicator_cache_size', type=int, default=256,
+                        help="Memory cap in MB of the computed indicators kept for reuse, 0 to disable. Hashing the "
+                             "inputs costs about 5%% of a single ticker engine run that reuses nothing, so 0 is "
+                             "faster there.")
+    parser.add_argument('--indicator_cache_dir',
+                        help="Directory persisting computed indicators, so later runs reuse them.")
     group.add_argument('-f', '--features', action="store_true", default=False,
                        help="Create features file for Machine Learning Training")
+    group.add_argument('-u', '--update', action="store_true", default=False,
+                       help="Advance the indicator state kept by the previous run by the new bars only, instead "
+                            "of recomputing the whole history.")
+    parser.add_argument('--profile', action="store_true", default=False,
+                        help="Time each pipeline stage and indicator, printing a summary table and writing it to "
+                             "reports/<hash>-profile.json.")
+    parser.add_argument('--profile_cprofile', action="store_true", default=False,
+                        help="With --profile, also run cProfile and keep its stats in reports/<hash>-profile.prof.")
+    parser.add_argument('--profile_memory', action="store_true", default=False,
+                        help="With --profile, also trace allocations with tracemalloc and report the peak.")
     parser.add_argument('-v', '--verbose', default=False, action="store_true", help="Verbose mode.")
     group.add_argument('-b', '--backtest', action="store_true",
                        help="Backtest mode provides recommended stocks prior to start date and assess the "
@@ -32,7 +56,127 @@ def argument_parsing():
     parser.add_argument('-ed', '--end_date', type=valid_date,
                         default=datetime.combine(datetime.now().date(), datetime.min.time())-relativedelta(hours=1),
                         help="The end date of evaluation - format YYYY-MM-DD")
-    return parser.parse_args()
+    args = parser.parse_args()
+    check_provider_arguments(parser, args)
+    return args
+
+
+def sweep_argument_parsing():
+
+    parser = argparse.ArgumentParser(description="Backtest every combination of a grid of setup parameters.")
+
+    parser.add_argument('-i', '--input', required=True, action=LoadFromFile,
+                        help="Input file containing stock tickers in JSON format.")
+    parser.add_argument('-s', '--setup', required=True, action=LoadFromFile, help="Base setup definition File.")
+    parser.add_argument('-g', '--grid', required=True, action=LoadFromFile,
+                        help="Parameter grid File mapping dotted setup paths (e.g. Analysis.Trend.ma_cross.short) "
+                             "to a list of values or to a {start, stop, step} range.")
+    parser.add_argument('-l', '--limit', type=int, default=500, help="Limit the number of stocks processed.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of worker processes backtesting combinations in parallel.")
+    parser.add_argument('--sort', default='total_return', help="Metric used to rank the combinations.")
+    parser.add_argument('--ascending', action="store_true", default=False,
+                        help="Rank the lowest values of the sort metric first (e.g. max_drawdown).")
+    parser.add_argument('--top', type=int, default=20, help="Number of ranked combinations printed.")
+    add_provider_arguments(parser)
+    parser.add_argument('--cache_size', type=int, default=1024,
+                        help="Memory cap in MB of the indicators each worker keeps for reuse.")
+    parser.add_argument('-o', '--output', help="CSV file to store every combination and its metrics.")
+    parser.add_argument('-sd', '--start_date', type=valid_date,
+                        default=datetime.combine(datetime.now().date(), datetime.min.time())-relativedelta(years=1),
+                        help="The start date of the backtest - format YYYY-MM-DD")
+    parser.add_argument('-ed', '--end_date', type=valid_date,
+                        default=datetime.combine(datetime.now().date(), datetime.min.time())-relativedelta(hours=1),
+                        help="The end date of the backtest - format YYYY-MM-DD")
+    args = parser.parse_args()
+    check_provider_arguments(parser, args)
+    return args
+
+
+def walk_forward_argument_parsing():
+
+    parser = argparse.ArgumentParser(description="Walk-forward optimization of setup parameters over rolling folds.")
+
+    parser.add_argument('-i', '--input', required=True, action=LoadFromFile,
+                        help="Input file containing stock tickers in JSON format.")
+    parser.add_argument('-s', '--setup', required=True, action=LoadFromFile, help="Base setup definition File.")
+    parser.add_argument('-g', '--grid', required=True, action=LoadFromFile,
+                        help="Parameter grid File, as in sweep.py, optimized on each in-sample window.")
+    parser.add_argument('-l', '--limit', type=int, default=500, help="Limit the number of stocks processed.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of worker processes backtesting combinations in parallel.")
+    parser.add_argument('--in_sample', type=int, default=12, help="Months of each in-sample window.")
+    parser.add_argument('--out_of_sample', type=int, default=3,
+                        help="Months of each out-of-sample window, which is also the step between folds.")
+    parser.add_argument('--anchored', action="store_true", default=False,
+                        help="Start every in-sample window at the start date instead of rolling it forward.")
+    parser.add_argument('--sort', default='total_return', help="In-sample metric the combinations are chosen by.")
+    parser.add_argument('--ascending', action="store_true", default=False,
+                        help="Choose the lowest value of the sort metric (e.g. max_drawdown).")
+    add_provider_arguments(parser)
+    parser.add_argument('--cache_size', type=int, default=1024,
+                        help="Memory cap in MB of the indicators each worker keeps for reuse.")
+    parser.add_argument('-o', '--output', help="CSV file to store the folds and their metrics.")
+    parser.add_argument('--trades', help="CSV file to store the stitched out-of-sample trades.")
+    parser.add_argument('-sd', '--start_date', type=valid_date,
+                        default=datetime.combine(datetime.now().date(), datetime.min.time())-relativedelta(years=3),
+                        help="The start date of the first in-sample window - format YYYY-MM-DD")
+    parser.add_argument('-ed', '--end_date', type=valid_date,
+                        default=datetime.combine(datetime.now().date(), datetime.min.time())-relativedelta(hours=1),
+                        help="The end date of the last out-of-sample window - format YYYY-MM-DD")
+    args = parser.parse_args()
+    check_provider_arguments(parser, args)
+    return args
+
+
+def server_argument_parsing():
+
+    parser = argparse.ArgumentParser(description="Resident service answering recommendation, signal and backtest "
+                                                 "queries from data and indicators kept in memory.")
+
+    parser.add_argument('-i', '--input', required=True, action=LoadFromFile,
+                        help="Input file containing stock tickers in JSON format.")
+    parser.add_argument('-s', '--setup', required=True, action=LoadFromFile,
+                        help="Setup definition File, used by queries that do not send their own.")
+    parser.add_argument('-l', '--limit', type=int, default=500, help="Limit the number of stocks processed.")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of worker processes computing ticker signals in parallel.")
+    parser.add_argument('--engine', choices=['ticker', 'panel'], default='panel',
+                        help="Compute indicators ticker by ticker or over the whole universe at once.")
+    add_provider_arguments(parser)
+    parser.add_argument('--indicator_cache_size', type=int, default=1024,
+                        help="Memory cap in MB of the computed indicators kept for reuse, 0 to disable.")
+    parser.add_argument('--indicator_cache_dir',
+                        help="Directory persisting computed indicators, so a restarted service reuses them.")
+    parser.add_argument('--host', default='127.0.0.1', help="Address the HTTP server listens on.")
+    parser.add_argument('--port', type=int, default=8765, help="Port the HTTP server listens on.")
+    parser.add_argument('--socket', help="Unix socket path to listen on instead of --host and --port.")
+    parser.add_argument('--refresh', type=float, default=60,
+                        help="Minutes between refreshes of the prices and signals, 0 to only refresh on request.")
+    parser.add_argument('--lookback', type=int, default=365,
+                        help="Calendar days of signals kept for recommendations and symbol queries.")
+    parser.add_argument('--max_results', type=int, default=32,
+                        help="Query results kept in memory for setups other than the default one and for backtests "
+                             "of other ranges, least recently used evicted first.")
+    args = parser.parse_args()
+    check_provider_arguments(parser, args)
+    return args
+
+
+def add_provider_arguments(parser):
+    """Options picking where the prices missing in ticker_data come from, see check_provider_arguments."""
+
+    parser.add_argument('--provider', choices=['yfinance', 'local', 'synthetic'], default='yfinance',
+                        help="Source of the prices missing in ticker_data: Yahoo, the per-symbol Parquet/CSV files "
+                             "of --data_dir, or seeded synthetic prices.")
+    parser.add_argument('--data_dir', help="Directory of per-symbol Parquet/CSV files read by the local provider.")
+
+
+def check_provider_arguments(parser, args):
+    """Exit with a usage error when the parsed provider options are incomplete."""
+
+    if args.provider == 'local' and args.data_dir is None:
+        parser.error("--provider local requires --data_dir")
 
 
 def valid_date(s: str) -> datetime:
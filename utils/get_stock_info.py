@@ -1,81 +1,135 @@
+import argparse
 import json
-import sys
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
 import pandas as pd
 import yfinance as yf
-import pickle
-import os
+
+INFO_DIR = os.path.join('ticker_data', 'info')
+DEFAULT_TTL = timedelta(days=7)
+
+# Fields of the S&P 500 list kept alongside the Yahoo info
+LIST_FIELDS = ['Security', 'GICS Sector', 'GICS Sub-Industry', 'Headquarters Location', 'Date added', 'CIK',
+               'Founded']
+
+
+def get_yahoo_info(symbol):
+    return yf.Ticker(symbol).info
+
+
+def fetch_stock_info(symbols, info_dir=INFO_DIR, ttl=DEFAULT_TTL, max_workers=16, retries=3, backoff=1.0,
+                     fetch_info=get_yahoo_info):
+    """
+    Yahoo info of each symbol, from a per-symbol cache in info_dir refreshed when older than ttl.
+
+    Stale and missing symbols are fetched by up to max_workers threads, each retried with
+    exponential backoff, and written to the cache as soon as they arrive, so an interrupted
+    refresh resumes from the symbols it had not fetched yet. fetch_info(symbol) returns the info
+    dict, yf.Ticker(symbol).info by default, and can be replaced by a local stub.
+
+    Returns:
+        dict: Symbol to its info dict, without the symbols that failed every attempt.
+    """
+
+    os.makedirs(info_dir, exist_ok=True)
+
+    stock_info = {}
+    pending = []
+    for symbol in dict.fromkeys(symbols):
+        info = read_stock_info(symbol, info_dir, ttl)
+        if info is None:
+            pending.append(symbol)
+        else:
+            stock_info[symbol] = info
+
+    if not pending:
+        return stock_info
+
+    print(f"Fetching info of {len(pending)} symbols, {len(stock_info)} cached")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_with_retry, fetch_info, symbol, retries, backoff): symbol
+                   for symbol in pending}
+        for future in as_completed(futures):
+            symbol = futures[future]
+            try:
+                info = future.result()
+            except Exception as e:
+                print(f"Error fetching data for {symbol}: {e}")
+                continue
+            write_stock_info(symbol, info, info_dir)
+            stock_info[symbol] = info
+
+    return stock_info
 
 
-def load_pickle_if_exists(pickle_file='stock_data.pkl'):
-    """Try to load existing pickle file; return None if not found."""
-    if os.path.exists(pickle_file):
+def fetch_with_retry(fetch_info, symbol, retries, backoff):
+    """Call fetch_info(symbol), retrying after backoff, 2 * backoff, ... seconds with some jitter."""
+    for attempt in range(retries + 1):
         try:
-            with open(pickle_file, 'rb') as file:
-                return pd.read_pickle(pickle_file)
-        except Exception as e:
-            print(f"Error loading pickle file {pickle_file}: {e}")
-    return None
+            return fetch_info(symbol)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
 
 
-def main(json_file_path):
-    # Try to load existing pickle file
-    pickle_file = 'stock_data.pkl'
-    df = load_pickle_if_exists(pickle_file)
-    if df is not None:
-        print(f"Loaded existing data from {pickle_file}")
-        return df
+def get_info_file(symbol, info_dir=INFO_DIR):
+    return os.path.join(info_dir, f"{symbol.replace('/', '_')}.json")
+
+
+def read_stock_info(symbol, info_dir=INFO_DIR, ttl=DEFAULT_TTL):
+    """Cached info of the symbol, or None when it is missing, unreadable or older than ttl."""
+
+    path = get_info_file(symbol, info_dir)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, 'r') as f:
+            cached = json.load(f)
+        if datetime.now() - datetime.fromisoformat(cached['fetched_at']) > ttl:
+            return None
+        return cached['info']
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Ignoring unreadable info cache {path}: {e}")
+        return None
+
+
+def write_stock_info(symbol, info, info_dir=INFO_DIR):
+
+    path = get_info_file(symbol, info_dir)
+
+    # Write to a temporary file first, so an interrupted refresh never leaves a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'fetched_at': datetime.now().isoformat(), 'info': info}, f, default=str)
+    os.replace(tmp_path, path)
+
+
+def main(json_file_path, info_dir=INFO_DIR, ttl=DEFAULT_TTL, max_workers=16, retries=3, fetch_info=get_yahoo_info):
 
-    # If no pickle file, load JSON and fetch data from Yahoo Finance
     with open(json_file_path, 'r') as file:
         stock_list = json.load(file)
 
-    # Prepare a list to hold the augmented data
-    augmented_data = []
+    stock_list = [stock for stock in stock_list if stock.get('Symbol')]
+    stock_info = fetch_stock_info([stock['Symbol'] for stock in stock_list], info_dir=info_dir, ttl=ttl,
+                                  max_workers=max_workers, retries=retries, fetch_info=fetch_info)
 
-    for stock in stock_list:
-        symbol = stock.get('Symbol')
-        if not symbol:
-            continue  # Skip if no symbol
-
-        try:
-            # Fetch stock info from Yahoo Finance
-            ticker = yf.Ticker(symbol)
-            info = ticker.info
-
-            # Extract all available features from yfinance
-            augmented_stock = {
-                'Symbol': symbol,
-                'Security': stock.get('Security'),
-                'GICS Sector': stock.get('GICS Sector'),
-                'GICS Sub-Industry': stock.get('GICS Sub-Industry'),
-                'Headquarters Location': stock.get('Headquarters Location'),
-                'Date added': stock.get('Date added'),
-                'CIK': stock.get('CIK'),
-                'Founded': stock.get('Founded'),
-                **{key: value for key, value in info.items()}  # Include all yfinance info fields
-            }
-
-            augmented_data.append(augmented_stock)
-
-        except Exception as e:
-            print(f"Error fetching data for {symbol}: {e}")
-            # Add with original data and None for yfinance fields
-            augmented_stock = {
-                'Symbol': symbol,
-                'Security': stock.get('Security'),
-                'GICS Sector': stock.get('GICS Sector'),
-                'GICS Sub-Industry': stock.get('GICS Sub-Industry'),
-                'Headquarters Location': stock.get('Headquarters Location'),
-                'Date added': stock.get('Date added'),
-                'CIK': stock.get('CIK'),
-                'Founded': stock.get('Founded')
-            }
-            augmented_data.append(augmented_stock)
+    # List fields, plus all yfinance info fields of the symbols fetched
+    augmented_data = [{'Symbol': stock['Symbol'], **{field: stock.get(field) for field in LIST_FIELDS},
+                       **stock_info.get(stock['Symbol'], {})}
+                      for stock in stock_list]
 
     # Create a DataFrame from the augmented data
     df = pd.DataFrame(augmented_data)
 
     # Save the DataFrame to a pickle file
+    pickle_file = 'stock_data.pkl'
     try:
         df.to_pickle(pickle_file)
         print(f"DataFrame saved to {pickle_file}")
@@ -90,9 +144,14 @@ def main(json_file_path):
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python script.py <path_to_json_file>")
-        sys.exit(1)
-
-    json_file_path = sys.argv[1]
-    main(json_file_path)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Augment a JSON list of stocks with their Yahoo info.')
+    parser.add_argument('json_file', help='Path to the JSON list of stocks')
+    parser.add_argument('--info-dir', default=INFO_DIR, help=f'Per-symbol info cache (default: {INFO_DIR})')
+    parser.add_argument('--ttl', type=float, default=DEFAULT_TTL.days * 24,
+                        help='Hours before a cached info is fetched again (default: 168)')
+    parser.add_argument('--workers', type=int, default=16, help='Concurrent requests (default: 16)')
+    parser.add_argument('--retries', type=int, default=3, help='Retries of a failed request (default: 3)')
+    args = parser.parse_args()
+
+    main(args.json_file, info_dir=args.info_dir, ttl=timedelta(hours=args.ttl), max_workers=args.workers,
+         retries=args.retries)
@@ -0,0 +1,152 @@
+import cProfile
+import functools
+import json
+import pstats
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+from tabulate import tabulate
+
+# Timings and counters of the run, only recorded between start_profiling and stop_profiling
+_enabled = False
+_stages = {}
+_counters = defaultdict(int)
+_tickers = defaultdict(float)
+_profiler = None
+
+
+def start_profiling(cprofile=False, memory=False):
+    """
+    Start recording the stages and counters of the run.
+
+    With cprofile the whole run is also profiled by cProfile, and with memory tracemalloc traces
+    the allocations, at the cost of slowing the run down.
+    """
+    global _enabled, _profiler
+
+    _stages.clear()
+    _counters.clear()
+    _tickers.clear()
+    _enabled = True
+
+    if cprofile:
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    if memory:
+        tracemalloc.start()
+
+
+def record_stage(name, elapsed, ticker=None):
+    # calls, total and longest call
+    stage = _stages.setdefault(name, [0, 0.0, 0.0])
+    stage[0] += 1
+    stage[1] += elapsed
+    stage[2] = max(stage[2], elapsed)
+    if ticker is not None:
+        _tickers[ticker] += elapsed
+
+
+@contextmanager
+def profile_stage(name, ticker=None):
+    """Time the block as a call of stage name, adding it to the time of ticker if given."""
+    if not _enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start, ticker)
+
+
+def profiled(func=None, name=None):
+    """Time every call of the decorated function as a stage, named after the function by default."""
+    if func is None:
+        return functools.partial(profiled, name=name)
+
+    stage_name = name or func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_stage(stage_name, time.perf_counter() - start)
+
+    return wrapper
+
+
+def count(name, value=1):
+    if _enabled:
+        _counters[name] += value
+
+
+def stop_profiling(path, top=30):
+    """
+    Stop recording and write the JSON report to path, with the cProfile stats next to it as .prof.
+
+    Returns:
+        dict: 'stages' (calls, total, mean and max time of each stage, slowest first), 'counters',
+        'tickers' (the `top` slowest tickers) and, when enabled, 'cprofile' and 'memory'.
+    """
+    global _enabled, _profiler
+
+    _enabled = False
+
+    stages = sorted(_stages.items(), key=lambda item: item[1][1], reverse=True)
+    tickers = sorted(_tickers.items(), key=lambda item: item[1], reverse=True)[:top]
+
+    report = {
+        'stages': {name: {'calls': calls, 'total_s': total, 'mean_ms': total / calls * 1000, 'max_ms': longest * 1000}
+                   for name, (calls, total, longest) in stages},
+        'counters': dict(_counters),
+        'tickers': {ticker: elapsed for ticker, elapsed in tickers}
+    }
+
+    if _profiler is not None:
+        _profiler.disable()
+        stats = pstats.Stats(_profiler)
+        stats.dump_stats(f"{path.rsplit('.', 1)[0]}.prof")
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+        report['cprofile'] = [{'function': f"{filename}:{line}({name})", 'calls': calls, 'tottime_s': tottime,
+                               'cumtime_s': cumtime}
+                              for (filename, line, name), (_, calls, tottime, cumtime, _) in functions]
+        _profiler = None
+
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().statistics('lineno')[:top]
+        tracemalloc.stop()
+        report['memory'] = {
+            'current_mb': current / 1024 ** 2,
+            'peak_mb': peak / 1024 ** 2,
+            'top': [{'location': str(stat.traceback), 'size_mb': stat.size / 1024 ** 2, 'count': stat.count}
+                    for stat in statistics]
+        }
+
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    return report
+
+
+def print_profile_report(report):
+    """Print the stages and counters of a report as tables."""
+
+    rows = [[name, stage['calls'], stage['total_s'], stage['mean_ms'], stage['max_ms']]
+            for name, stage in report['stages'].items()]
+    print(tabulate(rows, headers=['stage', 'calls', 'total [s]', 'mean [ms]', 'max [ms]'], tablefmt="grid",
+                   floatfmt=".3f"))
+
+    if report['counters']:
+        print(tabulate(list(report['counters'].items()), headers=['counter', 'value'], tablefmt="grid"))
+
+    if 'memory' in report:
+        print(f"Peak traced memory {report['memory']['peak_mb']:.1f} MB")
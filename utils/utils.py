@@ -8,6 +8,7 @@ from constants import SELL, BUY
 from utils.logging_config import logger
 import os
 import json
+import pandas as pd
 
 
 class LoadFromFile(argparse.Action):
@@ -153,22 +154,24 @@ def analysis_to_file(analysis_data, setup, report_hash):
 
 def position_results_to_file(position_results, setup, hash):
     with open(f"reports/{hash}-position.csv", mode='w') as f:
-        output = "Ticker,Date Start,Price Start,Last Close,Volume,Gain %,Period,Profit [USD]\n"
+        output = "Ticker,Date Start,Price Start,Last Close,Volume,Gain %,Period,Profit [USD],Stop Date,Stop Close\n"
         f.write(output)
 
-        for ticker in position_results.keys():
-            for date in position_results[ticker].keys():
-                price_start = position_results[ticker][date]['price_start']
-                price_end = position_results[ticker][date]['price_end']
-                gain = position_results[ticker][date]['gain']
-                period = position_results[ticker][date]['period'].days
-                volume = position_results[ticker][date]['volume']
-                profit = round(volume * (gain / 100.0) * price_start, 2)
-                if (gain / 100.0) <= (setup['Risk']['Stop']['margin'] * -1.00):
-                    output = f"**{ticker}**,{date},{price_start},{price_end},{volume},**{gain}**,{period}, {profit}\n"
-                else:
-                    output = f"{ticker},{date},{price_start},{price_end},{volume},{gain},{period}, {profit}\n"
-                f.write(output)
+        for lot in position_results.itertuples(index=False):
+            ticker = lot.symbol
+            date = lot.date.date()
+            price_start = lot.price_start
+            price_end = lot.price_end
+            gain = lot.gain
+            period = lot.period.days if not pd.isna(lot.period) else None
+            volume = lot.volume
+            profit = round(volume * (gain / 100.0) * price_start, 2)
+            stop = f"{lot.stop_date.date()},{lot.stop_close}" if not pd.isna(lot.stop_date) else ","
+            if (gain / 100.0) <= (setup['Risk']['Stop']['margin'] * -1.00):
+                output = f"**{ticker}**,{date},{price_start},{price_end},{volume},**{gain}**,{period}, {profit},{stop}\n"
+            else:
+                output = f"{ticker},{date},{price_start},{price_end},{volume},{gain},{period}, {profit},{stop}\n"
+            f.write(output)
     f.close()
 
 
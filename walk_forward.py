@@ -0,0 +1,340 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+from tabulate import tabulate
+
+from constants import HOLD
+from data_providers import configure_data_provider
+from indicator_cache import IndicatorCache, configure_indicator_cache
+from market_data import get_market_data
+from panel_indicators import get_price_matrices, compute_signal_panel
+from portfolio_manager import backtest_signals, calculate_trade_metrics, calculate_equity_curve
+from price_panel import fetch_price_panel, open_price_panel
+from risk import calculate_risk_filter
+from sweep import get_combinations, set_parameters
+from utils.argument_parsing import walk_forward_argument_parsing
+from utils.logging_config import logger
+from utils.utils import get_ticker_list, get_stock_selection_dates
+
+pd.options.mode.chained_assignment = None
+
+
+def main():
+
+    args = walk_forward_argument_parsing()
+    configure_data_provider(args.provider, data_dir=args.data_dir)
+
+    keys, combinations = get_combinations(args.grid)
+
+    try:
+        setups = [set_parameters(args.setup, keys, values) for values in combinations]
+    except KeyError as e:
+        logger.error(f"Invalid parameter grid - {e}")
+        return
+
+    folds = get_folds(args.start_date, args.end_date, args.in_sample, args.out_of_sample, args.anchored)
+    if not folds:
+        logger.error(f"No out-of-sample window fits between {args.start_date.date()} and {args.end_date.date()}")
+        return
+
+    print(f"--------------------------------------------------------\n"
+          f"Walk-forward over {len(folds)} folds of {len(combinations)} combinations of {', '.join(keys)}\n"
+          f"--------------------------------------------------------\n")
+
+    # Prices are loaded once, with the longest warm-up any combination needs, and sliced per fold
+    analysis_start_date = min(get_stock_selection_dates(args.start_date, args.end_date, setup=setup)[0]
+                              for setup in setups)
+    price_panel = fetch_price_panel(get_ticker_list(args.input), start_date=analysis_start_date,
+                                    end_date=args.end_date)
+
+    # Get SP500 and 3Mo Treasury bills data for benchmarks
+    benchmark_idx = get_market_data(['^SPX', '^IRX'], start_date=analysis_start_date, end_date=args.end_date)
+
+    context = (price_panel.path, benchmark_idx['^IRX'], args.setup, keys, folds, args.limit, analysis_start_date,
+               args.end_date, args.sort, args.ascending, args.cache_size * 1024 ** 2)
+
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=init_walk_forward_worker,
+                                       initargs=context)
+        chunksize = max(1, len(combinations) // (args.workers * 4))
+        results = executor.map(run_combination_folds, combinations, chunksize=chunksize)
+    else:
+        executor = None
+        init_walk_forward_worker(*context)
+        results = map(run_combination_folds, combinations)
+
+    # Best combination of each fold on its in-sample window; ties go to the first in grid order
+    best = [None] * len(folds)
+    for values, fold_results, error in results:
+        if error is not None:
+            logger.error(f"{dict(zip(keys, values))} - {error}")
+            continue
+        for i, (score, out_of_sample_trades) in enumerate(fold_results):
+            if best[i] is None or is_better(score, best[i][1], args.ascending):
+                best[i] = (values, score, out_of_sample_trades)
+
+    if executor is not None:
+        executor.shutdown()
+
+    if all(fold is None for fold in best):
+        logger.error("No combination could be backtested")
+        return
+
+    # Closes of the out-of-sample period, to mark the trades to market
+    close = get_price_matrices(price_panel, folds[0][1], folds[-1][2])['Close']
+
+    rows, trades = stitch_folds(folds, best, keys, args.setup, args.sort, benchmark_idx['^SPX']['Close'], close)
+
+    # Metrics of the out-of-sample windows taken together
+    benchmark = get_benchmark_gain(benchmark_idx['^SPX']['Close'], folds[0][1], folds[-1][2])
+    equity_curve = calculate_equity_curve(trades, close, args.setup['Portfolio']['cash'],
+                                          benchmark_idx['^SPX']['Close'])
+    metrics = calculate_trade_metrics(trades, benchmark, args.setup, print_trades=False, equity_curve=equity_curve)
+
+    fold_table = pd.DataFrame(rows)
+    if args.output:
+        fold_table.to_csv(args.output, index=False)
+    if args.trades:
+        trades.to_csv(args.trades, index=False)
+
+    print(tabulate(fold_table.to_dict('records'), headers='keys', tablefmt="grid", floatfmt=".2f"))
+    print(f"Stitched out-of-sample {folds[0][1].date()} to {folds[-1][2].date()}")
+    print(tabulate([list(metrics.values())], headers=list(metrics.keys()), tablefmt="grid", floatfmt=".2f"))
+
+
+def get_folds(start_date, end_date, in_sample, out_of_sample, anchored=False):
+    """
+    In-sample start, out-of-sample start and out-of-sample end of each fold.
+
+    Out-of-sample windows of `out_of_sample` months follow each other up to end_date, each one
+    right after its `in_sample` months in-sample window. Anchored folds keep every in-sample
+    window starting at start_date instead.
+    """
+
+    folds = []
+    in_sample_start = start_date
+    out_of_sample_start = start_date + relativedelta(months=in_sample)
+
+    while out_of_sample_start < end_date:
+        out_of_sample_end = min(out_of_sample_start + relativedelta(months=out_of_sample), end_date)
+        folds.append((in_sample_start, out_of_sample_start, out_of_sample_end))
+
+        out_of_sample_start = out_of_sample_end
+        if not anchored:
+            in_sample_start = out_of_sample_start - relativedelta(months=in_sample)
+
+    return folds
+
+
+def is_better(score, best_score, ascending):
+    if pd.isna(score):
+        return False
+    if pd.isna(best_score):
+        return True
+    return score < best_score if ascending else score > best_score
+
+
+def stitch_folds(folds, best, keys, setup, sort, benchmark_close, close):
+    """
+    Table of the folds with the chosen parameters and their out-of-sample metrics, and the
+    out-of-sample trades of every fold in a single frame.
+
+    Every fold trades from the same initial cash and ends flat, so the cash of each fold is
+    carried over by adding the profit of the folds before it.
+    """
+
+    rows = []
+    frames = []
+    carried_profit = 0.0
+
+    for i, ((in_sample_start, out_of_sample_start, out_of_sample_end), fold) in enumerate(zip(folds, best)):
+
+        row = {'fold': i + 1, 'in_sample': f"{in_sample_start.date()} - {out_of_sample_start.date()}",
+               'out_of_sample': f"{out_of_sample_start.date()} - {out_of_sample_end.date()}"}
+
+        if fold is None:
+            rows.append(row)
+            continue
+
+        values, score, trades = fold
+        fold_setup = set_parameters(setup, keys, values)
+        benchmark = get_benchmark_gain(benchmark_close, out_of_sample_start, out_of_sample_end)
+        fold_close = close[(close.index >= out_of_sample_start) & (close.index < out_of_sample_end)]
+        equity_curve = calculate_equity_curve(trades, fold_close, fold_setup['Portfolio']['cash'])
+        metrics = calculate_trade_metrics(trades, benchmark, fold_setup, print_trades=False, equity_curve=equity_curve)
+
+        row.update(dict(zip(keys, values)))
+        row[f"in_sample_{sort}"] = score
+        row.update({name: metrics[name] for name in ['total_return', 'win_ratio', 'total_trades', 'max_drawdown',
+                                                     'sharpe_ratio'] if name in metrics})
+        row['benchmark'] = None if benchmark is None else benchmark['^SPX']
+        rows.append(row)
+
+        if len(trades):
+            trades = trades.assign(fold=i + 1)
+            trades['cash_remaining'] += carried_profit
+            carried_profit = trades['cash_remaining'].iloc[-1] - fold_setup['Portfolio']['cash']
+            frames.append(trades)
+
+    if not frames:
+        return rows, pd.DataFrame(columns=['date', 'symbol', 'action', 'price', 'quantity', 'cash_remaining', 'fold'])
+    return rows, pd.concat(frames, ignore_index=True)
+
+
+def get_benchmark_gain(benchmark_close, start_date, end_date):
+    """Percentage gain of the benchmark within [start_date, end_date), as calculate_ticker_gain reports it."""
+
+    close = benchmark_close[(benchmark_close.index >= start_date) & (benchmark_close.index < end_date)].dropna()
+    if close.empty:
+        return None
+
+    return {'^SPX': round(float((close.iloc[-1] - close.iloc[0]) / close.iloc[0] * 100), 2)}
+
+
+# Per process state of walk-forward workers, sent once by the pool initializer instead of with every task
+_worker_context = None
+
+
+def init_walk_forward_worker(panel_path, irx, setup, keys, folds, limit, analysis_start_date, end_date, sort,
+                             ascending, cache_size):
+    global _worker_context
+
+    # Combinations share indicators through the worker cache below, keyed by parameters only
+    configure_indicator_cache(0)
+
+    price_panel = open_price_panel(panel_path)
+
+    _worker_context = {
+        'prices': get_price_matrices(price_panel, analysis_start_date, end_date),
+        'risk_free': irx[irx.index >= analysis_start_date], 'setup': setup, 'keys': keys, 'folds': folds,
+        'limit': limit, 'sort': sort, 'ascending': ascending, 'cache': IndicatorCache(cache_size)
+    }
+
+
+def run_combination_folds(values):
+    """
+    Backtest a combination on every fold, returning ``(values, fold results, error)``.
+
+    Indicators are causal, so the signal panel is computed once over the whole period and each
+    window only slices it. Each fold result is the in-sample score and the out-of-sample trades.
+    """
+
+    context = _worker_context
+    setup = set_parameters(context['setup'], context['keys'], values)
+
+    try:
+        signal_panel = compute_signal_panel(context['prices'], context['risk_free'], setup, context['folds'][0][0],
+                                            cache=context['cache'])
+        window_signals = get_window_signals(signal_panel, setup, context['limit'])
+
+        fold_results = []
+        for in_sample_start, out_of_sample_start, out_of_sample_end in context['folds']:
+            trades = backtest_window(window_signals, setup, in_sample_start, out_of_sample_start)
+            equity_curve = calculate_equity_curve(trades, get_window_close(window_signals, in_sample_start,
+                                                                           out_of_sample_start),
+                                                  setup['Portfolio']['cash'])
+            metrics = calculate_trade_metrics(trades, None, setup, print_trades=False, equity_curve=equity_curve)
+            fold_results.append((metrics.get(context['sort'], np.nan),
+                                 backtest_window(window_signals, setup, out_of_sample_start, out_of_sample_end)))
+    except ValueError as e:
+        return values, None, str(e)
+    finally:
+        context['cache'].trim()
+
+    return values, fold_results, None
+
+
+def get_window_signals(signal_panel, setup, limit):
+    """
+    Day x symbol arrays of the panel signals passing the risk filters, for backtest_window.
+
+    Only the first `limit` symbols without errors take part, like in get_stock_signals.
+    """
+
+    symbols = [symbol for symbol in signal_panel.symbols if symbol not in signal_panel.errors]
+    if limit > 0:
+        symbols = symbols[:limit]
+    columns = [signal_panel.symbol_index[symbol] for symbol in symbols]
+
+    actions = signal_panel['Action'].to_numpy()[:, columns]
+    keep = (signal_panel.valid.to_numpy()[:, columns] & (actions != HOLD) &
+            calculate_risk_filter(signal_panel, setup).to_numpy()[:, columns])
+
+    return {
+        'symbols': symbols, 'dates': signal_panel.dates, 'actions': actions, 'keep': keep,
+        'close': signal_panel['Close'].to_numpy()[:, columns]
+    }
+
+
+def backtest_window(window_signals, setup, start_date, end_date):
+    """
+    Backtest the signals within [start_date, end_date), selling the positions still open on the
+    last close of the window so every window is scored on its own trades.
+    """
+
+    dates = window_signals['dates']
+    rows = slice(dates.searchsorted(pd.Timestamp(start_date)), dates.searchsorted(pd.Timestamp(end_date)))
+    keep = window_signals['keep'][rows]
+    actions = window_signals['actions'][rows]
+    close = window_signals['close'][rows]
+    window_dates = dates.values[rows]
+
+    # Symbol by symbol, as the signal frames are concatenated by portfolio_manager
+    symbol_ids, days = np.nonzero(keep.T)
+    trades = backtest_signals(window_signals['symbols'], window_dates[days], symbol_ids, actions[days, symbol_ids],
+                              close[days, symbol_ids], setup)
+
+    return close_open_positions(trades, window_signals['symbols'], window_dates, close, setup)
+
+
+def get_window_close(window_signals, start_date, end_date):
+    """Days x symbols closes of the window signals within [start_date, end_date)."""
+
+    dates = window_signals['dates']
+    rows = slice(dates.searchsorted(pd.Timestamp(start_date)), dates.searchsorted(pd.Timestamp(end_date)))
+    return pd.DataFrame(window_signals['close'][rows], index=dates[rows], columns=window_signals['symbols'])
+
+
+def close_open_positions(trades, symbols, dates, close, setup):
+    """
+    Add a sell at the last close of the window for every position the trades leave open.
+
+    A symbol whose data ends early is sold on its last observed day, before later trades of the window,
+    so the sells are merged in by date and the cash after each trade is chained again in that order.
+    """
+
+    bought = trades['quantity'].where(trades['action'] == 'buy', -trades['quantity'])
+    held = bought.groupby(trades['symbol'], sort=False).sum()
+    held = held[held > 0]
+    if held.empty:
+        return trades
+
+    cash = trades['cash_remaining'].iloc[-1] if len(trades) else setup['Portfolio']['cash']
+    symbol_index = {symbol: i for i, symbol in enumerate(symbols)}
+
+    sells = []
+    for symbol, quantity in held.items():
+        observed = np.flatnonzero(~np.isnan(close[:, symbol_index[symbol]]))
+        row = observed[-1]
+        price = close[row, symbol_index[symbol]]
+        cash += quantity * price
+        sells.append({'date': dates[row], 'symbol': symbol, 'action': 'sell', 'price': price, 'quantity': quantity,
+                      'cash_remaining': cash})
+
+    trades = pd.concat([trades, pd.DataFrame(sells)], ignore_index=True)
+    if trades['date'].is_monotonic_increasing:
+        return trades
+
+    # Chain the cash again in date order, from the cash change of each trade
+    cash_change = np.diff(trades['cash_remaining'].to_numpy(dtype=float), prepend=setup['Portfolio']['cash'])
+    order = np.argsort(trades['date'].to_numpy(), kind='stable')
+    trades = trades.iloc[order].reset_index(drop=True)
+    trades['cash_remaining'] = setup['Portfolio']['cash'] + np.cumsum(cash_change[order])
+
+    return trades
+
+
+if __name__ == "__main__":
+    main()